@@ -0,0 +1,149 @@
+"""Benchmark of the embedding service under concurrent callers.
+
+Threads embed short texts from train.csv (questions and wrong answers, some asked again), once by
+calling the model per request under a lock and once through EmbeddingService's micro-batching and
+LRU cache. Reports throughput, request latency, model calls and cache hits.
+
+    python benchmarks/bench_embedding_service.py [--callers 16] [--requests 50] [--backend auto]
+
+Without the model weights (no network), --synthetic stands in a model whose encode call costs a
+fixed overhead plus a per-text time, which is what batching amortizes.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(ROOT, "src"))
+
+import numpy as np
+import pandas as pd
+
+from embedding_service import DEFAULT_EMBEDDING_MODEL, EmbeddingService, load_sentence_model
+
+
+class SyntheticModel:
+    """SentenceTransformer stand-in: `overhead_ms` per encode call plus `per_text_ms` per text."""
+
+    def __init__(self, overhead_ms: float, per_text_ms: float, dimension: int = 384):
+        self.overhead_ms = overhead_ms
+        self.per_text_ms = per_text_ms
+        self.dimension = dimension
+
+    def encode(self, texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False):
+        time.sleep((self.overhead_ms + self.per_text_ms * len(texts)) / 1000)
+        vectors = np.random.default_rng(len(texts)).standard_normal((len(texts), self.dimension)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+
+def make_requests(data_path, callers, requests, texts, repeat, seed):
+    """Per caller, `requests` lists of `texts` texts; a `repeat` share is drawn from a small hot set."""
+    data = pd.read_csv(data_path)
+    corpus = pd.concat([data["QuestionText"], data["AnswerAText"], data["AnswerBText"]]).dropna().astype(str).unique()
+    rng = np.random.default_rng(seed)
+    hot = rng.choice(corpus, size=max(1, len(corpus) // 100), replace=False)
+    plan = []
+    for _ in range(callers):
+        caller = []
+        for _ in range(requests):
+            pool = np.where(rng.random(texts) < repeat, rng.choice(hot, size=texts), rng.choice(corpus, size=texts))
+            caller.append([str(text) for text in pool])
+        plan.append(caller)
+    return plan
+
+
+def run(embed, plan):
+    """Wall time and per-request latencies (ms) of all callers running `plan` at once."""
+    latencies = [[] for _ in plan]
+    start_barrier = threading.Barrier(len(plan) + 1)
+
+    def caller(i):
+        start_barrier.wait()
+        for texts in plan[i]:
+            started = time.perf_counter()
+            embed(texts)
+            latencies[i].append((time.perf_counter() - started) * 1000)
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(len(plan))]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, np.concatenate([np.asarray(l) for l in latencies])
+
+
+def report(name, wall_s, latencies, texts, model_calls, cache_hits=None):
+    line = (f"{name:<10} {wall_s:7.2f} s  {texts / wall_s:8.0f} texts/s  p50 {np.percentile(latencies, 50):7.1f} ms"
+            f"  p95 {np.percentile(latencies, 95):7.1f} ms  model calls {model_calls:6d}")
+    if cache_hits is not None:
+        line += f"  cache hits {cache_hits / texts:.0%}"
+    print(line)
+
+
+class CountingModel:
+    """Counts encode calls of the wrapped model."""
+
+    def __init__(self, model):
+        self.model = model
+        self.calls = 0
+
+    def encode(self, texts, **kwargs):
+        self.calls += 1
+        return self.model.encode(texts, **kwargs)
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data", default=os.path.join(ROOT, "data", "train.csv"))
+    parser.add_argument("--callers", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=50, help="requests per caller")
+    parser.add_argument("--texts", type=int, default=3, help="texts per request")
+    parser.add_argument("--repeat", type=float, default=0.3, help="share of texts drawn from a small hot set")
+    parser.add_argument("--model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--backend", default="auto", choices=["auto", "onnx", "int8", "torch"])
+    parser.add_argument("--synthetic", action="store_true", help="use a synthetic model instead of the real one")
+    parser.add_argument("--overhead-ms", type=float, default=5.0, help="synthetic model: cost per encode call")
+    parser.add_argument("--per-text-ms", type=float, default=0.5, help="synthetic model: cost per text")
+    parser.add_argument("--max-wait-ms", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        model = SyntheticModel(args.overhead_ms, args.per_text_ms)
+    else:
+        model = load_sentence_model(args.model, args.backend)
+    plan = make_requests(args.data, args.callers, args.requests, args.texts, args.repeat, args.seed)
+    texts = args.callers * args.requests * args.texts
+
+    direct = CountingModel(model)
+    lock = threading.Lock()
+
+    def embed_directly(request_texts):
+        with lock:
+            return direct.encode(request_texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True,
+                                 show_progress_bar=False)
+
+    embed_directly(plan[0][0])  # warm up
+    direct.calls = 0
+    wall_s, latencies = run(embed_directly, plan)
+    report("direct", wall_s, latencies, texts, direct.calls)
+
+    batched = CountingModel(model)
+    service = EmbeddingService(batched, max_wait_ms=args.max_wait_ms)
+    wall_s, latencies = run(service, plan)
+    report("service", wall_s, latencies, texts, batched.calls, service.stats["cache_hits"])
+    print(f"batches:   {service.stats['batches']} ({service.stats['encoded'] / max(1, service.stats['batches']):.1f} texts each)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark of the MAP@25 evaluator on a synthetic multi-million-row submission.
+
+Writes a submission in the sample_submission.csv format with random rankings (the gold id is
+planted at a random rank in most rows), then times parsing and scoring.
+
+    python benchmarks/bench_map_at_k.py [--rows 2000000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(ROOT, "src"))
+
+import numpy as np
+
+from evaluation import DEFAULT_K, align, answer_keys, load_predictions, score
+
+
+def write_submission(path, rows, k, n_misconceptions, seed, chunk=200_000):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, n_misconceptions, size=rows)
+    with open(path, "w") as f:
+        f.write("QuestionId_Answer,MisconceptionId\n")
+        for begin in range(0, rows, chunk):
+            end = min(begin + chunk, rows)
+            predictions = rng.integers(0, n_misconceptions, size=(end - begin, k))
+            planted = rng.random(end - begin) < 0.8
+            predictions[planted, rng.integers(0, k, size=planted.sum())] = labels[begin:end][planted]
+            f.writelines(f"{i}_{'ABCD'[i % 4]},{' '.join(map(str, row))}\n"
+                         for i, row in zip(range(begin, end), predictions.tolist()))
+    return answer_keys(np.arange(rows), np.arange(rows) % 4), labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--misconceptions", type=int, default=2587)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "submission.csv")
+        keys, labels = write_submission(path, args.rows, DEFAULT_K, args.misconceptions, args.seed)
+        size_mb = os.path.getsize(path) / 2 ** 20
+
+        start = time.perf_counter()
+        parsed_keys, predictions = load_predictions(path)
+        parsed = time.perf_counter()
+        # Score in a shuffled label order so the key join is exercised too.
+        order = np.random.default_rng(args.seed).permutation(args.rows)
+        aligned, found = align(parsed_keys, predictions, keys[order])
+        result = score(aligned, labels[order], groups=np.arange(args.rows)[order] % 163)
+        scored = time.perf_counter()
+
+    print(f"rows:            {args.rows} ({size_mb:.0f} MB)")
+    print(f"parse:           {parsed - start:8.2f} s")
+    print(f"align + score:   {scored - parsed:8.2f} s")
+    print(f"map@{DEFAULT_K}:          {result[f'map@{DEFAULT_K}']:8.4f}  (all keys found: {bool(found.all())})")
+
+
+if __name__ == "__main__":
+    main()
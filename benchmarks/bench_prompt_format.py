@@ -0,0 +1,70 @@
+"""Micro-benchmark of per-call prompt formatting overhead in PrefixedChatAdapter.
+
+Uses the few-shot demos stored in compiled_model.dspy and compares the stock dspy
+ChatAdapter.format against the cached PrefixedChatAdapter.format.
+
+    python benchmarks/bench_prompt_format.py [--calls 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(ROOT, "src"))
+
+import dspy
+
+from util import Persona, PrefixedChatAdapter
+from agents import BaseAgentSignature
+
+
+def load_demos(path):
+    with open(path) as f:
+        state = json.load(f)
+    demos = []
+    for predictor_state in state.values():
+        demos.extend(dspy.Example(**demo) for demo in predictor_state.get("demos", []))
+    return demos
+
+
+def bench(fn, calls):
+    fn()  # warm up (fills the adapter cache)
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--compiled", default=os.path.join(ROOT, "compiled_model.dspy"))
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    demos = load_demos(args.compiled)
+    inputs = dict(
+        context="Agent A concludes: (Adds instead of multiplies)",
+        QuestionText="\\[\n3 \\times 2+4-5\n\\]\nWhere do the brackets need to go to make the answer equal \\( 13 \\) ?",
+        AnswerText="\\( 3 \\times(2+4-5) \\)",
+        ConstructName="Use the order of operations to carry out calculations involving powers",
+        SubjectName="BIDMAS",
+        CorrectAnswer="\\( 3 \\times(2+4)-5 \\)",
+    )
+
+    baseline = dspy.adapters.chat_adapter.ChatAdapter()
+    cached = PrefixedChatAdapter()
+
+    baseline_us = bench(lambda: baseline.format(BaseAgentSignature, demos, dict(inputs)), args.calls)
+    cached_us = bench(
+        lambda: cached.format(BaseAgentSignature, demos, dict(inputs, prefix=Persona.AGENT_A_new)), args.calls)
+
+    print(f"demos per call:            {len(demos)}")
+    print(f"ChatAdapter.format:        {baseline_us:9.1f} us/call")
+    print(f"PrefixedChatAdapter.format:{cached_us:9.1f} us/call")
+    print(f"speedup:                   {baseline_us / cached_us:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,18 @@ import os
 import certifi
 os.environ['SSL_CERT_FILE'] = certifi.where()
 
-import dspy
 import sys
 import pdb
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 
 import streamlit as st
 
 from openai import OpenAI
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../src")))
-from predict_model import ExchangeOfThought
-from config import configure_dspy
-from agents import AdvancedAgent
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from program_config import APP_PROGRAM
+from chat_history import ChatHistory, openai_summarizer
 
 class QuizApp:
     def __init__(self):
@@ -22,7 +22,6 @@ class QuizApp:
         # Configure page with wider layout
         self._setup_page_config()
 
-        configure_dspy(dspy)
         OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
         self.client = OpenAI(
             api_key = OPENAI_API_KEY,
@@ -35,26 +34,16 @@ class QuizApp:
 
         # Load custom CSS
         self._load_custom_css()
-        self.round = 2
-        self.mode = "Report"
-
-        # Set up Agents
-        lm = dspy.LM('openai/gpt-3.5-turbo')
-        dspy.configure(lm=lm)
-        agent_a = AdvancedAgent(name="Agent A", persona_promt=None)
-        agent_b = AdvancedAgent(name="Agent B", persona_promt=None)
-        agent_c = AdvancedAgent(name="Agent C", persona_promt=None)
-        agent_d = AdvancedAgent(name="Agent D", persona_promt=None)
-        agent_e = AdvancedAgent(name="Agent E", persona_promt=None)
-        self.model = ExchangeOfThought(
-            agent_a, agent_b, agent_c, agent_d, agent_e, rounds=self.round, mode=self.mode)
+        # The pages' program (src/program_config.py): Report mode, 2 rounds, routed models and the semantic cache.
+        self.round = APP_PROGRAM.rounds
+        self.mode = APP_PROGRAM.mode
+        # Seconds an analysis may take; remaining rounds are skipped when time runs out.
+        self.timeout = APP_PROGRAM.timeout
+        self.model = APP_PROGRAM.build()
 
         self.correct_answer = ''
         self.misconception_answer = ''
 
-        # evaluate
-        # self.model.load('./compiled_model.dspy')
-
     def _setup_page_config(self):
         """Configure page settings and style."""
         st.set_page_config(
@@ -175,6 +164,17 @@ class QuizApp:
             </div>
         """, unsafe_allow_html=True)
 
+    def _pending_miscon(self, misconception_container, option):
+        misconception_container.markdown(f"""
+            <div style="background-color: white; 
+                        padding: 20px; 
+                        border-radius: 10px; 
+                        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+                        margin-bottom: 15px;">
+                The agents are working out the {option}...
+            </div>
+        """, unsafe_allow_html=True)
+
     def _update_miscon(self, misconception_container, misconception, option):
         misconception_container.markdown(f"""
             <div style="background-color: white; 
@@ -199,10 +199,12 @@ class QuizApp:
         if "openai_model" not in st.session_state:
             st.session_state["openai_model"] = "gpt-3.5-turbo"
         
-        if "messages" not in st.session_state:
-            st.session_state.messages = [
-                {"role": "system", "content": "Find the misconception of the question."}
-            ]
+        if "chat_history" not in st.session_state:
+            # Last 4 turns verbatim, older ones summarized in the background; requests stay under 2000 tokens.
+            st.session_state.chat_history = ChatHistory(
+                "Find the misconception of the question.",
+                openai_summarizer(self.client, st.session_state["openai_model"], max_tokens=300),
+                keep_turns=4, token_budget=2000)
 
         # Create columns with custom layout
         col1, col2 = st.columns([2, 1])
@@ -237,37 +239,64 @@ class QuizApp:
                 Based on the Question and the Correct Options. Please analyze and provide misconceptions of the Misconception options.
                 """
 
-                try:
-                    # Analyze misconceptions
-                    pred_p = self.model(QuestionText=full_question, 
-                                        AnswerText=self.misconception_answer, 
-                                        CorrectAnswer=self.correct_answer, 
-                                        ConstructName=None, 
-                                        SubjectName=None)
-                    self._update_miscon(misconception_container, pred_p, 'Misconception Insights')
-
-                    # Chat functionality
-                    if full_question:
-                        st.session_state.messages.append({"role": "user", "content": full_question})
-                        
+                # The analysis and the chat are independent: the agents run on a background thread
+                # while the chat streams, and the panel is filled in as soon as their result arrives.
+                # The program applies its own dspy settings in whatever thread it runs.
+                def analyze():
+                    return self.model(QuestionText=full_question,
+                                      AnswerText=self.misconception_answer,
+                                      CorrectAnswer=self.correct_answer,
+                                      ConstructName=None,
+                                      SubjectName=None)
+
+                with ThreadPoolExecutor(max_workers=1, thread_name_prefix="misconception-analysis") as executor:
+                    analysis = executor.submit(copy_context().run, analyze)
+                    self._pending_miscon(misconception_container, 'Misconception Insights')
+                    # Below the panel, so notes about the analysis don't land in the chat message being streamed.
+                    analysis_note = st.empty()
+                    shown = False
+
+                    def show_analysis():
+                        # Streamlit elements are only updated from this (the script's) thread.
+                        try:
+                            pred_p = analysis.result()
+                        except Exception as e:
+                            analysis_note.error(f"An error occurred in the misconception analysis: {e}")
+                            return
+                        self._update_miscon(misconception_container, pred_p, 'Misconception Insights')
+                        if getattr(pred_p, 'truncated', False):
+                            analysis_note.caption(f"Analysis stopped after {pred_p.rounds_completed} of {pred_p.rounds} rounds to answer within {self.timeout}s.")
+
+                    def chunks(stream):
+                        nonlocal shown
+                        for chunk in stream:
+                            if not shown and analysis.done():
+                                shown = True
+                                show_analysis()
+                            yield chunk
+
+                    try:
+                        # Chat functionality
+                        history = st.session_state.chat_history
+
                         with st.chat_message("user"):
                             st.markdown(full_question)
-                        
+
                         with st.chat_message("assistant"):
                             stream = self.client.chat.completions.create(
                                 model=st.session_state["openai_model"],
-                                messages=[
-                                    {"role": m["role"], "content": m["content"]}
-                                    for m in st.session_state.messages
-                                ],
+                                messages=history.messages(full_question),
                                 stream=True,
                             )
-                            response = st.write_stream(stream)
-                        
-                        st.session_state.messages.append({"role": "assistant", "content": response})
+                            response = st.write_stream(chunks(stream))
+
+                        history.add_turn(full_question, response)
+
+                    except Exception as e:
+                        st.error(f"An error occurred: {e}")
 
-                except Exception as e:
-                    st.error(f"An error occurred: {e}")
+                    if not shown:
+                        show_analysis()
             else:
                 st.warning("🚨 Please input a question!")
 
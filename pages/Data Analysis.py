@@ -1,93 +1,86 @@
+import os
+import sys
+
 import streamlit as st
 import pandas as pd
-import numpy as np
 import plotly.express as px
-import plotly.graph_objs as go
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from metrics import DEFAULT_METRICS_PATH, get_store, merge_percentiles
+
 # Set page configuration
-st.set_page_config(page_title='AI Model Performance Dashboard', layout='wide')
-
-# Create sample performance data
-np.random.seed(42)
-models = ['Claude 3 Opus', 'GPT-4', 'Gemini Pro', 'Claude Haiku', 'PaLM 2']
-tasks = ['Coding', 'Math', 'Creative Writing', 'Reasoning', 'Translation']
-
-# Generate synthetic performance data
-performance_data = pd.DataFrame({
-    'Model': np.repeat(models, len(tasks)),
-    'Task': tasks * len(models),
-    'Performance Score': np.random.uniform(70, 95, len(models) * len(tasks)),
-    'Inference Speed (tokens/sec)': np.random.uniform(20, 100, len(models) * len(tasks)),
-    'Cost per 1M Tokens': np.random.uniform(5, 50, len(models) * len(tasks))
-})
+st.set_page_config(page_title='Agent Performance Dashboard', layout='wide')
 
 # Title
-st.title('🤖 AI Model Performance Comparison Dashboard')
+st.title('🤖 Agent Performance Dashboard')
+
+if not os.path.exists(DEFAULT_METRICS_PATH):
+    st.info('No LM calls recorded yet. Run the quiz or the chat playground to collect metrics.')
+    st.stop()
+
+store = get_store(DEFAULT_METRICS_PATH)
+rollups = pd.DataFrame(store.rollups())
+if rollups.empty:
+    st.info('No LM calls recorded yet. Run the quiz or the chat playground to collect metrics.')
+    st.stop()
+
+rollups['mode'] = rollups['mode'].replace('', 'standalone')
+rollups['agent'] = rollups['agent'].replace('', 'unknown')
+rollups['tokens'] = rollups['prompt_tokens'] + rollups['completion_tokens']
 
-# Layout with three columns
-col1, col2, col3 = st.columns(3)
+# Rollups are per (mode, agent, model); percentiles don't add up, so per-mode latency is read from the summed histograms.
+by_mode = rollups.groupby('mode').agg(
+    calls=('calls', 'sum'), errors=('errors', 'sum'), cache_hits=('cache_hits', 'sum'),
+    prompt_tokens=('prompt_tokens', 'sum'), completion_tokens=('completion_tokens', 'sum'),
+    cost=('cost', 'sum'), latency_sum=('latency_sum', 'sum'))
+by_mode = by_mode.join(rollups.groupby('mode')['latency_hist'].apply(merge_percentiles).unstack())
+by_mode['mean_ms'] = by_mode['latency_sum'] / by_mode['calls']
+by_mode['cache_hit_rate'] = by_mode['cache_hits'] / by_mode['calls']
+by_mode = by_mode.drop(columns='latency_sum').reset_index()
 
-# Line Chart: Performance Scores Across Tasks
+# Headline numbers
+col1, col2, col3, col4 = st.columns(4)
+col1.metric('LM calls', f"{int(by_mode['calls'].sum()):,}")
+col2.metric('Tokens', f"{int(rollups['tokens'].sum()):,}")
+col3.metric('Cost (USD)', f"${by_mode['cost'].sum():.4f}")
+col4.metric('Cache hit rate', f"{by_mode['cache_hits'].sum() / by_mode['calls'].sum():.1%}")
+
+st.header('Per ExchangeOfThought mode')
+st.dataframe(by_mode, use_container_width=True)
+
+col1, col2 = st.columns(2)
+
+# Latency percentiles per mode
 with col1:
-    st.header('Performance Scores')
-    fig_line = px.line(performance_data, x='Task', y='Performance Score', color='Model', 
-                       title='Model Performance by Task')
-    st.plotly_chart(fig_line, use_container_width=True)
+    latency = by_mode.melt(id_vars='mode', value_vars=['p50_ms', 'p90_ms', 'p99_ms'],
+                           var_name='percentile', value_name='latency (ms)')
+    fig_latency = px.bar(latency, x='mode', y='latency (ms)', color='percentile', barmode='group',
+                         title='LM call latency percentiles by mode')
+    st.plotly_chart(fig_latency, use_container_width=True)
 
-# Pie Chart: Overall Performance Distribution
+# Token cost per mode
 with col2:
-    st.header('Performance Distribution')
-    model_avg_performance = performance_data.groupby('Model')['Performance Score'].mean()
-    fig_pie = px.pie(values=model_avg_performance, names=model_avg_performance.index, 
-                     title='Average Performance Share')
-    st.plotly_chart(fig_pie, use_container_width=True)
-
-# Box Plot: Performance Variability
-with col3:
-    st.header('Performance Variability')
-    fig_box = go.Figure(data=[
-        go.Box(name=model, y=performance_data[performance_data['Model'] == model]['Performance Score'])
-        for model in models
-    ])
-    fig_box.update_layout(title='Performance Score Distribution')
-    st.plotly_chart(fig_box, use_container_width=True)
-
-# Heatmap: Performance and Speed Correlation
-st.header('Performance vs Inference Speed Heatmap')
-performance_speed = performance_data.pivot_table(
-    index='Model', 
-    columns='Task', 
-    values='Inference Speed (tokens/sec)'
-)
+    fig_cost = px.bar(by_mode, x='mode', y='cost', title='Token cost (USD) by mode')
+    st.plotly_chart(fig_cost, use_container_width=True)
+
+# Tokens per agent
+st.header('Tokens by agent')
+fig_tokens = px.bar(rollups, x='agent', y=['prompt_tokens', 'completion_tokens'], facet_col='mode',
+                    title='Prompt and completion tokens by agent')
+st.plotly_chart(fig_tokens, use_container_width=True)
 
+# Heatmap: p90 latency per mode and agent
+st.header('p90 latency (ms) by mode and agent')
+p90 = rollups.groupby(['agent', 'mode'])['latency_hist'].apply(lambda hists: merge_percentiles(hists)['p90_ms']).unstack()
 fig, ax = plt.subplots(figsize=(10, 6))
-sns.heatmap(performance_speed, annot=True, cmap='YlGnBu', ax=ax)
+sns.heatmap(p90, annot=True, fmt='.0f', cmap='YlGnBu', ax=ax)
 st.pyplot(fig)
 
-# Scatter Plot: Performance vs Cost
-st.header('Performance vs Cost Analysis')
-fig_scatter = px.scatter(performance_data, 
-    x='Cost per 1M Tokens', 
-    y='Performance Score', 
-    color='Model',
-    size='Inference Speed (tokens/sec)',
-    title='Performance, Cost, and Speed Relationship')
-st.plotly_chart(fig_scatter, use_container_width=True)
-
-# Radar Chart: Multidimensional Performance
-st.header('Multidimensional Performance Radar')
-tasks_radar = ['Coding', 'Math', 'Creative Writing', 'Reasoning', 'Translation']
-claude_scores = performance_data[performance_data['Model'] == 'Claude 3 Opus'].groupby('Task')['Performance Score'].mean()
-
-fig_radar = go.Figure(data=go.Scatterpolar(
-    r=claude_scores.values,
-    theta=tasks_radar,
-    fill='toself'
-))
-fig_radar.update_layout(title='Claude 3 Opus Performance Across Tasks')
-st.plotly_chart(fig_radar, use_container_width=True)
+# Most recent calls
+st.header('Recent calls')
+st.dataframe(pd.DataFrame(store.calls(limit=200)), use_container_width=True)
 
 # Footer
-st.markdown('*Note: Data is synthetically generated for illustrative purposes*')
\ No newline at end of file
+st.markdown(f'*Note: Data is read from `{DEFAULT_METRICS_PATH}`; latency percentiles are bucketed (±10%).*')
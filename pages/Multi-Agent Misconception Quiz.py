@@ -2,20 +2,20 @@ import os
 import certifi
 os.environ['SSL_CERT_FILE'] = certifi.where()
 
-import dspy
 import sys
 import re
 import pdb
+from dataclasses import replace
 
 import streamlit as st
-import pandas as pd
 
 from openai import OpenAI
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
-from predict_model import ExchangeOfThought
-from config import configure_dspy
-from agents import AdvancedAgent
+from program_config import APP_PROGRAM
+from resilience import AgentError, LMError
+from question_store import load_question_store
+from materialize import load_materialized_predictions
 
 # initialize
 OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
@@ -27,8 +27,6 @@ if not OPENAI_API_KEY:
     raise EnvironmentError(
         "OPENAI_API_KEY not found in environment variables.")
 os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
-lm = dspy.LM('openai/gpt-3.5-turbo')
-dspy.configure(lm=lm)
 
 class QuizApp:
     def __init__(self, q_data_path='./data/train.csv', mis_data_path='./data/misconception_mapping.csv'):
@@ -105,26 +103,22 @@ class QuizApp:
         # Load custom CSS
         # self._load_custom_css()
 
-        self.round = 2
-        self.mode = "Report"
+        # The pages' program (src/program_config.py): Report mode, 2 rounds, routed models and the semantic cache.
+        # The kNN classifier (classifier=True) stays off: its calibrated threshold never lets it answer yet.
+        config = replace(APP_PROGRAM, q_data_path=q_data_path, mis_data_path=mis_data_path)
+        self.round = config.rounds
+        self.mode = config.mode
+        # Seconds an analysis may take; remaining rounds are skipped when time runs out.
+        self.timeout = config.timeout
 
-        configure_dspy(dspy)
-        # Set up Agents
-        agent_a = AdvancedAgent(name="Agent A", persona_promt=None)
-        agent_b = AdvancedAgent(name="Agent B", persona_promt=None)
-        agent_c = AdvancedAgent(name="Agent C", persona_promt=None)
-        agent_d = AdvancedAgent(name="Agent D", persona_promt=None)
-        agent_e = AdvancedAgent(name="Agent E", persona_promt=None)
+        lm = config.build_lm()
+        self.model = config.build(lm)
+        # Predictions precomputed by src/materialize.py for this exact configuration; misses run live.
+        tag = config.meta(lm)["tag"]
+        self.materialized = load_materialized_predictions('./data/predictions.sqlite3', tag)
 
-        # evaluate
-        self.model = ExchangeOfThought(
-            agent_a, agent_b, agent_c, agent_d, agent_e, rounds=self.round, mode=self.mode)
-        # self.model.load('./compiled_model.dspy')
-
-        # Load data
-        self.data = pd.read_csv(q_data_path)
-
-        self.mis_data = pd.read_csv(mis_data_path)
+        # Load data (columnar store built once from the CSVs, shared across reruns)
+        self.store = load_question_store(q_data_path, mis_data_path)
 
         # Initialize session state
         self._initialize_session_state()
@@ -145,45 +139,15 @@ class QuizApp:
         for key, value in default_values.items():
             st.session_state.setdefault(key, value)
 
-    @staticmethod
-    def _wrap_latex(text: str) -> str:
-        """Convert LaTeX delimiters to Markdown-friendly format."""
-        return text.replace("\\[", "$").replace("\\]", "$") \
-                   .replace("\\(", "$").replace("\\)", "$")
-
     def _get_current_question(self):
         """Retrieve the current question from the dataset."""
-        current_row = self.data.iloc[st.session_state.current_index + 1]
-        return {
-            'question_text': self._wrap_latex(current_row['QuestionText']),
-            'options': {
-                "A": self._wrap_latex(current_row['AnswerAText']),
-                "B": self._wrap_latex(current_row['AnswerBText']),
-                "C": self._wrap_latex(current_row['AnswerCText']),
-                "D": self._wrap_latex(current_row['AnswerDText'])
-            },
-            'correct_answer': current_row.get('CorrectAnswer', 'A'),
-            'construct_name': current_row['ConstructName'],
-            'subject_name': current_row['SubjectName'],
-            'misconceptions': {
-                "A": current_row.get('MisconceptionAId'),
-                "B": current_row.get('MisconceptionBId'),
-                "C": current_row.get('MisconceptionCId'),
-                "D": current_row.get('MisconceptionDId'),
-            }
-        }
+        return self.store.question(st.session_state.current_index + 1)
     
     def _get_current_misconception(self, index):
         misconceptions = {}
         for keys, value in index.items():
-            if pd.isna(value):
-                misconceptions[keys] = "There's no apparent misconception."
-            
-            try:
-                int_index = int(value)
-                misconceptions[keys] = self.mis_data.iloc[int_index]['MisconceptionName']
-            except (ValueError, TypeError):
-                misconceptions[keys] = "There's no apparent misconception."
+            name = self.store.misconception_name(value)
+            misconceptions[keys] = name if name is not None else "There's no apparent misconception."
 
         return misconceptions
 
@@ -401,11 +365,18 @@ class QuizApp:
         # Get answer from gpt and our model
 
         if st.session_state.answer_submitted:
-            pred = self.model(QuestionText=question['question_text'], 
-                    AnswerText=question['options'][st.session_state.selected_option], 
-                    CorrectAnswer=question['options'][question['correct_answer']], 
-                    ConstructName=question['construct_name'], 
-                    SubjectName=question['subject_name'])
+            try:
+                pred = self.materialized.get(question['question_id'], st.session_state.selected_option)
+                if pred is None:
+                    pred = self.model(QuestionText=question['question_text'], 
+                            AnswerText=question['options'][st.session_state.selected_option], 
+                            CorrectAnswer=question['options'][question['correct_answer']], 
+                            ConstructName=question['construct_name'], 
+                            SubjectName=question['subject_name'])
+            except (AgentError, LMError) as e:
+                st.error(f"The agents could not analyse this answer: {e}")
+                # Still show the panel and the Next/Restart buttons.
+                pred = "The agents could not analyse this answer; try again or move on to the next question."
             for option in ['A', 'B', 'C', 'D']:
                 self._update_miscon(misconception_container[option], misconception[option], option)
 
@@ -451,10 +422,10 @@ class QuizApp:
 
             col1, col2 = st.columns(2)
             with col1:
-                if st.session_state.current_index < len(self.data) - 1:
+                if st.session_state.current_index < len(self.store) - 1:
                     st.button("Next", on_click=self._next_question)
             with col2:
-                if st.session_state.current_index == len(self.data) - 1:
+                if st.session_state.current_index == len(self.store) - 1:
                     st.button("Restart Quiz", on_click=self._restart_quiz)
 
 
@@ -1,19 +1,15 @@
 from dataclasses import dataclass
 from typing import Tuple
 import dspy
-# import logging
+import logging
 import pdb
 
-from src.agents_component import MisAgent, FinAgent, SolveAgent_api
+from agents_component import MisAgent, FinAgent, SolveAgent_api
+from resilience import AgentError
+from tracing import record_exception
 
-# logging.basicConfig(
-#     level=logging.WARNING, 
-#     format='%(asctime)s - %(levelname)s - %(message)s', 
-#     handlers=[
-#         logging.FileHandler("agents.log"), 
-#         logging.StreamHandler()
-#     ]
-# )
+# Failures are recorded on the current trace span (see tracing.py) and raised as AgentError.
+logger = logging.getLogger(__name__)
 
 # Agents' data return format
 @dataclass
@@ -59,22 +55,25 @@ class Agent(dspy.Module):
 
             return outputs.completions[0].MisconceptionText
         except Exception as e:
-            print(e)
-            return "Failed to generate misconception explanation."
+            record_exception(e)
+            raise AgentError(self.name, e) from e
         
 # other architecture of agents (not in use)
 
 class AdvancedAgent(dspy.Module):
-    def __init__(self, name, persona_promt=None):
+    def __init__(self, name, persona_promt=None, speculative_samples=1, reasoning_store=None):
         super().__init__()
         self.name = name
         self.prefix_promt = persona_promt
 
         # TODO Write the prompt
         # self.solve_agent = SolveAgent("solve_agent", tools)
-        self.solve_agent = SolveAgent_api("solve_agent")
-        self.mis_agent = MisAgent("mis_agent")
-        self.fin_agent = FinAgent("fin_agent")
+        # speculative_samples > 1 generates and judges that many reasonings concurrently.
+        # The solution of the question is persona independent, so it can come from a shared reasoning_store.
+        self.solve_agent = SolveAgent_api("solve_agent", speculative_samples=speculative_samples,
+                                          reasoning_store=reasoning_store)
+        self.mis_agent = MisAgent("mis_agent", persona_promt=persona_promt)
+        self.fin_agent = FinAgent("fin_agent", persona_promt=persona_promt)
 
     def forward(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=None) -> str:
         # Directly pass the inputs to the process method
@@ -88,7 +87,7 @@ class AdvancedAgent(dspy.Module):
                 CorrectAnswer=CorrectAnswer,
             )
 
-            # logging.warning(f"answer_reasoning: {answer_reasoning}")
+            logger.debug("answer_reasoning: %s", answer_reasoning)
 
             misconception_choice = self.mis_agent(
                 context=context,
@@ -100,7 +99,7 @@ class AdvancedAgent(dspy.Module):
                 CorrectReasoning=answer_reasoning,
             )
 
-            # logging.warning(f"misconception_choice: {misconception_choice}")
+            logger.debug("misconception_choice: %s", misconception_choice)
 
             misconception = self.fin_agent(
                 context=context,
@@ -116,8 +115,8 @@ class AdvancedAgent(dspy.Module):
             return misconception
     
         except Exception as e:
-            print(e)
-            return "Failed to generate misconception explanation."
+            record_exception(e)
+            raise AgentError(self.name, e) from e
         
 class RerankAgentSignature(dspy.Signature):
     """Pick out the most relavant misconception sentence."""
@@ -154,8 +153,8 @@ class RerankAgent(dspy.Module):
 
             return outputs.completions[0].MisconceptionText
         except Exception as e:
-            print(e)
-            return "Failed to pick out misconception sentence."
+            record_exception(e)
+            raise AgentError(self.name, e) from e
 
 # All code down below not used any more at the moment at least (it will be modified in the future)
 #########################################################################################################################
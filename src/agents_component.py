@@ -1,7 +1,7 @@
 
 # TODO
 # Implement tools 
-# import logging
+import logging
 import dspy
 from openai import OpenAI
 import os
@@ -10,23 +10,31 @@ import time
 import httpx
 import pdb
 import urllib3
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from typing import Literal
+
+from metrics import record_external_call
+from resilience import DEFAULT_TIMEOUT, AgentError, LMError, call_with_retry, get_limiter, remaining_time
+from tracing import SPAN_KIND_CLIENT, record_exception, span
+from safe_math import evaluate_text, solve_arithmetic
+from structured_output import coerce_literal
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# logging.basicConfig(
-#     level=logging.DEBUG,
-#     format='%(asctime)s - %(levelname)s - %(message)s'
-# )
+logger = logging.getLogger(__name__)
 
 class Calculator:
     def __init__(self):
         self.name = "Calculator"
     
     def __call__(self, QuestionText, CorrectAnswer):
-        try:
-            return {"result": str(eval(QuestionText))}
-        except Exception as e:
-            return {"error": str(e)}
+        # Only the LaTeX expressions of the question are evaluated, through a whitelisted AST (no eval).
+        evaluations = evaluate_text(QuestionText)
+        if not evaluations:
+            return {"error": "No expression in the question could be evaluated."}
+        return {"result": "; ".join(f"{e.expression} -> {e.value}" for e in evaluations)}
 
 class WebSearchTool:
     def __init__(self):
@@ -49,6 +57,27 @@ tools_basic = {
     "wikipediasearch": WikipediaSearchTool()
 }
 
+
+def match_tool(choice, tools):
+    """The tool named by a (possibly verbose) Choice; web search if none matches."""
+    key = coerce_literal(choice, list(tools))
+    if key is None:
+        logger.debug("Unrecognized tool choice %r, using web search", choice)
+        return tools.get("websearch", WebSearchTool())
+    return tools[key]
+
+
+def judge_passed(judge) -> bool:
+    """
+    Whether a Judge answer accepts the context. An answer that is neither yes nor no is taken as
+    acceptance: asking again would cost another round trip for the same context.
+    """
+    verdict = coerce_literal(judge, ("Yes", "No"))
+    if verdict is None:
+        logger.debug("Unrecognized judge answer %r, accepting", judge)
+    return verdict != "No"
+
+
 # This agent is use to solve the problem
 class SelectAgentSignature(dspy.Signature):
     """Choose only one tool from the provided options that is the most helpful in solving the problem."""
@@ -59,7 +88,7 @@ class SelectAgentSignature(dspy.Signature):
     ConstructName = dspy.InputField()
     SubjectName = dspy.InputField(desc="The subject of the question.")
     CorrectAnswer = dspy.InputField(desc="The correct answer.")
-    Choice = dspy.OutputField(desc="Only output the name of tool you select without explanation.")
+    Choice: Literal[tuple(tools_basic)] = dspy.OutputField(desc="Only output the name of tool you select without explanation.")
 
 class SolveAgentSignature(dspy.Signature):
     """Can I get the correct answer of this question based on the context I have? If so, output 'Yes" without any further explanation, if not, answer just answer "No" without any explanation """
@@ -69,7 +98,7 @@ class SolveAgentSignature(dspy.Signature):
     ConstructName = dspy.InputField()
     SubjectName = dspy.InputField(desc="The subject of the question.")
     CorrectAnswer = dspy.InputField(desc="The correct answer.")
-    Judge = dspy.OutputField(desc= "If you have sufficient infomation to answer the question, output 'Yes'. Else output 'No'. Only output 'Yes' or 'No' without any explanation") 
+    Judge: Literal["Yes", "No"] = dspy.OutputField(desc= "If you have sufficient infomation to answer the question, output 'Yes'. Else output 'No'. Only output 'Yes' or 'No' without any explanation") 
     
 
 class SummaryAgentSignature(dspy.Signature):
@@ -105,6 +134,11 @@ class SolveAgent(dspy.Module):
         return descriptions.get(tool.name, "General tool")
 
     def forward(self, QuestionText, ConstructName, SubjectName, CorrectAnswer, context=None) -> str:
+        # Pure arithmetic questions are verified and explained locally, without any LLM call.
+        local_solution = solve_arithmetic(QuestionText, CorrectAnswer)
+        if local_solution is not None:
+            return local_solution
+
         # Directly pass the inputs to the process method
         try:
             while(True):
@@ -125,7 +159,7 @@ class SolveAgent(dspy.Module):
                 )
 
                 # Add the selection to history
-                # logging.info(f"Selction is: {tool_selection}")
+                logger.debug("Selection is: %s", tool_selection)
 
                 if context:
                     context = str(context) +  f"\nTool selection: {tool_selection} \n"
@@ -133,11 +167,10 @@ class SolveAgent(dspy.Module):
                     context = f"\nTool selection: {tool_selection} \n"
 
                 # Call relavent tool
-                tool_selection = tool_selection.completions[0].Choice.lower()
-                matched_tool = self.tools.get(tool_selection, WebSearchTool())
+                matched_tool = match_tool(tool_selection.completions[0].Choice, self.tools)
                 thoughts = matched_tool(QuestionText, CorrectAnswer)
                 context += f"\nTool use result: {thoughts} \n"
-                # logging.info(f"Tool use result is: {thoughts}")
+                logger.debug("Tool use result is: %s", thoughts)
 
                 # Judge whether the infomation is enough
                 judge_pass = self.solve_agent(
@@ -149,10 +182,10 @@ class SolveAgent(dspy.Module):
                     prefix = self.prefix_promt
                 )
 
-                judge_pass = judge_pass.completions[0].Judge.lower()
-                if 'yes' in judge_pass:
+                judge_pass = judge_pass.completions[0].Judge
+                logger.debug("Current judge is: %s", judge_pass)
+                if judge_passed(judge_pass):
                     break
-                    # logging.debug(f"Current judge is: {judge_pass}")
 
             outputs = self.summery_agent(
                 context=context,
@@ -165,8 +198,8 @@ class SolveAgent(dspy.Module):
 
             return outputs.completions[0].Solution
         except Exception as e:
-            # print(e)
-            return "Failed to generate anwser explanation of the problem."
+            record_exception(e)
+            raise AgentError(self.name, e) from e
         
 MisagentPrompt = r"""
 Based on the provided correct answer, its reasoning process, and the incorrect answer obtained, identify the step where the error occurred, and determine the reason for the mistake.
@@ -258,7 +291,8 @@ class MisAgent(dspy.Module):
 
             return outputs.completions[0].MisconceptionText
         except Exception as e:
-            return "Failed to generate misconception explanation."
+            record_exception(e)
+            raise AgentError(self.name, e) from e
         
 # This agent is use to summarize the misconception
 class FinAgentSignature(dspy.Signature):
@@ -301,73 +335,185 @@ class FinAgent(dspy.Module):
             return outputs.completions[0].MisconceptionText
         
         except Exception as e:
-            # print(e)
-            return "Failed to generate misconception explanation."
+            record_exception(e)
+            raise AgentError(self.name, e) from e
         
+# Shared by every SolveAgent_api; sized for a few agents sampling concurrently.
+_speculation_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="speculative-reasoning")
+# Batches of samples drawn before the last rejected reasoning is used (or the last error raised).
+MAX_SPECULATIVE_BATCHES = 3
+
+
 class SolveAgent_api(dspy.Module):
+    """
+    Reasons with the DashScope math model and asks the judge whether the reasoning is enough.
 
-    def __init__(self, name, persona_promt=None, request_interval=1):
+    With `speculative_samples` > 1, that many reasonings are generated and judged concurrently and
+    the first accepted one is used; the others are abandoned. A rejected batch is followed by
+    another one, like the sequential loop, up to MAX_SPECULATIVE_BATCHES batches, so the reasoning
+    stage usually costs one round trip instead of one per rejected attempt.
+    """
+
+    def __init__(self, name, persona_promt=None, request_interval=1, speculative_samples=1, reasoning_store=None):
         super().__init__()
         self.name = name
         self.prefix_promt = persona_promt
+        # Unused: requests are paced by the shared "dashscope" limiter in resilience.py.
         self.request_interval = request_interval
+        self.speculative_samples = speculative_samples
+        # Optional reasoning_store.ReasoningStore: one solution per question, shared by every caller.
+        self.reasoning_store = reasoning_store
+        self._openai_client = None
 
         self.solve_agent = dspy.Predict(SolveAgentSignature)
         self.summery_agent = dspy.Predict(SummaryAgentSignature)
 
-    def get_reasoning(self, query, answer):
-
-        try:
-            # pdb.set_trace()
-            prompt = f"Please generate proper reasoning process of the question.\nQuestion:\n{query}\nCorrect Answer:{answer}. Your answer should be well-formatted, using 1. 2. 3. to list items sequentially."
-
-            http_client = httpx.Client(verify=False)
-
-            time.sleep(self.request_interval)
-            client = OpenAI(
+    def _client(self):
+        # Retries are done by resilience.call_with_retry, not by the OpenAI client.
+        if self._openai_client is None:
+            self._openai_client = OpenAI(
                 api_key=os.getenv("DASHSCOPE_API_KEY"),
                 base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-                http_client=http_client
+                http_client=httpx.Client(verify=False),
+                max_retries=0,
             )
-            completion = client.chat.completions.create(
-                model="qwen2-math-72b-instruct",
-                # model="qwen-math-plus",
-                messages=[
-                    {'role': 'system', 'content': 'You are a helpful assistant that giit.'},
-                    {'role': 'user', 'content': prompt}]
-                )
-            # print(completion.model_dump_json())
-            return completion.choices[0].message.content
-        
-        except Exception as e:
-            print(e)
-            # pdb.set_trace()
+        return self._openai_client
+
+    def _request_reasoning(self, prompt):
+        model = "dashscope/qwen2-math-72b-instruct"
+        with span(f"lm {model}", SPAN_KIND_CLIENT, **{"gen_ai.request.model": model}) as current:
+            start = time.perf_counter()
+            try:
+                raw = self._client().chat.completions.with_raw_response.create(
+                    # call_with_retry runs this under the request's deadline; past it the request is abandoned.
+                    timeout=max(remaining_time() or DEFAULT_TIMEOUT, 1.0),
+                    model="qwen2-math-72b-instruct",
+                    # model="qwen-math-plus",
+                    messages=[
+                        {'role': 'system', 'content': 'You are a helpful assistant that giit.'},
+                        {'role': 'user', 'content': prompt}]
+                    )
+            except Exception as e:
+                record_external_call((time.perf_counter() - start) * 1000, model=model, error=repr(e))
+                raise
+            get_limiter("dashscope").update_from_headers(raw.headers)
+            completion = raw.parse()
+            usage = completion.usage
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            record_external_call((time.perf_counter() - start) * 1000, prompt_tokens, completion_tokens, model=model)
+            if current is not None:
+                current.set_attribute("gen_ai.usage.input_tokens", prompt_tokens)
+                current.set_attribute("gen_ai.usage.output_tokens", completion_tokens)
+        # print(completion.model_dump_json())
+        return completion.choices[0].message.content
+
+    def get_reasoning(self, query, answer):
+        prompt = f"Please generate proper reasoning process of the question.\nQuestion:\n{query}\nCorrect Answer:{answer}. Your answer should be well-formatted, using 1. 2. 3. to list items sequentially."
+        try:
+            # Pacing and retries are shared with every other DashScope caller through the provider limiter.
+            return call_with_retry(lambda: self._request_reasoning(prompt), "dashscope", tokens=len(prompt) // 4 + 1024)
+        except LMError as e:
+            logger.warning("%s: reasoning request failed: %r", self.name, e)
+            record_exception(e)
+            raise
+
+    def _judge(self, context, QuestionText, ConstructName, SubjectName, CorrectAnswer) -> bool:
+        judge_pass = self.solve_agent(
+            context=context,
+            QuestionText=QuestionText,
+            ConstructName=ConstructName,
+            SubjectName=SubjectName,
+            CorrectAnswer=CorrectAnswer,
+            prefix = self.prefix_promt
+        )
+        return judge_passed(judge_pass.completions[0].Judge)
+
+    def _sample(self, stop, context, QuestionText, ConstructName, SubjectName, CorrectAnswer):
+        """One speculative sample: (context with the reasoning, accepted), or None once `stop` is set."""
+        if stop.is_set():
+            return None
+        thoughts = self.get_reasoning(QuestionText, CorrectAnswer)
+        context = f"{context or ''}\nReasoning result: {thoughts} \n"
+        if stop.is_set():
+            return None
+        return context, self._judge(context, QuestionText, ConstructName, SubjectName, CorrectAnswer)
+
+    def _speculative_reasoning(self, context, QuestionText, ConstructName, SubjectName, CorrectAnswer) -> str:
+        """
+        Context extended with the first accepted reasoning of a batch of concurrent samples, or with
+        the last rejected one after MAX_SPECULATIVE_BATCHES batches.
+        """
+        # dspy.context() overrides are thread-local; the copied contextvars carry metrics, tracing and the deadline.
+        settings = {key: dspy.settings.get(key) for key in ("lm", "adapter", "callbacks")}
+
+        def run(stop):
+            with dspy.context(**settings):
+                return self._sample(stop, context, QuestionText, ConstructName, SubjectName, CorrectAnswer)
+
+        rejected = None
+        for batch in range(1, MAX_SPECULATIVE_BATCHES + 1):
+            stop = threading.Event()
+            pending = {_speculation_executor.submit(copy_context().run, run, stop)
+                       for _ in range(self.speculative_samples)}
+            errors = []
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            errors.append(e)
+                            continue
+                        if result is not None and result[1]:
+                            return result[0]
+                        if result is not None:
+                            rejected = result[0]
+            finally:
+                # Queued samples are dropped; running ones skip their judge call or are discarded.
+                stop.set()
+                for future in pending:
+                    future.cancel()
+            if len(errors) == self.speculative_samples:
+                raise errors[0]
+            logger.debug("%s: no speculative reasoning accepted in batch %d, sampling again", self.name, batch)
+        # Every batch had a rejected sample (a batch of errors alone raises); more batches would keep
+        # paying for samples until the deadline.
+        logger.warning("%s: no reasoning accepted in %d batches; using the last one", self.name, MAX_SPECULATIVE_BATCHES)
+        return rejected
 
     def forward(self, QuestionText, ConstructName, SubjectName, CorrectAnswer, context=None) -> str:
+        # Pure arithmetic questions are verified and explained locally, without any LLM call.
+        local_solution = solve_arithmetic(QuestionText, CorrectAnswer)
+        if local_solution is not None:
+            return local_solution
+
+        # The judge and the summary read the context and the persona, so both are part of the key;
+        # the wrong option isn't an input, so a stored solution serves every option of the question.
+        if self.reasoning_store is not None:
+            return self.reasoning_store.get_or_compute(QuestionText, CorrectAnswer, lambda: self._solve(
+                QuestionText, ConstructName, SubjectName, CorrectAnswer, context), context, self.prefix_promt)
+        return self._solve(QuestionText, ConstructName, SubjectName, CorrectAnswer, context)
+
+    def _solve(self, QuestionText, ConstructName, SubjectName, CorrectAnswer, context=None) -> str:
         # Directly pass the inputs to the process method
         # try:
-        while(True):
-            
-            thoughts = self.get_reasoning(QuestionText, CorrectAnswer)
+        if self.speculative_samples > 1:
+            context = self._speculative_reasoning(context, QuestionText, ConstructName, SubjectName, CorrectAnswer)
+        else:
+            while(True):
 
-            if context:
-                context += f"\Reasoning result: {thoughts} \n"
-            else:
-                context = f"\Reasoning result: {thoughts} \n"
+                thoughts = self.get_reasoning(QuestionText, CorrectAnswer)
 
-            # Judge whether the infomation is enough
-            judge_pass = self.solve_agent(
-                context=context,
-                QuestionText=QuestionText,
-                ConstructName=ConstructName,
-                SubjectName=SubjectName,
-                CorrectAnswer=CorrectAnswer,
-                prefix = self.prefix_promt
-            )
+                if context:
+                    context += f"\nReasoning result: {thoughts} \n"
+                else:
+                    context = f"\nReasoning result: {thoughts} \n"
 
-            judge_pass = judge_pass.completions[0].Judge.lower()
-            if 'yes' in judge_pass:
-                break
+                # Judge whether the infomation is enough
+                if self._judge(context, QuestionText, ConstructName, SubjectName, CorrectAnswer):
+                    break
 
         outputs = self.summery_agent(
             context=context,
@@ -0,0 +1,227 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from evaluation import DEFAULT_K, answer_keys
+from program_config import ProgramConfig
+from sweep import PERSONA_SETS, SWEEP_MODES, MisconceptionRanker, SweepConfig, use_shared_lm_cache
+from work_queue import Heartbeat, QueueServer, default_worker_id, open_queue
+
+#########################################################################################################################
+# Multi-machine batch scoring of ExchangeOfThought
+#
+# One (QuestionId, wrong option) is one task of a shared work queue (work_queue.py):
+#   coordinate: shard a dataset (train.csv or test.csv) into tasks, with the configuration to run;
+#   serve:      on the machine holding the queue file, serve it over HTTP to workers on other hosts
+#               (the file itself has to stay on a local disk: SQLite's locks aren't reliable on
+#               network shares);
+#   work:       lease tasks, keep the leases alive with heartbeats and store the predicted
+#               misconception text. Run as many workers as there are API keys and machines, each
+#               with its own key (--api-key-env), pointing at the queue file on the coordinator and
+#               at its URL everywhere else;
+#   merge:      rank the predictions against the misconception names and write one submission in
+#               the sample_submission.csv format (works on partial results too).
+#
+#   python src/batch_score.py coordinate --queue ./cache/test.queue --data data/test.csv --mode Report --rounds 2
+#   QUEUE_TOKEN=... python src/batch_score.py serve --queue ./cache/test.queue --port 8765
+#   QUEUE_TOKEN=... python src/batch_score.py work --queue http://coordinator:8765 --threads 4 --api-key-env LAMBDA_API_KEY_2
+#   python src/batch_score.py merge --queue ./cache/test.queue --data data/test.csv --out submission.csv
+
+logger = logging.getLogger(__name__)
+
+OPTIONS = ("A", "B", "C", "D")
+
+
+def shard(data_path: str, config: ProgramConfig) -> List[Tuple[int, dict]]:
+    """(key, payload) of every (question, wrong option) of a dataset, with the program every worker builds."""
+    data = pd.read_csv(data_path)
+    tasks = []
+    for row in data.itertuples(index=False):
+        for i, option in enumerate(OPTIONS):
+            if option == row.CorrectAnswer:
+                continue
+            tasks.append((int(answer_keys(row.QuestionId, i)), {
+                "config": config.to_json(),
+                "QuestionText": row.QuestionText, "AnswerText": getattr(row, f"Answer{option}Text"),
+                "ConstructName": row.ConstructName, "SubjectName": row.SubjectName,
+                "CorrectAnswer": getattr(row, f"Answer{row.CorrectAnswer}Text"),
+            }))
+    return tasks
+
+
+class DegradedPrediction(RuntimeError):
+    """The exchange ran out of time or lost an agent; its result is not stored."""
+
+
+class Worker:
+    def __init__(self, queue, threads: int = 4, lease_s: float = 120.0, poll_s: float = 5.0):
+        self.queue = queue
+        self.threads = threads
+        self.lease_s = lease_s
+        self.poll_s = poll_s
+        self.worker_id = default_worker_id()
+        # Programs by the ProgramConfig JSON of the tasks: workers run what the coordinator queued.
+        self._programs: Dict[str, object] = {}
+        self._programs_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+
+    def _program(self, config: str):
+        with self._programs_lock:
+            if config not in self._programs:
+                self._programs[config] = ProgramConfig.from_json(config).build()
+            return self._programs[config]
+
+    def _score(self, task) -> str:
+        payload = dict(task.payload)
+        prediction = self._program(payload.pop("config"))(**payload)
+        # Like materialized predictions and the semantic cache, degraded exchanges are retried, not kept.
+        if getattr(prediction, "truncated", False):
+            raise DegradedPrediction(f"stopped after {prediction.rounds_completed} of {prediction.rounds} rounds")
+        if getattr(prediction, "failed_agents", ()):
+            raise DegradedPrediction(f"{', '.join(prediction.failed_agents)} failed")
+        return str(prediction)
+
+    def run(self):
+        """Work until the queue has neither pending nor leased tasks."""
+        with Heartbeat(self.queue, self.worker_id, self.lease_s) as heartbeat, \
+                ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="score") as executor:
+            running = {}
+            while True:
+                free = self.threads - len(running)
+                if free:
+                    for task in self.queue.lease(self.worker_id, free, self.lease_s):
+                        heartbeat.hold(task.key)
+                        running[executor.submit(self._score, task)] = task
+                if not running:
+                    if self.queue.finished():
+                        break
+                    # Other workers hold the remaining leases; they come back if those workers die.
+                    time.sleep(self.poll_s)
+                    continue
+                finished, _ = wait(running, timeout=self.poll_s, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    try:
+                        self.queue.complete(task.key, self.worker_id, future.result())
+                        self.completed += 1
+                    except Exception as e:
+                        logger.warning("Task %d failed (attempt %d): %r", task.key, task.attempts, e)
+                        self.queue.fail(task.key, self.worker_id, repr(e))
+                        self.failed += 1
+                    heartbeat.release(task.key)
+                if finished:
+                    logger.info("%s: %d completed, %d failed; queue %s", self.worker_id, self.completed, self.failed,
+                                self.queue.counts())
+
+
+def merge(queue, data_path: str, out_path: str, ranker: MisconceptionRanker = None, k: int = DEFAULT_K) -> Dict[str, int]:
+    """Write the submission; wrong options without a prediction are ranked from their construct and answer text."""
+    ranker = ranker or MisconceptionRanker()
+    results = queue.results()
+    data = pd.read_csv(data_path)
+    keys, texts, subjects, constructs = [], [], [], []
+    predicted = 0
+    for row in data.itertuples(index=False):
+        for i, option in enumerate(OPTIONS):
+            if option == row.CorrectAnswer:
+                continue
+            key = int(answer_keys(row.QuestionId, i))
+            predicted += key in results
+            keys.append(f"{row.QuestionId}_{option}")
+            texts.append(results.get(key) or f"{row.ConstructName} {getattr(row, f'Answer{option}Text')}")
+            subjects.append(row.SubjectName)
+            constructs.append(row.ConstructName)
+    ranked = ranker.rank(texts, k, subjects=subjects, constructs=constructs) if texts else np.zeros((0, k), dtype=np.int64)
+    with open(out_path, "w") as f:
+        f.write("QuestionId_Answer,MisconceptionId\n")
+        f.writelines(f"{key},{' '.join(str(i) for i in row if i >= 0)}\n" for key, row in zip(keys, ranked.tolist()))
+    return {"rows": len(keys), "predicted": predicted, "queue": queue.counts()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score a dataset with ExchangeOfThought on several machines.")
+    parser.add_argument("--token-env", default="QUEUE_TOKEN",
+                        help="environment variable with the shared secret of the queue server and its clients")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    coordinate = commands.add_parser("coordinate", help="shard a dataset into the work queue")
+    coordinate.add_argument("--queue", required=True,
+                            help="queue database on a local disk (not a network share), or a queue server's URL")
+    coordinate.add_argument("--data", default="./data/test.csv")
+    coordinate.add_argument("--mode", default="Report", choices=SWEEP_MODES)
+    coordinate.add_argument("--rounds", type=int, default=2)
+    coordinate.add_argument("--personas", default="none", choices=list(PERSONA_SETS))
+    coordinate.add_argument("--router", action="store_true", help="route requests to cheap/strong models (routing.py)")
+    coordinate.add_argument("--timeout", type=float, default=None, help="seconds per task (default: no deadline)")
+    coordinate.add_argument("--reasoning-store", default="./cache/reasoning.sqlite3",
+                            help="reasoning store of each worker's machine (reasoning_store.py)")
+    coordinate.add_argument("--compiled", default="./compiled_model.dspy")
+    coordinate.add_argument("--retry-failed", action="store_true", help="requeue tasks that used up their attempts")
+
+    serve = commands.add_parser("serve", help="serve the queue file to workers on other hosts")
+    serve.add_argument("--queue", required=True)
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8765)
+
+    work = commands.add_parser("work", help="lease and score tasks until the queue is empty")
+    work.add_argument("--queue", required=True)
+    work.add_argument("--threads", type=int, default=4, help="tasks scored at the same time by this worker")
+    work.add_argument("--lease", type=float, default=300.0, help="seconds a lease lasts without a heartbeat")
+    work.add_argument("--api-key-env", default=None,
+                      help="environment variable with this worker's API key (used as LAMBDA_API_KEY/OPENAI_API_KEY)")
+    work.add_argument("--cache-dir", default="./cache/lm", help="LM response cache of this machine")
+
+    merge_parser = commands.add_parser("merge", help="write the submission from the results so far")
+    merge_parser.add_argument("--queue", required=True)
+    merge_parser.add_argument("--data", default="./data/test.csv")
+    merge_parser.add_argument("--out", default="./submission.csv")
+    merge_parser.add_argument("--cooccurrence", action="store_true", help="rank within subject/construct partitions")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    token = os.environ.get(args.token_env)
+    queue = open_queue(args.queue, token)
+
+    if args.command == "serve":
+        if token is None:
+            logger.warning("%s is not set: any client that can reach the port may use the queue", args.token_env)
+        server = QueueServer(queue, args.host, args.port, token)
+        print(f"Serving {args.queue} at {server.url}; queue: {queue.counts()}")
+        server.serve_forever()
+
+    elif args.command == "coordinate":
+        if args.retry_failed:
+            print(f"Requeued {queue.retry_failed()} failed tasks")
+        # Everything a prediction depends on travels with the task, so workers can't mix configurations.
+        config = ProgramConfig.from_sweep(
+            SweepConfig(args.mode, args.rounds, args.personas), lm="router" if args.router else "lambda",
+            max_tokens=1000 if args.router else 100, compiled_path=args.compiled or None, timeout=args.timeout,
+            reasoning_store_path=args.reasoning_store or None)
+        added = queue.enqueue(shard(args.data, config))
+        print(f"Queued {added} new tasks from {args.data}; queue: {queue.counts()}")
+
+    elif args.command == "work":
+        if args.api_key_env:
+            # Set before config.py creates the LM: each worker spends its own key's rate limit.
+            os.environ["LAMBDA_API_KEY"] = os.environ["OPENAI_API_KEY"] = os.environ[args.api_key_env]
+        use_shared_lm_cache(args.cache_dir)
+        worker = Worker(queue, args.threads, args.lease)
+        worker.run()
+        print(f"{worker.worker_id}: {worker.completed} tasks completed, {worker.failed} failed; queue: {queue.counts()}")
+
+    elif args.command == "merge":
+        ranker = None
+        if args.cooccurrence:
+            from cooccurrence import load_cooccurrence_index
+            ranker = MisconceptionRanker(cooccurrence=load_cooccurrence_index())
+        summary = merge(queue, args.data, args.out, ranker)
+        print(f"Wrote {args.out}: {summary['rows']} rows, {summary['predicted']} from predictions; "
+              f"queue: {summary['queue']}")
@@ -0,0 +1,120 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from util import estimate_tokens
+
+#########################################################################################################################
+# Bounded chat history for the Chat Playground
+#
+# Resending the whole conversation makes every turn slower and more expensive than the last. The
+# history keeps the last `keep_turns` (user, assistant) turns verbatim and folds older turns into a
+# rolling summary. Folding calls an LM, so it runs on a background thread after a turn is added
+# and never delays a reply; until it catches up, the turns it is still folding are sent verbatim
+# if they fit. The request (system prompt, summary, turns, new message) is kept under
+# `token_budget` by dropping the oldest turns first, so the cost of a turn stays constant however
+# long the session gets.
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = ("Summarize the conversation between a user and an assistant about math questions and "
+                  "misconceptions for the assistant's later reference. Keep the questions, answers and "
+                  "misconceptions that were discussed; use at most {words} words.")
+
+Message = Dict[str, str]
+
+# Shared by the histories of every session; a history submits at most one fold at a time.
+_summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chat-summary")
+
+
+def openai_summarizer(client, model: str = "gpt-3.5-turbo", max_tokens: int = 300) -> Callable[[str, List[Tuple[Message, Message]]], str]:
+    """summarize(summary, turns) with an OpenAI client: the previous summary extended with the turns."""
+    def summarize(summary: str, turns: List[Tuple[Message, Message]]) -> str:
+        transcript = "\n\n".join(f"{message['role']}: {message['content']}" for turn in turns for message in turn)
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT.format(words=max_tokens * 3 // 4)},
+                {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+            ],
+            max_tokens=max_tokens,
+        )
+        return response.choices[0].message.content.strip()
+    return summarize
+
+
+class ChatHistory:
+    def __init__(self, system_prompt: str, summarize: Callable[[str, List[Tuple[Message, Message]]], str],
+                 keep_turns: int = 4, token_budget: int = 2000):
+        """summarize(summary, turns): the summary extended with older turns, e.g. openai_summarizer(client)."""
+        self.system = {"role": "system", "content": system_prompt}
+        self.summarize = summarize
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        self.summary = ""
+        # Turns not folded into the summary yet, oldest first.
+        self.turns: List[Tuple[Message, Message]] = []
+        self._lock = threading.Lock()
+        self._folding = False
+        # Notified when the background fold stops.
+        self._idle = threading.Condition(self._lock)
+        self.stats = {"turns": 0, "folded": 0, "fold_errors": 0}
+
+    def add_turn(self, user: str, assistant: str):
+        """Record a finished turn; turns that left the window are folded into the summary in the background."""
+        with self._lock:
+            self.turns.append(({"role": "user", "content": user}, {"role": "assistant", "content": assistant}))
+            self.stats["turns"] += 1
+            if self._folding or len(self.turns) <= self.keep_turns:
+                return
+            self._folding = True
+        _summary_executor.submit(self._fold)
+
+    def _fold(self):
+        # Folds until only the window is left; turns added meanwhile are picked up by the same loop.
+        while True:
+            with self._lock:
+                old = self.turns[:len(self.turns) - self.keep_turns]
+                summary = self.summary
+                if not old:
+                    self._folding = False
+                    self._idle.notify_all()
+                    return
+            try:
+                summary = self.summarize(summary, old)
+            except Exception as e:
+                # The turns stay unfolded and are retried after the next turn.
+                logger.warning("Summarizing %d chat turns failed: %r", len(old), e)
+                with self._lock:
+                    self.stats["fold_errors"] += 1
+                    self._folding = False
+                    self._idle.notify_all()
+                return
+            with self._lock:
+                self.summary = summary
+                del self.turns[:len(old)]
+                self.stats["folded"] += len(old)
+
+    def messages(self, user: str) -> List[Message]:
+        """The request for a new user message: system prompt, summary and as many recent turns as the budget allows."""
+        head = [self.system]
+        with self._lock:
+            if self.summary:
+                head.append({"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"})
+            turns = list(self.turns)
+        new = {"role": "user", "content": user}
+        used = sum(estimate_tokens(message["content"]) for message in [*head, new])
+        kept = []
+        for turn in reversed(turns):
+            tokens = sum(estimate_tokens(message["content"]) for message in turn)
+            if used + tokens > self.token_budget:
+                break
+            kept.append(turn)
+            used += tokens
+        return head + [message for turn in reversed(kept) for message in turn] + [new]
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the background summary has caught up; False if it is still folding after `timeout`."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._folding, timeout)
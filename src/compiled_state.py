@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import pickle
+import threading
+from collections.abc import Sequence
+from typing import Dict, List, Optional
+
+import dspy
+
+#########################################################################################################################
+# Loading of compiled programs (compiled_model.dspy)
+#
+# The compiled file is a JSON dump of `dspy.Module.dump_state()`: one entry per predictor path
+# (e.g. "agent_a.process") holding its few-shot demos. It is parsed once per process, a pickled
+# copy of the parsed demos is kept next to it for warm starts, and the demos of a predictor are
+# only turned into `dspy.Example` objects the first time that predictor is actually called.
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".cache"
+# compiled_model.dspy was compiled against an older agent graph. Predictors of the current graph
+# (suffix of their path) and the compiled predictor whose demos they take, under the same agent:
+# the agent's own MisconceptionText predictor ("agent_a.process") becomes AdvancedAgent's final
+# answer, and its misconception reasoning step feeds MisAgent. Both demo sets are (question,
+# answer) -> MisconceptionText examples; fields the new signatures add are marked "not supplied".
+LEGACY_PREDICTOR_NAMES = (
+    ("fin_agent.process", "process"),
+    ("mis_agent.process", "reasoning_agent.process"),
+)
+_CACHE_VERSION = 1
+
+
+class LazyDemos(Sequence):
+    """Read-only demo list of one predictor, materialized on first access.
+
+    One instance exists per predictor path and process, so every agent that references the same
+    predictor shares the same `dspy.Example` objects (which also keeps the prompt cache of
+    `PrefixedChatAdapter` warm across agents).
+    """
+
+    def __init__(self, raw_demos: List[dict]):
+        self._raw_demos = raw_demos
+        self._demos: Optional[List[dspy.Example]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def materialized(self) -> bool:
+        return self._demos is not None
+
+    def _materialize(self) -> List[dspy.Example]:
+        if self._demos is None:
+            with self._lock:
+                if self._demos is None:
+                    self._demos = [dspy.Example(**demo) for demo in self._raw_demos]
+                    self._raw_demos = None
+        return self._demos
+
+    def __getitem__(self, index):
+        return self._materialize()[index]
+
+    def __iter__(self):
+        return iter(self._materialize())
+
+    def __len__(self):
+        if self._demos is None:
+            return len(self._raw_demos)
+        return len(self._demos)
+
+    def __repr__(self):
+        state = "materialized" if self.materialized else "lazy"
+        return f"LazyDemos({len(self)} demos, {state})"
+
+
+class CompiledState:
+    """Parsed compiled_model.dspy, shared by every program loaded in this process."""
+
+    _instances: Dict[str, "CompiledState"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str, raw_demos: Dict[str, List[dict]], stamp: tuple = None):
+        self.path = path
+        self._stamp = stamp
+        self._raw_demos = raw_demos
+        self._demos: Dict[str, LazyDemos] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, use_cache: bool = True) -> "CompiledState":
+        """Return the parsed state for `path`, parsing it at most once per file version."""
+        path = os.path.abspath(path)
+        stamp = _file_stamp(path)
+        with cls._instances_lock:
+            state = cls._instances.get(path)
+            if state is None or state._stamp != stamp:
+                raw_demos = _read_cache(path, stamp) if use_cache else None
+                if raw_demos is None:
+                    raw_demos = _parse(path)
+                    if use_cache:
+                        _write_cache(path, stamp, raw_demos)
+                state = cls(path, raw_demos, stamp)
+                cls._instances[path] = state
+        return state
+
+    def predictor_names(self) -> List[str]:
+        return list(self._raw_demos)
+
+    def demos(self, predictor_name: str) -> Optional[LazyDemos]:
+        """Shared demos of a predictor, or None if the compiled program has no such predictor."""
+        if predictor_name not in self._raw_demos:
+            return None
+        demos = self._demos.get(predictor_name)
+        if demos is None:
+            with self._lock:
+                demos = self._demos.get(predictor_name)
+                if demos is None:
+                    demos = self._demos[predictor_name] = LazyDemos(self._raw_demos[predictor_name])
+        return demos
+
+
+def compiled_names(predictor_name: str) -> List[str]:
+    """Names a predictor of the current graph may have in a compiled file, exact name first."""
+    names = [predictor_name]
+    for suffix, legacy_suffix in LEGACY_PREDICTOR_NAMES:
+        if predictor_name == suffix or predictor_name.endswith("." + suffix):
+            names.append(predictor_name[:len(predictor_name) - len(suffix)] + legacy_suffix)
+    return names
+
+
+def load_compiled_program(program: dspy.Module, path: str = "./compiled_model.dspy", use_cache: bool = True) -> List[str]:
+    """Attach the compiled demos to the matching predictors of `program`.
+
+    Unlike `program.load(path)`, predictors missing from the compiled file are left untouched and
+    the signatures of the program are kept as they are in the code. Predictors renamed since the
+    file was compiled are matched through LEGACY_PREDICTOR_NAMES. Returns the names of the
+    predictors that received demos; a warning is logged when none did.
+    """
+    state = CompiledState.load(path, use_cache=use_cache)
+    attached = []
+    for name, predictor in program.named_predictors():
+        for compiled_name in compiled_names(name):
+            demos = state.demos(compiled_name)
+            if demos is not None:
+                predictor.demos = demos
+                if len(demos):
+                    attached.append(name)
+                break
+    if not attached:
+        logger.warning("No demos of %s match a predictor of the program (compiled: %s; program: %s)", path,
+                       ", ".join(state.predictor_names()), ", ".join(name for name, _ in program.named_predictors()))
+    return attached
+
+
+def _file_stamp(path: str) -> tuple:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _cache_path(path: str) -> str:
+    return path + CACHE_SUFFIX
+
+
+def _parse(path: str) -> Dict[str, List[dict]]:
+    with open(path) as f:
+        state = json.load(f)
+    # Only the demos are needed at runtime; traces, train sets and signatures are dropped.
+    return {
+        name: predictor_state.get("demos", [])
+        for name, predictor_state in state.items()
+        if isinstance(predictor_state, dict) and "demos" in predictor_state
+    }
+
+
+def _read_cache(path: str, stamp: tuple) -> Optional[Dict[str, List[dict]]]:
+    try:
+        with open(_cache_path(path), "rb") as f:
+            version, cached_stamp, raw_demos = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        return None
+    if version != _CACHE_VERSION or tuple(cached_stamp) != stamp:
+        return None
+    return raw_demos
+
+
+def _write_cache(path: str, stamp: tuple, raw_demos: Dict[str, List[dict]]):
+    tmp_path = f"{_cache_path(path)}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump((_CACHE_VERSION, stamp, raw_demos), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, _cache_path(path))
+    except OSError:
+        # A read-only checkout just means every cold start parses the JSON.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -1,10 +1,32 @@
+from metrics import MetricsCallback
+from tracing import TracingCallback
 from util import LanguageModel, PrefixedChatAdapter
 
 API = 'lambda'  # or 'openai'
 MAX_TOKEN = 100
 
-lm_wrapper = LanguageModel(max_tokens=MAX_TOKEN, service=API)
+# Created on first use, so importing this module needs no API keys (see program_config.py).
+_lm_wrapper = None
 custom_adapter = PrefixedChatAdapter()
+# Records every LM call to ./metrics/calls.sqlite3 (see pages/Data Analysis.py).
+metrics_callback = MetricsCallback()
+# Writes one OTLP/JSON trace per ExchangeOfThought call to ./traces/traces.jsonl.
+tracing_callback = TracingCallback()
 
-def configure_dspy(dspy):
-    dspy.configure(lm=lm_wrapper.lm, adapter=custom_adapter)
\ No newline at end of file
+def get_lm_wrapper() -> LanguageModel:
+    global _lm_wrapper
+    if _lm_wrapper is None:
+        _lm_wrapper = LanguageModel(max_tokens=MAX_TOKEN, service=API)
+    return _lm_wrapper
+
+def __getattr__(name):
+    # `config.lm_wrapper` keeps working.
+    if name == "lm_wrapper":
+        return get_lm_wrapper()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def configure_dspy(dspy, demo_selector=None, lm=None):
+    # demo_selector: optional demo_selector.DemoSelector; None sends every stored demo.
+    # lm: defaults to lm_wrapper.lm; a routing.ModelRouter relies on metrics_callback for its context.
+    custom_adapter.demo_selector = demo_selector
+    dspy.configure(lm=lm or get_lm_wrapper().lm, adapter=custom_adapter, callbacks=[metrics_callback, tracing_callback])
@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+#########################################################################################################################
+# Subject/construct x misconception co-occurrence
+#
+# train.csv tells which misconceptions were actually observed for each SubjectName and
+# ConstructName. The counts are stored offline as one CSR matrix (subject rows, then construct
+# rows; one column per MisconceptionId) and serve two purposes at retrieval time:
+#   * a prior: smoothed P(misconception | subject, construct) added to similarity scores;
+#   * a partition: only misconceptions seen for the question's subject (or construct) are scored,
+#     instead of all ~2,587, with the global ranking as a fallback for unseen subjects.
+#
+#   python src/cooccurrence.py --train data/train.csv --misconceptions data/misconception_mapping.csv --out data/cooccurrence
+
+INDEX_VERSION = 1
+OPTIONS = ("A", "B", "C", "D")
+
+
+def _source_stamp(*paths) -> list:
+    return [[os.path.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths]
+
+
+def build_index(q_data_path: str, mis_data_path: str, out_dir: str):
+    """Count (SubjectName, MisconceptionId) and (ConstructName, MisconceptionId) pairs of train.csv into `out_dir`."""
+    os.makedirs(out_dir, exist_ok=True)
+    data = pd.read_csv(q_data_path)
+    n_misconceptions = int(pd.read_csv(mis_data_path)["MisconceptionId"].max()) + 1
+
+    labels = data.melt(id_vars=["SubjectName", "ConstructName"], value_vars=[f"Misconception{o}Id" for o in OPTIONS],
+                       value_name="MisconceptionId").dropna(subset=["MisconceptionId"])
+    misconception_ids = labels["MisconceptionId"].astype(np.int64).to_numpy()
+    subject_codes, subjects = pd.factorize(labels["SubjectName"].astype(str))
+    construct_codes, constructs = pd.factorize(labels["ConstructName"].astype(str))
+
+    rows = np.concatenate((subject_codes, len(subjects) + construct_codes))
+    columns = np.concatenate((misconception_ids, misconception_ids))
+    # Duplicate (row, column) pairs are summed into counts by the COO -> CSR conversion.
+    counts = sp.coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                           shape=(len(subjects) + len(constructs), n_misconceptions)).tocsr()
+    sp.save_npz(os.path.join(out_dir, "counts.npz"), counts)
+
+    # The meta file is written last: an index without it is incomplete and gets rebuilt.
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"version": INDEX_VERSION, "subjects": list(subjects), "constructs": list(constructs),
+                   "sources": _source_stamp(q_data_path, mis_data_path)}, f)
+
+
+class CooccurrenceIndex:
+    def __init__(self, index_dir: str):
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.counts: sp.csr_matrix = sp.load_npz(os.path.join(index_dir, "counts.npz")).tocsr()
+        self.subjects = {name: i for i, name in enumerate(self.meta["subjects"])}
+        self.constructs = {name: len(self.subjects) + i for i, name in enumerate(self.meta["constructs"])}
+        # Marginal P(misconception) over all subjects, the smoothing target of the prior.
+        totals = np.asarray(self.counts[:len(self.subjects)].sum(axis=0)).ravel()
+        self._background = (totals + 1) / (totals.sum() + len(totals))
+
+    @classmethod
+    def open_or_build(cls, q_data_path: str = "./data/train.csv", mis_data_path: str = "./data/misconception_mapping.csv",
+                      index_dir: str = "./data/cooccurrence") -> "CooccurrenceIndex":
+        """Open the index, (re)building it first if it is missing or older than the CSVs."""
+        try:
+            with open(os.path.join(index_dir, "meta.json")) as f:
+                meta = json.load(f)
+            fresh = meta.get("version") == INDEX_VERSION and meta.get("sources") == _source_stamp(q_data_path, mis_data_path)
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            build_index(q_data_path, mis_data_path, index_dir)
+        return cls(index_dir)
+
+    @property
+    def n_misconceptions(self) -> int:
+        return self.counts.shape[1]
+
+    def _rows(self, subject_name: Optional[str], construct_name: Optional[str]) -> list:
+        rows = []
+        if subject_name in self.subjects:
+            rows.append(self.subjects[subject_name])
+        if construct_name in self.constructs:
+            rows.append(self.constructs[construct_name])
+        return rows
+
+    def candidates(self, subject_name: Optional[str] = None, construct_name: Optional[str] = None) -> Optional[np.ndarray]:
+        """MisconceptionIds observed with the subject or construct; None if neither is known (search everything)."""
+        rows = self._rows(subject_name, construct_name)
+        if not rows:
+            return None
+        return np.unique(self.counts[rows].indices)
+
+    def prior(self, subject_name: Optional[str] = None, construct_name: Optional[str] = None,
+              strength: float = 5.0) -> np.ndarray:
+        """
+        log P(misconception | subject, construct) over all MisconceptionIds: the observed counts
+        smoothed towards the global frequencies with `strength` pseudo-observations.
+        """
+        rows = self._rows(subject_name, construct_name)
+        observed = np.asarray(self.counts[rows].sum(axis=0)).ravel() if rows else np.zeros(self.n_misconceptions)
+        return np.log((observed + strength * self._background) / (observed.sum() + strength))
+
+    def partition_sizes(self) -> pd.Series:
+        """Number of candidate misconceptions per SubjectName."""
+        subject_rows = self.counts[:len(self.subjects)]
+        return pd.Series(np.diff(subject_rows.indptr), index=self.meta["subjects"], name="candidates")
+
+
+@lru_cache(maxsize=4)
+def load_cooccurrence_index(q_data_path: str = "./data/train.csv", mis_data_path: str = "./data/misconception_mapping.csv",
+                            index_dir: str = "./data/cooccurrence") -> CooccurrenceIndex:
+    return CooccurrenceIndex.open_or_build(q_data_path, mis_data_path, index_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the subject/construct x misconception co-occurrence index.")
+    parser.add_argument("--train", default="./data/train.csv")
+    parser.add_argument("--misconceptions", default="./data/misconception_mapping.csv")
+    parser.add_argument("--out", default="./data/cooccurrence")
+    args = parser.parse_args()
+    build_index(args.train, args.misconceptions, args.out)
+    sizes = CooccurrenceIndex(args.out).partition_sizes()
+    print(f"Built co-occurrence index for {len(sizes)} subjects in {args.out}; "
+          f"candidates per subject: median {sizes.median():.0f}, max {sizes.max()} "
+          f"(of {CooccurrenceIndex(args.out).n_misconceptions} misconceptions)")
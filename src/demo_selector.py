@@ -0,0 +1,197 @@
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+import re
+
+import dspy
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from util import estimate_tokens
+
+#########################################################################################################################
+# Retrieval-based few-shot demo selection
+#
+# Instead of sending every stored demo of a predictor, the selector indexes the compiled demos and
+# the labelled (question, wrong answer) pairs of train.csv and sends only the k demos most similar
+# to the current query that fit in a token budget. Demos of the query's own question are never
+# sent: the quiz asks train.csv questions, whose labels would otherwise leak into the prompt.
+
+# Fields used to describe both a query and a demo for similarity search.
+QUERY_FIELDS = ("SubjectName", "ConstructName", "QuestionText", "AnswerText")
+# Bookkeeping fields of train demos that never reach the prompt.
+_LABEL_FIELDS = ("MisconceptionId", "QuestionId", "Option")
+
+
+def example_text(values) -> str:
+    return "\n".join(str(values[k]) for k in QUERY_FIELDS if k in values and values[k] is not None)
+
+
+_LATEX_DELIMITERS = re.compile(r"\\[()\[\]]|\$")
+
+
+def question_key(text) -> str:
+    """QuestionText with LaTeX delimiters and whitespace normalized; the pages show it with $ delimiters."""
+    return " ".join(_LATEX_DELIMITERS.sub(" ", str(text)).split())
+
+
+def load_train_demos(q_data_path: str = "./data/train.csv", mis_data_path: str = "./data/misconception_mapping.csv") -> List[dspy.Example]:
+    """One demo per (question, wrong option) of train.csv that has a labelled misconception."""
+    data = pd.read_csv(q_data_path)
+    mis_data = pd.read_csv(mis_data_path)
+    misconception_names = dict(zip(mis_data["MisconceptionId"], mis_data["MisconceptionName"]))
+
+    demos = []
+    for row in data.itertuples(index=False):
+        correct_answer = getattr(row, f"Answer{row.CorrectAnswer}Text")
+        for option in "ABCD":
+            misconception_id = getattr(row, f"Misconception{option}Id")
+            if option == row.CorrectAnswer or pd.isna(misconception_id):
+                continue
+            demos.append(dspy.Example(
+                QuestionId=int(row.QuestionId),
+                Option=option,
+                QuestionText=row.QuestionText,
+                AnswerText=getattr(row, f"Answer{option}Text"),
+                ConstructName=row.ConstructName,
+                SubjectName=row.SubjectName,
+                CorrectAnswer=correct_answer,
+                MisconceptionText=misconception_names.get(int(misconception_id), ""),
+                MisconceptionId=int(misconception_id),
+            ))
+    return demos
+
+
+class TfidfEmbedder:
+    """Sparse TF-IDF vectors as a CPU-only embedding; rows are L2 normalized."""
+
+    def __init__(self, corpus: List[str]):
+        self.vectorizer = TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), min_df=1)
+        self.vectorizer.fit(corpus)
+
+    def __call__(self, texts: List[str]):
+        return self.vectorizer.transform(texts)
+
+
+def _similarities(matrix, query) -> np.ndarray:
+    # A dense query vector keeps sparse @ vector on the fast path (no sparse-sparse product).
+    if hasattr(query, "toarray"):
+        query = query.toarray()
+    return np.asarray(matrix @ np.asarray(query).ravel()).ravel()
+
+
+class DemoSelector:
+    def __init__(self, pool: List[dspy.Example], embed: Optional[Callable[[List[str]], Any]] = None,
+                 k: int = 3, token_budget: int = 600, max_similarity: float = 0.98):
+        """
+        pool: labelled examples that can be used as demos for any predictor (e.g. train.csv).
+        embed: maps a list of texts to L2-normalized row vectors (dense or sparse).
+        max_similarity: candidates at least this similar are treated as the query itself and skipped.
+        Pool demos of the query's question (its QuestionId, or the same QuestionText) are always skipped.
+        """
+        self.pool = pool
+        self.embed = embed or TfidfEmbedder([example_text(demo) for demo in pool])
+        self.k = k
+        self.token_budget = token_budget
+        self.max_similarity = max_similarity
+
+        self._pool_matrix = self.embed([example_text(demo) for demo in pool]) if pool else None
+        self._pool_tokens = np.array([self._demo_tokens(demo) for demo in pool], dtype=np.int64)
+        self._pool_question_ids = np.array([demo.get("QuestionId", -1) for demo in pool], dtype=np.int64)
+        self._question_ids = {question_key(demo.QuestionText): demo.QuestionId for demo in pool
+                              if "QuestionId" in demo and "QuestionText" in demo}
+        self._pool_fits: Dict[Any, bool] = {}
+        self._demo_index: Dict[tuple, tuple] = {}
+
+    @staticmethod
+    def _demo_tokens(demo) -> int:
+        return sum(estimate_tokens(value) for key, value in demo.items() if key not in _LABEL_FIELDS)
+
+    def _fits(self, signature, demo) -> bool:
+        # Same rule as ChatAdapter: a demo needs at least one input and one output field of the signature.
+        return any(k in demo for k in signature.input_fields) and any(k in demo for k in signature.output_fields)
+
+    def _index_demos(self, demos) -> tuple:
+        """Vectors and token counts of a predictor's own demos, cached per demo set."""
+        key = tuple(id(demo) for demo in demos)
+        entry = self._demo_index.get(key)
+        if entry is None:
+            demos = list(demos)
+            matrix = self.embed([example_text(demo) for demo in demos])
+            tokens = np.array([self._demo_tokens(demo) for demo in demos], dtype=np.int64)
+            entry = self._demo_index[key] = (demos, matrix, tokens)
+        return entry
+
+    def select(self, signature, demos, inputs: Dict[str, Any]) -> list:
+        """Pick up to k demos most similar to `inputs` whose estimated size fits the token budget."""
+        candidates, scores, tokens, leaked = [], [], [], []
+
+        query = self.embed([example_text(inputs)])
+        query_question = question_key(inputs.get("QuestionText", ""))
+        query_id = inputs.get("QuestionId", self._question_ids.get(query_question, -1))
+
+        if demos:
+            own_demos, matrix, own_tokens = self._index_demos(demos)
+            fits = np.array([self._fits(signature, demo) for demo in own_demos], dtype=bool)
+            candidates.extend(demo for demo, fit in zip(own_demos, fits) if fit)
+            scores.append(_similarities(matrix, query)[fits])
+            tokens.append(own_tokens[fits])
+            leaked.append(np.array([bool(query_question) and question_key(demo.get("QuestionText", "")) == query_question
+                                    for demo in own_demos], dtype=bool)[fits])
+
+        if self.pool:
+            pool_fits = self._pool_fits.get(signature)
+            if pool_fits is None:
+                pool_fits = self._pool_fits[signature] = self._fits(signature, self.pool[0])
+            if pool_fits:
+                candidates.extend(self.pool)
+                scores.append(_similarities(self._pool_matrix, query))
+                tokens.append(self._pool_tokens)
+                leaked.append((self._pool_question_ids == query_id) & (query_id >= 0))
+
+        if not candidates:
+            return list(demos or [])
+
+        scores = np.concatenate(scores)
+        tokens = np.concatenate(tokens)
+        # The shortlist is taken after dropping the query's own question, which scores highest.
+        scores[np.concatenate(leaked)] = -np.inf
+
+        # Only the best few candidates can be picked, so avoid sorting the whole pool.
+        shortlist = min(len(scores), 8 * self.k)
+        top = np.argpartition(-scores, shortlist - 1)[:shortlist]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        selected, used, questions = [], 0, set()
+        for i in top:
+            if scores[i] >= self.max_similarity or np.isneginf(scores[i]):
+                continue
+            if used + tokens[i] > self.token_budget:
+                continue
+            # Several wrong options of the same question carry little extra signal; keep one.
+            question = candidates[i].get("QuestionText")
+            if question in questions:
+                continue
+            selected.append(candidates[i])
+            used += tokens[i]
+            questions.add(question)
+            if len(selected) == self.k:
+                break
+        return selected
+
+
+@lru_cache(maxsize=4)
+def load_demo_selector(q_data_path: str = "./data/train.csv", mis_data_path: str = "./data/misconception_mapping.csv",
+                       k: int = 3, token_budget: int = 600, embedding: str = "tfidf") -> DemoSelector:
+    """
+    Build (once per process) a selector over the train.csv demos.
+    embedding: "tfidf", or "dense" for the local sentence-embedding model (embedding_service.py).
+    """
+    embed = None
+    if embedding == "dense":
+        from embedding_service import load_embedding_service
+        embed = load_embedding_service()
+    elif embedding != "tfidf":
+        raise ValueError(f"Unknown embedding {embedding!r}; expected 'tfidf' or 'dense'")
+    return DemoSelector(load_train_demos(q_data_path, mis_data_path), embed=embed, k=k, token_budget=token_budget)
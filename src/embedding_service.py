@@ -0,0 +1,170 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+#########################################################################################################################
+# Local CPU embedding service
+#
+# A small sentence-embedding model runs in-process. Concurrent callers (agents, the demo selector,
+# retrieval) don't encode one by one: their texts are queued and a single batching thread encodes
+# everything that arrives within `max_wait_ms` as one batch. Vectors are L2-normalized float32 and
+# kept in an LRU cache keyed by text, so a repeated thought or query costs a dictionary lookup.
+#
+# Backends, fastest first: ONNX Runtime with the model's int8-quantized export, then PyTorch with
+# dynamic int8 quantization of the Linear layers, then plain PyTorch.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# Quantized export shipped in the model repository, used with the ONNX backend.
+DEFAULT_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+def load_sentence_model(model_name: str = DEFAULT_EMBEDDING_MODEL, backend: str = "auto",
+                        onnx_file: str = DEFAULT_ONNX_FILE):
+    """A SentenceTransformer on CPU; backend is "onnx", "int8" (PyTorch dynamic quantization), "torch" or "auto"."""
+    from sentence_transformers import SentenceTransformer
+
+    if backend in ("auto", "onnx"):
+        try:
+            return SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs={"file_name": onnx_file})
+        except Exception as e:  # onnxruntime/optimum missing or no ONNX export of the model
+            if backend == "onnx":
+                raise
+            logger.info("ONNX embedding backend unavailable (%r), using PyTorch", e)
+
+    model = SentenceTransformer(model_name, device="cpu")
+    if backend in ("auto", "int8"):
+        import torch
+
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+class EmbeddingService:
+    """
+    Thread-safe text -> vector function with micro-batching and an LRU cache.
+
+    Instances are callable like the embedders of demo_selector.py: `service(texts)` returns an
+    (n, dim) array of L2-normalized rows.
+    """
+
+    def __init__(self, model=None, max_batch_size: int = 64, max_wait_ms: float = 3.0, cache_size: int = 50_000):
+        """
+        model: anything with a SentenceTransformer-style `encode(texts, batch_size=..., normalize_embeddings=True)`;
+        loaded with load_sentence_model() on first use if None.
+        """
+        self._model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self._worker_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self.stats = {"requests": 0, "texts": 0, "cache_hits": 0, "batches": 0, "encoded": 0}
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = load_sentence_model()
+            return self._model
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._batch_loop, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch):
+        # Texts asked for by several callers of the batch are encoded once.
+        texts = list(dict.fromkeys(text for request_texts, _ in batch for text in request_texts))
+        try:
+            vectors = self._encode(texts)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        by_text = dict(zip(texts, vectors))
+        self._remember(by_text)
+        self.stats["batches"] += 1
+        self.stats["encoded"] += len(texts)
+        for request_texts, future in batch:
+            future.set_result(np.stack([by_text[text] for text in request_texts]))
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=self.max_batch_size, normalize_embeddings=True,
+                                    convert_to_numpy=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32)
+
+    def _remember(self, by_text: dict):
+        with self._cache_lock:
+            for text, vector in by_text.items():
+                self._cache[text] = vector
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """(len(texts), dim) float32 array of L2-normalized embeddings."""
+        texts = [str(text) for text in texts]
+        vectors: List[Optional[np.ndarray]] = [None] * len(texts)
+        with self._cache_lock:
+            for i, text in enumerate(texts):
+                vector = self._cache.get(text)
+                if vector is not None:
+                    self._cache.move_to_end(text)
+                    vectors[i] = vector
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            self.stats["requests"] += 1
+            self.stats["texts"] += len(texts)
+            self.stats["cache_hits"] += len(texts) - len(missing)
+
+        if missing:
+            future: Future = Future()
+            self._ensure_worker()
+            self._queue.put(([texts[i] for i in missing], future))
+            for i, vector in zip(missing, future.result()):
+                vectors[i] = vector
+        if not vectors:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return np.stack(vectors)
+
+    __call__ = embed
+
+    @property
+    def dimension(self) -> int:
+        return int(self.model.get_sentence_embedding_dimension())
+
+
+@lru_cache(maxsize=2)
+def load_embedding_service(model_name: str = DEFAULT_EMBEDDING_MODEL, backend: str = "auto") -> EmbeddingService:
+    """One embedding service (and model) per process."""
+    return EmbeddingService(load_sentence_model(model_name, backend))
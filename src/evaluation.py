@@ -0,0 +1,203 @@
+import argparse
+import json
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+#########################################################################################################################
+# MAP@25 evaluation
+#
+# Predictions use the format of data/sample_submission.csv: one row per QuestionId_Answer with up to
+# 25 space-separated MisconceptionIds, best first. Labels are the MisconceptionAId..DId columns of
+# train.csv; options without a misconception (including the correct answer) are not scored. Each
+# label has a single gold id, so the average precision of a row is 1/rank of the gold id (0 if it
+# isn't in the top k). All scoring is done on (rows, k) integer arrays.
+#
+#   python src/evaluation.py predictions.csv --train data/train.csv --by-subject
+
+OPTIONS = ("A", "B", "C", "D")
+DEFAULT_K = 25
+DEFAULT_RECALL_AT = (1, 5, 10, 25)
+# Padding for rows with fewer than k predictions; never a valid MisconceptionId.
+NO_PREDICTION = -1
+
+
+def answer_keys(question_ids, options) -> np.ndarray:
+    """Integer key of QuestionId_Answer pairs (QuestionId * 4 + option index), so joins avoid strings."""
+    return np.asarray(question_ids, dtype=np.int64) * len(OPTIONS) + np.asarray(options, dtype=np.int64)
+
+
+def load_labels(train_path: str = "./data/train.csv") -> pd.DataFrame:
+    """One row per labelled (question, option): key (see answer_keys), QuestionId_Answer, MisconceptionId, SubjectName."""
+    data = pd.read_csv(train_path, usecols=["QuestionId", "SubjectName"] + [f"Misconception{o}Id" for o in OPTIONS])
+    labels = data.melt(id_vars=["QuestionId", "SubjectName"], value_vars=[f"Misconception{o}Id" for o in OPTIONS],
+                       var_name="Option", value_name="MisconceptionId").dropna(subset=["MisconceptionId"])
+    option = labels["Option"].str[len("Misconception")]
+    labels["key"] = answer_keys(labels["QuestionId"], option.map(OPTIONS.index))
+    labels["QuestionId_Answer"] = labels["QuestionId"].astype(str) + "_" + option
+    labels["MisconceptionId"] = labels["MisconceptionId"].astype(np.int32)
+    return labels[["key", "QuestionId_Answer", "MisconceptionId", "SubjectName"]].reset_index(drop=True)
+
+
+# Longest QuestionId/MisconceptionId accepted, so that values fit in int32.
+_MAX_DIGITS = 9
+
+
+def _parse_block(block: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keys and (rows, k) predictions of a block of complete submission lines (uint8 bytes)."""
+    # Tokens are runs of digits/letters; everything below "0" (space, comma, quote, CR, LF) and "_"
+    # separates them: "1869_B,1 2 3" and '"1869_B","1 2 3"' -> 1869 | B | 1 | 2 | 3.
+    is_token = (block >= ord("0")) & (block != ord("_"))
+    padded = np.concatenate(([False], is_token, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    starts, lengths = edges[0::2], edges[1::2] - edges[0::2]
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, k), dtype=np.int32)
+    if lengths.max() > _MAX_DIGITS:
+        raise ValueError("QuestionId or MisconceptionId too long")
+
+    # Decimal value of every token, grouped by token length so each digit is gathered exactly once.
+    values = np.empty(len(starts), dtype=np.int32)
+    non_digit = np.zeros(len(starts), dtype=bool)
+    for length in range(1, int(lengths.max()) + 1):
+        tokens = np.flatnonzero(lengths == length)
+        token_starts = starts[tokens]
+        value = np.zeros(len(tokens), dtype=np.int32)
+        invalid = np.zeros(len(tokens), dtype=bool)
+        for j in range(length):
+            digit = block[token_starts + j].astype(np.int32) - ord("0")
+            invalid |= digit > 9
+            value = value * 10 + digit
+        values[tokens] = value
+        non_digit[tokens] = invalid
+
+    # Position of each token in its line: 0 QuestionId, 1 option letter, 2.. ranked MisconceptionIds.
+    # A line's first token is the first one after a newline, whatever separators (a quote) precede it.
+    line = np.searchsorted(np.flatnonzero(block == ord("\n")), starts)
+    first = np.concatenate(([True], line[1:] != line[:-1]))
+    first_index = np.flatnonzero(first)
+    position = np.arange(len(starts)) - np.repeat(first_index, np.diff(np.append(first_index, len(starts))))
+    row = np.cumsum(first) - 1
+
+    is_letter = position == 1
+    letters = block[starts[is_letter]].astype(np.int64) - ord("A")
+    if (non_digit & ~is_letter).any() or len(letters) != len(first_index) or (lengths[is_letter] != 1).any() \
+            or ((letters < 0) | (letters >= len(OPTIONS))).any():
+        raise ValueError("Malformed submission line: expected QuestionId_Answer,<MisconceptionIds separated by spaces>")
+
+    predictions = np.full((len(first_index), k), NO_PREDICTION, dtype=np.int32)
+    ranked = (position >= 2) & (position < k + 2)
+    predictions[row[ranked], position[ranked] - 2] = values[ranked]
+    return answer_keys(values[first], letters), predictions
+
+
+def load_predictions(path: str, k: int = DEFAULT_K, block_size: int = 1 << 24) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (keys, predictions) of a submission file: keys as in answer_keys and predictions an int32
+    (rows, k) array padded with NO_PREDICTION. The file is parsed in blocks of whole lines with
+    array operations only, so memory stays bounded and millions of rows take seconds.
+    """
+    keys, predictions = [], []
+    with open(path, "rb") as f:
+        f.readline()  # header
+        rest = b""
+        while True:
+            chunk = f.read(block_size)
+            data = rest + chunk
+            if not chunk:
+                data, rest = data + b"\n", b""
+            else:
+                cut = data.rfind(b"\n") + 1
+                data, rest = data[:cut], data[cut:]
+            if data:
+                block_keys, block_predictions = _parse_block(np.frombuffer(data, dtype=np.uint8), k)
+                keys.append(block_keys)
+                predictions.append(block_predictions)
+            if not chunk:
+                break
+    return np.concatenate(keys), np.concatenate(predictions)
+
+
+def gold_ranks(predictions: np.ndarray, labels: np.ndarray, k: int = DEFAULT_K) -> np.ndarray:
+    """1-based rank of each label among the first k predictions of its row, 0 if absent."""
+    hits = predictions[:, :k] == np.asarray(labels)[:, None]
+    # argmax finds the first hit, so a repeated id is only credited at its best rank.
+    return np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, 0)
+
+
+def average_precision(ranks: np.ndarray) -> np.ndarray:
+    """Per-row AP@k for single-label rows, from gold_ranks."""
+    return np.divide(1.0, ranks, out=np.zeros(len(ranks), dtype=np.float64), where=ranks > 0)
+
+
+def align(keys: np.ndarray, predictions: np.ndarray, label_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Prediction rows in the order of `label_keys` and a mask of the labels that have one."""
+    index = pd.Index(keys)
+    if not index.is_unique:
+        # Keep the first row of a repeated key, like a submission read into a dict would.
+        first = ~index.duplicated()
+        index, predictions = index[first], predictions[first]
+    positions = index.get_indexer(label_keys)
+    found = positions >= 0
+    aligned = np.full((len(positions), predictions.shape[1]), NO_PREDICTION, dtype=predictions.dtype)
+    aligned[found] = predictions[positions[found]]
+    return aligned, found
+
+
+def score(predictions: np.ndarray, labels: np.ndarray, k: int = DEFAULT_K,
+          recall_at: Sequence[int] = DEFAULT_RECALL_AT, groups: np.ndarray = None) -> Dict:
+    """
+    MAP@k and recall@k of aligned (rows, k) predictions against one label per row.
+    With `groups` (one label per row, e.g. SubjectName), adds a per-group breakdown DataFrame.
+    """
+    ranks = gold_ranks(predictions, labels, k)
+    ap = average_precision(ranks)
+    recall_at = [r for r in recall_at if r <= k]
+    result = {
+        "rows": int(len(ranks)),
+        f"map@{k}": float(ap.mean()) if len(ap) else 0.0,
+        **{f"recall@{r}": float(((ranks > 0) & (ranks <= r)).mean()) if len(ranks) else 0.0 for r in recall_at},
+    }
+    if groups is not None:
+        codes, names = pd.factorize(np.asarray(groups))
+        counts = np.bincount(codes, minlength=len(names))
+        breakdown = {"rows": counts, f"map@{k}": np.bincount(codes, weights=ap, minlength=len(names)) / counts}
+        for r in recall_at:
+            hit = ((ranks > 0) & (ranks <= r)).astype(np.float64)
+            breakdown[f"recall@{r}"] = np.bincount(codes, weights=hit, minlength=len(names)) / counts
+        result["by_group"] = pd.DataFrame(breakdown, index=pd.Index(names, name="group")) \
+            .sort_values(["rows", f"map@{k}"], ascending=[False, False])
+    return result
+
+
+def evaluate(predictions_path: str, train_path: str = "./data/train.csv", k: int = DEFAULT_K,
+             recall_at: Sequence[int] = DEFAULT_RECALL_AT, by_subject: bool = False) -> Dict:
+    """Score a submission file against the labelled options of train.csv (missing rows score 0)."""
+    labels = load_labels(train_path)
+    keys, predictions = load_predictions(predictions_path, k)
+    aligned, found = align(keys, predictions, labels["key"].to_numpy())
+    result = score(aligned, labels["MisconceptionId"].to_numpy(), k, recall_at,
+                   groups=labels["SubjectName"].to_numpy() if by_subject else None)
+    result["predicted_rows"] = int(len(keys))
+    result["labels_without_prediction"] = int((~found).sum())
+    if by_subject:
+        result["by_subject"] = result.pop("by_group").rename_axis("SubjectName")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute MAP@25 and recall@k of a submission against train.csv.")
+    parser.add_argument("predictions", help="CSV in the sample_submission.csv format")
+    parser.add_argument("--train", default="./data/train.csv")
+    parser.add_argument("--k", type=int, default=DEFAULT_K)
+    parser.add_argument("--recall-at", type=int, nargs="+", default=list(DEFAULT_RECALL_AT))
+    parser.add_argument("--by-subject", action="store_true", help="also print the per-SubjectName breakdown")
+    args = parser.parse_args()
+
+    result = evaluate(args.predictions, args.train, args.k, args.recall_at, args.by_subject)
+    by_subject = result.pop("by_subject", None)
+    print(json.dumps(result, indent=2))
+    if by_subject is not None:
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(by_subject.round(4).to_string())
@@ -0,0 +1,223 @@
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import replace
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from evaluation import answer_keys
+from sweep import PERSONA_SETS, SWEEP_MODES, SweepConfig, use_shared_lm_cache
+
+#########################################################################################################################
+# Materialized ExchangeOfThought predictions
+#
+# The quiz only shows train.csv questions, so the prediction of every (question, wrong option) can
+# be computed ahead of time for one program (a program_config.ProgramConfig, by default the pages'
+# APP_PROGRAM) and served by key. The job writes a single SQLite file: a `predictions` table keyed
+# like evaluation.answer_keys (QuestionId * 4 + option) and a `meta` table with the configuration
+# and its version tag (program_config.config_meta). Interrupted jobs resume where they stopped; a
+# job for another configuration starts a new file. Readers open the finished file read-only, load
+# it into a dict and only serve it when its tag matches their own configuration.
+#
+#   python src/materialize.py --out data/predictions.sqlite3                # the pages' program
+#   python src/materialize.py --mode Report --rounds 1 --personas new --lm lambda --out data/r1.sqlite3
+#   python src/materialize.py --processes 4   # one program per worker process (program_config.py)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREDICTIONS_PATH = "./data/predictions.sqlite3"
+OPTIONS = ("A", "B", "C", "D")
+
+
+def wrong_options(q_data_path: str = "./data/train.csv") -> List[dict]:
+    """Inputs of ExchangeOfThought for every (question, wrong option) of the dataset."""
+    data = pd.read_csv(q_data_path)
+    tasks = []
+    for row in data.itertuples(index=False):
+        for i, option in enumerate(OPTIONS):
+            if option == row.CorrectAnswer:
+                continue
+            tasks.append({
+                "key": int(answer_keys(row.QuestionId, i)),
+                "QuestionText": row.QuestionText, "AnswerText": getattr(row, f"Answer{option}Text"),
+                "ConstructName": row.ConstructName, "SubjectName": row.SubjectName,
+                "CorrectAnswer": getattr(row, f"Answer{row.CorrectAnswer}Text"),
+            })
+    return tasks
+
+
+class PredictionWriter:
+    def __init__(self, path: str, meta: Dict[str, str]):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path) and read_meta(path).get("tag") != meta["tag"]:
+            logger.info("%s holds another configuration; starting over", path)
+            os.remove(path)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                key INTEGER PRIMARY KEY, prediction TEXT NOT NULL, truncated INTEGER NOT NULL, created REAL NOT NULL
+            )
+        """)
+        self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [*meta.items(), ("complete", "0")])
+
+    def done(self) -> set:
+        """Keys with a servable prediction; truncated or degraded ones are predicted again."""
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT key FROM predictions WHERE truncated = 0")}
+
+    def put(self, key: int, prediction: str, truncated: bool = False):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                               (key, str(prediction), int(truncated), time.time()))
+
+    def finish(self, complete: bool):
+        """Compact the file into a single read-only-friendly database (no WAL)."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('complete', ?)", (str(int(complete)),))
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+            self._conn.execute("VACUUM")
+            self._conn.close()
+
+
+def read_meta(path: str) -> Dict[str, str]:
+    try:
+        conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        try:
+            return dict(conn.execute("SELECT name, value FROM meta").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+
+
+class MaterializedPredictions:
+    """Read-only (QuestionId, option) -> prediction map of one configuration."""
+
+    def __init__(self, path: str = DEFAULT_PREDICTIONS_PATH, tag: Optional[str] = None):
+        """tag: the reader's ProgramConfig.meta(lm)["tag"]; a file of another configuration serves nothing."""
+        self.meta = read_meta(path) if os.path.exists(path) else {}
+        self.predictions: Dict[int, str] = {}
+        self.hits = 0
+        self.misses = 0
+        if not self.meta:
+            logger.info("No materialized predictions at %s", path)
+        elif tag is not None and self.meta.get("tag") != tag:
+            logger.warning("Materialized predictions at %s are for another configuration (%s, expected %s); ignoring them",
+                           path, self.meta.get("tag"), tag)
+        else:
+            conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+            try:
+                self.predictions = dict(conn.execute("SELECT key, prediction FROM predictions WHERE truncated = 0"))
+            finally:
+                conn.close()
+
+    def get(self, QuestionId: int, option: str) -> Optional[str]:
+        prediction = self.predictions.get(int(answer_keys(QuestionId, OPTIONS.index(option))))
+        if prediction is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return prediction
+
+    def __len__(self):
+        return len(self.predictions)
+
+
+@lru_cache(maxsize=4)
+def load_materialized_predictions(path: str = DEFAULT_PREDICTIONS_PATH, tag: Optional[str] = None) -> MaterializedPredictions:
+    return MaterializedPredictions(path, tag)
+
+
+def materialize(program, tasks: List[dict], writer: PredictionWriter, workers: int = 4, executor=None) -> int:
+    """
+    Predict every task the writer doesn't have yet; returns the number of failures (retried by the next run).
+    executor: a program_config.process_pool to predict in instead of `workers` threads running `program`.
+    """
+    done = writer.done()
+    pending = [task for task in tasks if task["key"] not in done]
+    logger.info("Materializing %d of %d predictions (%d already done)", len(pending), len(tasks), len(tasks) - len(pending))
+
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="materialize")
+        predict = lambda inputs: program(**inputs)
+    else:
+        from program_config import predict
+
+    failures = 0
+    with executor:
+        futures = {executor.submit(predict, {name: value for name, value in task.items() if name != "key"}): task
+                   for task in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            try:
+                prediction = future.result()
+                # Predictions come back from worker processes too, so they are written here. Exchanges
+                # that ran out of time or lost an agent are kept but not served.
+                incomplete = getattr(prediction, "truncated", False) or getattr(prediction, "failed_agents", ())
+                writer.put(futures[future]["key"], prediction, bool(incomplete))
+            except Exception as e:
+                failures += 1
+                logger.warning("Prediction of key %d failed: %r", futures[future]["key"], e)
+            if i % 50 == 0 or i == len(futures):
+                logger.info("Materialized %d/%d", i, len(futures))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute ExchangeOfThought predictions for every wrong option.")
+    parser.add_argument("--config", metavar="JSON", help="ProgramConfig.to_json() file to start from (default: the pages' APP_PROGRAM)")
+    parser.add_argument("--mode", choices=SWEEP_MODES)
+    parser.add_argument("--rounds", type=int)
+    parser.add_argument("--personas", choices=list(PERSONA_SETS))
+    parser.add_argument("--lm", choices=["lambda", "openai", "router"], help="'router' routes requests to cheap/strong models (routing.py)")
+    parser.add_argument("--max-tokens", type=int)
+    parser.add_argument("--train")
+    parser.add_argument("--misconceptions")
+    parser.add_argument("--reasoning-store", help="reuse reasoning across runs (reasoning_store.py)")
+    parser.add_argument("--compiled")
+    parser.add_argument("--out", default=DEFAULT_PREDICTIONS_PATH)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=0,
+                        help="predict in this many worker processes, each with its own program (default: threads only)")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N (question, option) pairs")
+    parser.add_argument("--cache-dir", default="./cache/lm", help="LM response cache shared with sweeps")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    use_shared_lm_cache(args.cache_dir)
+    from program_config import APP_PROGRAM, ProgramConfig, process_pool
+
+    if args.config:
+        with open(args.config) as f:
+            program_config = ProgramConfig.from_json(f.read())
+    else:
+        program_config = APP_PROGRAM
+    overrides = {name: value for name, value in (
+        ("mode", args.mode), ("rounds", args.rounds), ("lm", args.lm), ("max_tokens", args.max_tokens),
+        ("q_data_path", args.train), ("mis_data_path", args.misconceptions),
+        ("reasoning_store_path", args.reasoning_store), ("compiled_path", args.compiled),
+    ) if value is not None}
+    if args.personas:
+        overrides["agents"] = ProgramConfig.from_sweep(SweepConfig("Report", 1, args.personas)).agents
+    program_config = replace(program_config, **overrides)
+    lm = program_config.build_lm()
+    meta = program_config.meta(lm)
+    tasks = wrong_options(program_config.q_data_path)[:args.limit]
+    writer = PredictionWriter(args.out, meta)
+    if args.processes:
+        failures = materialize(None, tasks, writer, executor=process_pool(program_config, args.processes, args.cache_dir))
+    else:
+        failures = materialize(program_config.build(lm), tasks, writer, args.workers)
+    writer.finish(complete=failures == 0 and args.limit is None)
+    print(f"{args.out}: configuration {meta['tag']} ({program_config.mode}, {program_config.rounds} rounds, "
+          f"{meta['lm']}), {len(tasks) - failures} of {len(tasks)} predictions written, {failures} failed")
@@ -0,0 +1,305 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+import dspy
+import numpy as np
+from dspy.utils.callback import BaseCallback
+
+#########################################################################################################################
+# Per-call metrics
+#
+# Every LM request is recorded with the context it ran in (ExchangeOfThought mode and round, the
+# agent and the sub-agent that issued it), its latency, token usage and whether it was served from
+# the cache. Records go to an append-only SQLite table; `refresh_rollups` folds new records into
+# per (mode, agent, model) rollups with a latency histogram, which the Data Analysis page reads.
+
+DEFAULT_METRICS_PATH = "./metrics/calls.sqlite3"
+
+# USD per 1M tokens (input, output); unknown models are priced like gpt-4o-mini, as in LanguageModel.get_usage.
+PRICES = {
+    "gpt-4o-mini": (0.150, 0.600),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+}
+
+# Log-spaced latency buckets (ms) from 1 ms to ~20 min; percentiles are read from these.
+LATENCY_BUCKETS = np.geomspace(1, 1.2e6, 160)
+
+_context: ContextVar[Dict[str, Any]] = ContextVar("metrics_context", default={})
+
+
+@contextmanager
+def metrics_context(**fields):
+    """Attach fields (e.g. round=2) to every call recorded inside the block."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def current_context() -> Dict[str, Any]:
+    return dict(_context.get())
+
+
+def price(model: Optional[str], prompt_tokens: int, completion_tokens: int) -> float:
+    model_name = (model or "").split("/")[-1]
+    input_price, output_price = next(
+        (prices for name, prices in PRICES.items() if model_name.startswith(name)), PRICES["gpt-4o-mini"])
+    return prompt_tokens * input_price / 10**6 + completion_tokens * output_price / 10**6
+
+
+class MetricsStore:
+    def __init__(self, path: str = DEFAULT_METRICS_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                mode TEXT, round INTEGER, agent TEXT, component TEXT, model TEXT,
+                latency_ms REAL, prompt_tokens INTEGER, completion_tokens INTEGER,
+                cache_hit INTEGER, error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS rollups (
+                mode TEXT NOT NULL, agent TEXT NOT NULL, model TEXT NOT NULL,
+                calls INTEGER, errors INTEGER, cache_hits INTEGER,
+                prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL,
+                latency_sum REAL, latency_hist TEXT,
+                PRIMARY KEY (mode, agent, model)
+            );
+            CREATE TABLE IF NOT EXISTS rollup_state (id INTEGER PRIMARY KEY CHECK (id = 0), last_call_id INTEGER);
+            INSERT OR IGNORE INTO rollup_state VALUES (0, 0);
+        """)
+        # `run` labels calls of one configuration of a sweep (sweep.py); added to older files in place.
+        if "run" not in {row[1] for row in self._conn.execute("PRAGMA table_info(calls)")}:
+            self._conn.execute("ALTER TABLE calls ADD COLUMN run TEXT")
+
+    def record(self, latency_ms: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+               cache_hit: bool = False, model: Optional[str] = None, error: Optional[str] = None, **fields):
+        """Append one call record; unspecified context fields come from `metrics_context`."""
+        context = {**current_context(), **fields}
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO calls (ts, mode, round, agent, component, model, latency_ms, prompt_tokens,"
+                " completion_tokens, cache_hit, error, run) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), context.get("mode"), context.get("round"), context.get("agent"),
+                 context.get("component"), model, latency_ms, prompt_tokens, completion_tokens, int(cache_hit), error,
+                 context.get("run")),
+            )
+
+    def refresh_rollups(self):
+        """Fold the calls recorded since the last refresh into the rollup table."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                last_id = self._conn.execute("SELECT last_call_id FROM rollup_state").fetchone()[0]
+                rows = self._conn.execute(
+                    "SELECT id, COALESCE(mode, ''), COALESCE(agent, ''), COALESCE(model, ''), latency_ms,"
+                    " prompt_tokens, completion_tokens, cache_hit, error IS NOT NULL FROM calls WHERE id > ?",
+                    (last_id,),
+                ).fetchall()
+                groups: Dict[tuple, list] = {}
+                for row in rows:
+                    groups.setdefault(row[1:4], []).append(row)
+                for key, group in groups.items():
+                    self._merge_rollup(key, group)
+                if rows:
+                    self._conn.execute("UPDATE rollup_state SET last_call_id = ?", (rows[-1][0],))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _merge_rollup(self, key: tuple, group: list):
+        latencies = np.array([row[4] or 0.0 for row in group])
+        prompt_tokens = sum(row[5] or 0 for row in group)
+        completion_tokens = sum(row[6] or 0 for row in group)
+        hist = np.bincount(np.searchsorted(LATENCY_BUCKETS, latencies), minlength=len(LATENCY_BUCKETS) + 1)
+
+        existing = self._conn.execute(
+            "SELECT calls, errors, cache_hits, prompt_tokens, completion_tokens, cost, latency_sum, latency_hist"
+            " FROM rollups WHERE mode = ? AND agent = ? AND model = ?", key).fetchone()
+        totals = [len(group), sum(row[8] for row in group), sum(row[7] for row in group), prompt_tokens,
+                  completion_tokens, price(key[2], prompt_tokens, completion_tokens), float(latencies.sum())]
+        if existing:
+            totals = [a + b for a, b in zip(totals, existing[:7])]
+            hist = hist + np.array(json.loads(existing[7]))
+        self._conn.execute("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (*key, *totals, json.dumps(hist.tolist())))
+
+    def rollups(self) -> list:
+        """
+        Rollup rows as dicts, with latency percentiles (ms) read from the histograms. Percentiles of
+        several rows are read from the sum of their `latency_hist` arrays (merge_percentiles).
+        """
+        self.refresh_rollups()
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM rollups ORDER BY mode, agent, model")
+            columns = [c[0] for c in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            hist = row["latency_hist"] = np.array(json.loads(row["latency_hist"]))
+            row.update(merge_percentiles([hist]))
+            row["mean_ms"] = row["latency_sum"] / row["calls"] if row["calls"] else 0.0
+        return rows
+
+    def run_totals(self) -> Dict[str, dict]:
+        """Per-run call counts, tokens and cost; cache hits are counted but not paid for."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT run, COALESCE(model, ''), COUNT(*), SUM(cache_hit), SUM(error IS NOT NULL),"
+                " SUM(CASE WHEN cache_hit THEN 0 ELSE prompt_tokens END),"
+                " SUM(CASE WHEN cache_hit THEN 0 ELSE completion_tokens END)"
+                " FROM calls WHERE run IS NOT NULL GROUP BY run, model").fetchall()
+        totals: Dict[str, dict] = {}
+        for run, model, calls, cache_hits, errors, prompt_tokens, completion_tokens in rows:
+            total = totals.setdefault(run, {"lm_calls": 0, "cache_hits": 0, "lm_errors": 0, "prompt_tokens": 0,
+                                            "completion_tokens": 0, "cost": 0.0})
+            total["lm_calls"] += calls
+            total["cache_hits"] += cache_hits or 0
+            total["lm_errors"] += errors or 0
+            total["prompt_tokens"] += prompt_tokens or 0
+            total["completion_tokens"] += completion_tokens or 0
+            total["cost"] += price(model, prompt_tokens or 0, completion_tokens or 0)
+        return totals
+
+    def calls(self, limit: int = 10000) -> list:
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM calls ORDER BY id DESC LIMIT ?", (limit,))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def histogram_percentile(hist: np.ndarray, q: float) -> float:
+    """Upper edge of the latency bucket containing the q-th percentile."""
+    total = hist.sum()
+    if not total:
+        return 0.0
+    index = int(np.searchsorted(np.cumsum(hist), total * q / 100))
+    return float(LATENCY_BUCKETS[min(index, len(LATENCY_BUCKETS) - 1)])
+
+
+def merge_percentiles(hists) -> Dict[str, float]:
+    """p50/p90/p99 (ms) of the calls of several latency histograms together."""
+    hist = np.sum(list(hists), axis=0)
+    return {f"p{q}_ms": histogram_percentile(hist, q) for q in (50, 90, 99)}
+
+
+def lm_history_entry(lm, outputs) -> Optional[dict]:
+    """The history entry of the dspy.LM call that returned `outputs` (usage, response, ...)."""
+    # LM.__call__ returns the same list object it stores in its history entry.
+    for entry in reversed(getattr(lm, "history", [])[-16:]):
+        if entry.get("outputs") is outputs:
+            return entry
+    return None
+
+
+_stores: Dict[str, MetricsStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str = DEFAULT_METRICS_PATH) -> MetricsStore:
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = MetricsStore(path)
+        return _stores[path]
+
+
+class MetricsCallback(BaseCallback):
+    """dspy callback that records every LM call with its ExchangeOfThought/agent context.
+
+    It also maintains that context (mode, round, agent, predictor signature) for the duration of
+    each module call, which other components such as the LM router read with `current_context`.
+    """
+
+    def __init__(self, store: Optional[MetricsStore] = None):
+        self.store = store
+        self._module_tokens: Dict[str, Any] = {}
+        self._lm_calls: Dict[str, tuple] = {}
+        self._seen_responses: OrderedDict = OrderedDict()
+
+    def _get_store(self) -> MetricsStore:
+        return self.store or get_store()
+
+    def on_module_start(self, call_id, instance, inputs):
+        fields = {}
+        if hasattr(instance, "mode") and hasattr(instance, "rounds"):  # ExchangeOfThought
+            fields = {"mode": instance.mode, "round": 0, "rounds": instance.rounds, "agent": None, "component": None}
+        elif isinstance(instance, dspy.Predict):
+            # Not stored, but lets the LM router (routing.py) see which signature is being predicted.
+            fields = {"signature": instance.signature.__name__, "output_fields": tuple(instance.signature.output_fields)}
+        elif getattr(instance, "name", None):
+            # The outermost named module is the agent; the innermost one is the component.
+            fields = {"component": instance.name}
+            if not _context.get().get("agent"):
+                fields["agent"] = instance.name
+        if fields:
+            self._module_tokens[call_id] = _context.set({**_context.get(), **fields})
+
+    def on_module_end(self, call_id, outputs, exception=None):
+        token = self._module_tokens.pop(call_id, None)
+        if token is not None:
+            _context.reset(token)
+
+    def on_lm_start(self, call_id, instance, inputs):
+        self._lm_calls[call_id] = (instance, time.perf_counter())
+
+    def on_lm_end(self, call_id, outputs, exception=None):
+        instance, start = self._lm_calls.pop(call_id, (None, time.perf_counter()))
+        latency_ms = (time.perf_counter() - start) * 1000
+        entry = lm_history_entry(instance, outputs) or {}
+        usage = entry.get("usage") or {}
+        cache_hit = self._is_cache_hit(entry.get("response"))
+
+        self._get_store().record(
+            latency_ms,
+            prompt_tokens=usage.get("prompt_tokens") or 0,
+            completion_tokens=usage.get("completion_tokens") or 0,
+            cache_hit=cache_hit,
+            model=getattr(instance, "model", None),
+            error=repr(exception) if exception is not None else None,
+        )
+
+    def _is_cache_hit(self, response) -> bool:
+        if response is None:
+            return False
+        hidden_params = getattr(response, "_hidden_params", None) or {}
+        if hidden_params.get("cache_hit"):  # litellm disk cache
+            return True
+        # dspy's in-memory LRU cache hands back the very same response object. Ids of collected
+        # responses get reused, so an id only counts while its entry still refers to that object.
+        key = id(response)
+        seen = self._seen_responses.get(key)
+        if seen is not None and seen() is response:
+            self._seen_responses.move_to_end(key)
+            return True
+        try:
+            self._seen_responses[key] = weakref.ref(response)
+        except TypeError:
+            # Not weak-referenceable: keep it alive so no other response can get its id.
+            self._seen_responses[key] = lambda: response
+        if len(self._seen_responses) > 10000:
+            self._seen_responses.popitem(last=False)
+        return False
+
+
+def record_external_call(latency_ms: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+                         model: Optional[str] = None, error: Optional[str] = None):
+    """Record an LM request made outside dspy (e.g. the DashScope client) if metrics are enabled."""
+    for callback in dspy.settings.get("callbacks") or []:
+        if isinstance(callback, MetricsCallback):
+            callback._get_store().record(latency_ms, prompt_tokens, completion_tokens, model=model, error=error)
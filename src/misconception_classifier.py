@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+from functools import lru_cache
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+#########################################################################################################################
+# Distilled misconception classifier (no LLM)
+#
+# A weighted k-nearest-neighbour classifier over TF-IDF vectors of (ConstructName, QuestionText,
+# AnswerText), trained on the labelled wrong answers of train.csv plus the misconception
+# paraphrases of math_sent.json. The artifact is a directory of .npy arrays (the training matrix
+# is stored term-major as CSR arrays) opened with mmap, and a meta.json with the vocabulary, idf
+# and a confidence threshold calibrated on held-out questions. ExchangeOfThought answers directly
+# when the classifier is confident and runs the agents otherwise.
+#
+#   python src/misconception_classifier.py --train data/train.csv --paraphrases data/math_sent.json --out data/misconception_classifier
+
+MODEL_VERSION = 1
+OPTIONS = ("A", "B", "C", "D")
+# Neighbours that vote for a prediction, each with weight similarity ** VOTE_POWER.
+NEIGHBOURS = 20
+VOTE_POWER = 8
+# Share of the held-out confident predictions that must be right.
+TARGET_PRECISION = 0.9
+
+
+def pair_text(QuestionText: str, ConstructName: str, AnswerText: str) -> str:
+    return f"{ConstructName}\n{QuestionText}\n{AnswerText}"
+
+
+def _source_stamp(*paths) -> list:
+    return [[os.path.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths]
+
+
+def training_rows(q_data_path: str, mis_data_path: str, paraphrase_path: Optional[str] = None) -> pd.DataFrame:
+    """text, MisconceptionId, QuestionId (-1 for paraphrases) and weight of every training row."""
+    data = pd.read_csv(q_data_path)
+    rows = []
+    for row in data.itertuples(index=False):
+        for option in OPTIONS:
+            misconception_id = getattr(row, f"Misconception{option}Id")
+            if option == row.CorrectAnswer or pd.isna(misconception_id):
+                continue
+            rows.append((pair_text(row.QuestionText, row.ConstructName, getattr(row, f"Answer{option}Text")),
+                         int(misconception_id), int(row.QuestionId), 1.0))
+
+    if paraphrase_path:
+        mis_data = pd.read_csv(mis_data_path)
+        name_to_id = dict(zip(mis_data["MisconceptionName"], mis_data["MisconceptionId"]))
+        with open(paraphrase_path) as f:
+            paraphrases = json.load(f)
+        # Paraphrases describe the misconception rather than a question, so their votes count less.
+        for name, texts in paraphrases.items():
+            if name in name_to_id:
+                rows.extend((str(text), int(name_to_id[name]), -1, 0.5) for text in [name, *texts])
+    return pd.DataFrame(rows, columns=["text", "MisconceptionId", "QuestionId", "weight"])
+
+
+class MisconceptionClassifier:
+    def __init__(self, vectorizer: TfidfVectorizer, matrix: sp.csr_matrix, labels: np.ndarray, weights: np.ndarray,
+                 threshold: float = 1.0, neighbours: int = NEIGHBOURS, misconception_names: Optional[dict] = None):
+        """matrix: (terms, training rows) L2-normalized TF-IDF vectors, stored term-major."""
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.labels = labels
+        self.weights = weights
+        self.threshold = threshold
+        self.neighbours = neighbours
+        self.misconception_names = misconception_names or {}
+        self.served = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def fit(cls, rows: pd.DataFrame, neighbours: int = NEIGHBOURS) -> "MisconceptionClassifier":
+        vectorizer = TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), min_df=1, dtype=np.float32)
+        matrix = vectorizer.fit_transform(rows["text"]).T.tocsr()
+        return cls(vectorizer, matrix, rows["MisconceptionId"].to_numpy(np.int32),
+                   rows["weight"].to_numpy(np.float32), neighbours=neighbours)
+
+    def save(self, out_dir: str, meta: dict):
+        os.makedirs(out_dir, exist_ok=True)
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(out_dir, f"matrix.{name}.npy"), getattr(self.matrix, name))
+        np.save(os.path.join(out_dir, "labels.npy"), self.labels)
+        np.save(os.path.join(out_dir, "weights.npy"), self.weights)
+        np.save(os.path.join(out_dir, "idf.npy"), self.vectorizer.idf_.astype(np.float32))
+        # The meta file is written last: a model without it is incomplete and gets retrained.
+        with open(os.path.join(out_dir, "meta.json"), "w") as f:
+            json.dump({**meta, "version": MODEL_VERSION, "shape": list(self.matrix.shape), "threshold": self.threshold,
+                       "neighbours": self.neighbours,
+                       "vocabulary": {term: int(i) for term, i in self.vectorizer.vocabulary_.items()}}, f)
+
+    @classmethod
+    def load(cls, model_dir: str, mis_data_path: Optional[str] = "./data/misconception_mapping.csv") -> "MisconceptionClassifier":
+        with open(os.path.join(model_dir, "meta.json")) as f:
+            meta = json.load(f)
+        vectorizer = TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), dtype=np.float32,
+                                     vocabulary=meta["vocabulary"])
+        vectorizer.idf_ = np.load(os.path.join(model_dir, "idf.npy"))
+        arrays = [np.load(os.path.join(model_dir, f"matrix.{name}.npy"), mmap_mode="r")
+                  for name in ("data", "indices", "indptr")]
+        matrix = sp.csr_matrix(tuple(arrays), shape=tuple(meta["shape"]), copy=False)
+        names = None
+        if mis_data_path:
+            mis_data = pd.read_csv(mis_data_path)
+            names = dict(zip(mis_data["MisconceptionId"], mis_data["MisconceptionName"]))
+        return cls(vectorizer, matrix, np.load(os.path.join(model_dir, "labels.npy"), mmap_mode="r"),
+                   np.load(os.path.join(model_dir, "weights.npy"), mmap_mode="r"), meta["threshold"],
+                   meta["neighbours"], names)
+
+    def predict(self, texts: Sequence[str], k: int = 25):
+        """
+        (ids, scores, confidence): the (n, k) best MisconceptionIds (-1 when fewer were voted for),
+        their vote shares, and the confidence of the first one (vote share x best similarity).
+        """
+        similarities = (self.vectorizer.transform(list(texts)) @ self.matrix).toarray()
+        n_neighbours = min(self.neighbours, similarities.shape[1])
+        neighbours = np.argpartition(-similarities, n_neighbours - 1, axis=1)[:, :n_neighbours]
+        neighbour_similarities = np.take_along_axis(similarities, neighbours, axis=1)
+        votes = neighbour_similarities ** VOTE_POWER * np.asarray(self.weights)[neighbours]
+
+        ids = np.full((len(texts), k), -1, dtype=np.int64)
+        scores = np.zeros((len(texts), k), dtype=np.float32)
+        confidence = np.zeros(len(texts), dtype=np.float32)
+        for i in range(len(texts)):
+            labels, inverse = np.unique(np.asarray(self.labels)[neighbours[i]], return_inverse=True)
+            totals = np.bincount(inverse, weights=votes[i])
+            order = np.argsort(-totals, kind="stable")[:k]
+            share = totals[order] / max(totals.sum(), 1e-12)
+            ids[i, :len(order)] = labels[order]
+            scores[i, :len(order)] = share
+            confidence[i] = share[0] * neighbour_similarities[i].max()
+        return ids, scores, confidence
+
+    def answer(self, QuestionText: str, ConstructName: str, AnswerText: str) -> Optional[int]:
+        """The MisconceptionId if the classifier is confident enough to skip the agents, else None."""
+        ids, _, confidence = self.predict([pair_text(QuestionText, ConstructName, AnswerText)], k=1)
+        if confidence[0] >= self.threshold and ids[0, 0] >= 0:
+            self.served += 1
+            return int(ids[0, 0])
+        self.fallbacks += 1
+        return None
+
+
+def calibrate(confidence: np.ndarray, correct: np.ndarray, target_precision: float = TARGET_PRECISION) -> float:
+    """Lowest confidence threshold whose accepted predictions are right at least `target_precision` of the time."""
+    order = np.argsort(-confidence, kind="stable")
+    precision = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    ok = np.flatnonzero(precision >= target_precision)
+    # If no threshold is precise enough the classifier never answers on its own.
+    return float(confidence[order][ok[-1]]) if len(ok) else float("inf")
+
+
+def train(q_data_path: str = "./data/train.csv", mis_data_path: str = "./data/misconception_mapping.csv",
+          paraphrase_path: Optional[str] = "./data/math_sent.json", out_dir: str = "./data/misconception_classifier",
+          target_precision: float = TARGET_PRECISION, holdout: float = 0.2, seed: int = 0) -> dict:
+    """
+    Train on all rows and write the model to `out_dir`; the confidence threshold is calibrated by
+    a model trained without a random `holdout` share of the questions. Returns the held-out report.
+    """
+    rows = training_rows(q_data_path, mis_data_path, paraphrase_path)
+    questions = rows.loc[rows["QuestionId"] >= 0, "QuestionId"].unique()
+    held_out = np.random.default_rng(seed).choice(questions, int(len(questions) * holdout), replace=False)
+    is_held_out = rows["QuestionId"].isin(held_out).to_numpy()
+
+    model = MisconceptionClassifier.fit(rows[~is_held_out])
+    ids, _, confidence = model.predict(rows.loc[is_held_out, "text"].tolist(), k=25)
+    gold = rows.loc[is_held_out, "MisconceptionId"].to_numpy()
+    correct = ids[:, 0] == gold
+    threshold = calibrate(confidence, correct, target_precision)
+    accepted = confidence >= threshold
+    report = {
+        "held_out_pairs": int(is_held_out.sum()), "top1_accuracy": float(correct.mean()),
+        "recall@25": float((ids == gold[:, None]).any(axis=1).mean()), "threshold": threshold,
+        "coverage": float(accepted.mean()), "precision": float(correct[accepted].mean()) if accepted.any() else None,
+    }
+
+    model = MisconceptionClassifier.fit(rows)
+    model.threshold = threshold
+    sources = [q_data_path, mis_data_path] + ([paraphrase_path] if paraphrase_path else [])
+    model.save(out_dir, {"sources": _source_stamp(*sources), "held_out": report})
+    return report
+
+
+@lru_cache(maxsize=4)
+def load_misconception_classifier(q_data_path: str = "./data/train.csv",
+                                  mis_data_path: str = "./data/misconception_mapping.csv",
+                                  paraphrase_path: Optional[str] = "./data/math_sent.json",
+                                  model_dir: str = "./data/misconception_classifier") -> MisconceptionClassifier:
+    """The classifier in `model_dir`, (re)trained first if it is missing or older than its training data."""
+    sources = [q_data_path, mis_data_path] + ([paraphrase_path] if paraphrase_path else [])
+    try:
+        with open(os.path.join(model_dir, "meta.json")) as f:
+            meta = json.load(f)
+        fresh = meta.get("version") == MODEL_VERSION and meta.get("sources") == _source_stamp(*sources)
+    except (OSError, ValueError):
+        fresh = False
+    if not fresh:
+        train(q_data_path, mis_data_path, paraphrase_path, model_dir)
+    return MisconceptionClassifier.load(model_dir, mis_data_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the kNN misconception classifier.")
+    parser.add_argument("--train", default="./data/train.csv")
+    parser.add_argument("--misconceptions", default="./data/misconception_mapping.csv")
+    parser.add_argument("--paraphrases", default="./data/math_sent.json", help="'' to train without paraphrases")
+    parser.add_argument("--out", default="./data/misconception_classifier")
+    parser.add_argument("--precision", type=float, default=TARGET_PRECISION,
+                        help="held-out precision the confidence threshold must reach")
+    parser.add_argument("--holdout", type=float, default=0.2, help="share of questions held out for calibration")
+    args = parser.parse_args()
+    report = train(args.train, args.misconceptions, args.paraphrases or None, args.out, args.precision, args.holdout)
+    print(json.dumps(report, indent=2))
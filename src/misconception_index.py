@@ -0,0 +1,215 @@
+import argparse
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+
+#########################################################################################################################
+# Hybrid lexical + dense index over misconception names
+#
+# Misconception names are short and keyword-heavy, so exact term matches matter as much as meaning.
+# The index keeps, per MisconceptionName row:
+#   * a BM25 inverted index: the saturated, length-normalized term weights of every name as a CSR
+#     matrix, so a batch of queries is scored with one sparse matrix product;
+#   * optionally the embeddings of the names (embedding_service.py), scored with one dense product.
+# The two rankings are combined with reciprocal rank fusion. Without an embedding model the index
+# is purely lexical and needs nothing but scikit-learn.
+#
+#   python src/misconception_index.py --misconceptions data/misconception_mapping.csv --out data/misconception_index [--dense]
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+# Reciprocal rank fusion: score = sum over rankings of 1 / (RRF_K + rank).
+RRF_K = 60
+# Depth of each ranking taken into the fusion; deeper entries add nothing.
+FUSION_DEPTH = 200
+
+
+def _source_stamp(path: str) -> list:
+    return [os.path.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size]
+
+
+def _vectorizer(vocabulary=None) -> CountVectorizer:
+    return CountVectorizer(ngram_range=(1, 2), vocabulary=vocabulary, dtype=np.float32)
+
+
+def bm25_weights(counts: sp.csr_matrix, k1: float = 1.2, b: float = 0.75) -> sp.csr_matrix:
+    """Document-term BM25 weights: idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len / avg_len))."""
+    counts = sp.csr_matrix(counts, dtype=np.float32)
+    n_docs = counts.shape[0]
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+    lengths = np.asarray(counts.sum(axis=1)).ravel()
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1e-9))
+    weights = counts.copy()
+    tf = weights.data
+    weights.data = idf[weights.indices] * tf * (k1 + 1) / (tf + np.repeat(norm, np.diff(weights.indptr)))
+    return weights
+
+
+def build_index(mis_data_path: str, out_dir: str, embed: Optional[Callable[[List[str]], np.ndarray]] = None,
+                embedding_model: Optional[str] = None):
+    """Write the BM25 index (and, with `embed`, the name embeddings) of misconception_mapping.csv to `out_dir`."""
+    os.makedirs(out_dir, exist_ok=True)
+    mis_data = pd.read_csv(mis_data_path)
+    names = mis_data["MisconceptionName"].astype(str).tolist()
+    np.save(os.path.join(out_dir, "ids.npy"), mis_data["MisconceptionId"].to_numpy(dtype=np.int64))
+
+    vectorizer = _vectorizer().fit(names)
+    sp.save_npz(os.path.join(out_dir, "bm25.npz"), bm25_weights(vectorizer.transform(names)))
+    if embed is not None:
+        np.save(os.path.join(out_dir, "dense.npy"), np.asarray(embed(names), dtype=np.float32))
+
+    # The meta file is written last: an index without it is incomplete and gets rebuilt.
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"version": INDEX_VERSION, "source": _source_stamp(mis_data_path),
+                   "vocabulary": {term: int(i) for term, i in vectorizer.vocabulary_.items()},
+                   "embedding_model": embedding_model if embed is not None else None}, f)
+
+
+def rrf(*rankings: np.ndarray, n_columns: int, k: int = RRF_K) -> np.ndarray:
+    """(n, n_columns) reciprocal rank fusion scores of (n, depth) column rankings, best first; -1 entries are skipped."""
+    n_rows = rankings[0].shape[0]
+    # Skipped entries land in a scratch column that is dropped at the end.
+    fused = np.zeros((n_rows, n_columns + 1), dtype=np.float32)
+    rows = np.arange(n_rows)[:, None]
+    for ranking in rankings:
+        fused[rows, np.where(ranking < 0, n_columns, ranking)] += \
+            1.0 / (k + 1 + np.arange(ranking.shape[1], dtype=np.float32))
+    return fused[:, :n_columns]
+
+
+def top_columns(scores: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k best scores of each row, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(scores, top, axis=1).argsort(axis=1, kind="stable")[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
+
+class MisconceptionIndex:
+    def __init__(self, index_dir: str, embed: Optional[Callable[[List[str]], np.ndarray]] = None):
+        """embed: query embedder matching the stored name embeddings; without it, search is lexical only."""
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.ids: np.ndarray = np.load(os.path.join(index_dir, "ids.npy"))
+        self.vectorizer = _vectorizer(self.meta["vocabulary"])
+        # Term-major copy: query @ weights is then a CSR x CSR product with no transposition per call.
+        self.bm25 = sp.load_npz(os.path.join(index_dir, "bm25.npz")).T.tocsr()
+        dense_path = os.path.join(index_dir, "dense.npy")
+        self.dense = np.load(dense_path, mmap_mode="r") if embed is not None and os.path.exists(dense_path) else None
+        self.embed = embed if self.dense is not None else None
+
+    @classmethod
+    def open_or_build(cls, mis_data_path: str = "./data/misconception_mapping.csv",
+                      index_dir: str = "./data/misconception_index",
+                      embedding_model: Optional[str] = None) -> "MisconceptionIndex":
+        """
+        Open the index, (re)building it first if it is missing, older than the CSV or lacks the
+        embeddings of `embedding_model`. If the embedding model can't be loaded, the index is lexical.
+        """
+        embed = None
+        if embedding_model:
+            try:
+                from embedding_service import load_embedding_service
+                embed = load_embedding_service(embedding_model)
+            except Exception as e:
+                logger.warning("Embedding model %s unavailable (%r); misconception search is lexical only",
+                               embedding_model, e)
+        try:
+            with open(os.path.join(index_dir, "meta.json")) as f:
+                meta = json.load(f)
+            fresh = meta.get("version") == INDEX_VERSION and meta.get("source") == _source_stamp(mis_data_path)
+            if embed is not None:
+                fresh = fresh and meta.get("embedding_model") == embedding_model
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            try:
+                build_index(mis_data_path, index_dir, embed, embedding_model)
+            except Exception as e:
+                if embed is None:
+                    raise
+                logger.warning("Embedding misconception names failed (%r); misconception search is lexical only", e)
+                embed = None
+                build_index(mis_data_path, index_dir)
+        return cls(index_dir, embed)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lexical_scores(self, texts: Sequence[str]) -> sp.csr_matrix:
+        """(len(texts), len(self)) sparse BM25 scores; names sharing no term with a query score 0."""
+        queries = self.vectorizer.transform(texts)
+        queries.data[:] = 1.0
+        return (queries @ self.bm25).tocsr()
+
+    def dense_scores(self, texts: Sequence[str]) -> Optional[np.ndarray]:
+        """(len(texts), len(self)) cosine similarities, or None for a lexical-only index."""
+        if self.embed is None:
+            return None
+        try:
+            return np.asarray(self.embed(list(texts)), dtype=np.float32) @ np.asarray(self.dense).T
+        except Exception as e:
+            logger.warning("Dense misconception search failed (%r); using lexical scores only", e)
+            return None
+
+    def fuse(self, lexical: sp.csr_matrix, dense: Optional[np.ndarray], rows: Optional[np.ndarray] = None,
+             depth: int = FUSION_DEPTH) -> np.ndarray:
+        """
+        Reciprocal rank fusion of lexical_scores() and dense_scores() restricted to the names at
+        `rows` (all names if None), scaled so that a name ranked first by every retriever scores 1.
+        """
+        if rows is not None:
+            lexical = lexical[:, rows]
+            dense = dense[:, rows] if dense is not None else None
+        lexical = lexical.toarray()
+        ranking = top_columns(lexical, depth)
+        # Names sharing no term with the query are left out of the lexical ranking instead of tied at 0.
+        rankings = [np.where(np.take_along_axis(lexical, ranking, axis=1) > 0, ranking, -1)]
+        if dense is not None:
+            rankings.append(top_columns(dense, depth))
+        return rrf(*rankings, n_columns=lexical.shape[1]) * (RRF_K + 1) / len(rankings)
+
+    def scores(self, texts: Sequence[str], rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """(len(texts), len(rows)) fused scores of the names at `rows` (all names if None)."""
+        return self.fuse(self.lexical_scores(texts), self.dense_scores(texts), rows)
+
+    def search(self, texts: Sequence[str], k: int = 25) -> np.ndarray:
+        """(len(texts), k) MisconceptionIds, best first."""
+        if not len(texts):
+            return np.zeros((0, k), dtype=np.int64)
+        return self.ids[top_columns(self.scores(texts), k)]
+
+
+@lru_cache(maxsize=4)
+def load_misconception_index(mis_data_path: str = "./data/misconception_mapping.csv",
+                             index_dir: str = "./data/misconception_index",
+                             embedding_model: Optional[str] = None) -> MisconceptionIndex:
+    return MisconceptionIndex.open_or_build(mis_data_path, index_dir, embedding_model)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the hybrid lexical + dense misconception name index.")
+    parser.add_argument("--misconceptions", default="./data/misconception_mapping.csv")
+    parser.add_argument("--out", default="./data/misconception_index")
+    parser.add_argument("--dense", nargs="?", const="sentence-transformers/all-MiniLM-L6-v2", default=None,
+                        metavar="MODEL", help="also embed the names with this sentence-transformers model")
+    args = parser.parse_args()
+    embed = None
+    if args.dense:
+        from embedding_service import load_embedding_service
+        embed = load_embedding_service(args.dense)
+    build_index(args.misconceptions, args.out, embed, args.dense)
+    index = MisconceptionIndex(args.out, embed)
+    print(f"Built misconception index in {args.out}: {len(index)} names, {index.bm25.shape[0]} terms, "
+          f"{'dense + lexical' if index.dense is not None else 'lexical only'}")
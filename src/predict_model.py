@@ -1,9 +1,21 @@
 import time
+import logging
 import pdb
-from typing import Literal
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Literal, Optional
 
 import dspy
 
+from metrics import metrics_context
+from resilience import AgentError, LMDeadlineExceeded, current_deadline, deadline_scope
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Budget of the current forward call; _ask records the agents it left out on it.
+_current_budget: ContextVar[Optional["RoundBudget"]] = ContextVar("current_budget", default=None)
+
 #########################################################################################################################
 # The main model (ultilizing all agents together)
 
@@ -23,8 +35,73 @@ class SharedMemoryPool:
         return self.memories[-k:] if len(self.memories) > k else self.memories
 
 
+@contextmanager
+def _round(number):
+    # Calls made in the block are attributed to this round in metrics and traces.
+    with metrics_context(round=number), span(f"round {number}", round=number):
+        yield
+
+
+class ExchangeResult(str):
+    """Final thought_a of an exchange, with how many of the configured rounds actually ran and which agents failed."""
+
+    def __new__(cls, thought, rounds_completed: int = 0, rounds: int = 0, truncated: bool = False,
+                failed_agents: tuple = ()):
+        result = super().__new__(cls, thought)
+        result.rounds_completed = rounds_completed
+        result.rounds = rounds
+        result.truncated = truncated
+        result.failed_agents = failed_agents
+        return result
+
+
+class RoundBudget:
+    """Yields round numbers while the deadline leaves time for another round like the last one."""
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline
+        self.rounds_completed = 0
+        self.truncated = False
+        # Names of the agents whose calls failed; _ask left their thoughts out.
+        self.failed_agents = []
+        self._mark = time.monotonic()
+
+    def rounds(self, count: int):
+        for number in range(1, count + 1):
+            now = time.monotonic()
+            # The first estimate is the time the initial thoughts took.
+            last_duration, self._mark = now - self._mark, now
+            # An agent of the last round ran out of time (see agent_failed): that round is incomplete.
+            if self.truncated:
+                return
+            if number > 1:
+                self.rounds_completed += 1
+            if self.deadline is not None and now + last_duration > self.deadline:
+                self.truncated = True
+                return
+            yield number
+        if count > 0 and not self.truncated:
+            self.rounds_completed += 1
+
+    def agent_failed(self, error: AgentError):
+        """Record a failed agent call; one that ran out of time truncates the exchange."""
+        self.failed_agents.append(error.agent)
+        if _caused_by_deadline(error):
+            self.truncated = True
+
+
+def _caused_by_deadline(error: BaseException) -> bool:
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, LMDeadlineExceeded):
+            return True
+        seen.add(id(error))
+        error = getattr(error, "cause", None) or error.__cause__ or error.__context__
+    return False
+
+
 class ExchangeOfThought(dspy.Module):
-    def __init__(self, agent_a, agent_b, agent_c, agent_d=None, agent_e=None, rounds: int = 1, mode: Literal["Debate", "Report", "Memory", "Relay"] = "Report"):
+    def __init__(self, agent_a, agent_b, agent_c, agent_d=None, agent_e=None, rounds: int = 1, mode: Literal["Debate", "Report", "Memory", "Relay"] = "Report", rule_engine=None, timeout: Optional[float] = None, classifier=None, semantic_cache=None):
         super().__init__()
         self.agent_a = agent_a
         self.agent_b = agent_b
@@ -34,87 +111,173 @@ class ExchangeOfThought(dspy.Module):
         self.memory_pool = SharedMemoryPool()
         self.rounds = rounds
         self.mode = mode
-
-    def forward(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer):
+        # Optional rule_engine.RuleEngine: wrong answers it can reproduce skip the agents entirely.
+        self.rule_engine = rule_engine
+        # Optional misconception_classifier.MisconceptionClassifier: answers it is confident about skip the agents.
+        self.classifier = classifier
+        # Optional semantic_cache.SemanticCache: near-duplicates of answered questions reuse their result.
+        self.semantic_cache = semantic_cache
+        # Default time budget (seconds) of a forward call; None means no deadline.
+        self.timeout = timeout
+
+    def forward(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, timeout: Optional[float] = None):
+        """
+        timeout: seconds the whole exchange may take (default self.timeout). Every agent and LM call
+        inherits the deadline; rounds that would not finish in time are skipped and the best
+        thought_a so far is returned with `truncated=True`.
+        """
+        if self.rule_engine is not None:
+            with span("rule_engine.match") as current:
+                rule_match = self.rule_engine.match(QuestionText, AnswerText, CorrectAnswer)
+                if current is not None:
+                    current.set_attribute("rule", rule_match.rule if rule_match else None)
+            if rule_match is not None:
+                return ExchangeResult(rule_match.misconception, rounds=self.rounds)
+
+        if self.classifier is not None:
+            with span("classifier.answer") as current:
+                misconception_id = self.classifier.answer(QuestionText, ConstructName, AnswerText)
+                if current is not None:
+                    current.set_attribute("misconception_id", misconception_id)
+            if misconception_id is not None and misconception_id in self.classifier.misconception_names:
+                return ExchangeResult(self.classifier.misconception_names[misconception_id], rounds=self.rounds)
+
+        if self.semantic_cache is not None:
+            with span("semantic_cache.lookup") as current:
+                hit = self.semantic_cache.lookup(QuestionText, AnswerText, CorrectAnswer)
+                if current is not None:
+                    current.set_attribute("similarity", hit.similarity if hit else None)
+            if hit is not None:
+                return ExchangeResult(hit.result, rounds=self.rounds)
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with deadline_scope(deadline):
+            budget = RoundBudget(current_deadline())
+            token = _current_budget.set(budget)
+            try:
+                result = self._run_mode(budget, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
+            finally:
+                _current_budget.reset(token)
+        failed_agents = budget.failed_agents
+
+        if budget.truncated:
+            logger.info("%s mode stopped after %d of %d rounds to meet its deadline", self.mode, budget.rounds_completed, self.rounds)
+        # Only complete exchanges, with every agent's thought, are worth reusing.
+        if self.semantic_cache is not None and isinstance(result, str) and not budget.truncated and not failed_agents:
+            self.semantic_cache.store(QuestionText, AnswerText, CorrectAnswer, result)
+        if isinstance(result, str):
+            return ExchangeResult(result, budget.rounds_completed, self.rounds, budget.truncated, tuple(failed_agents))
+        return result
+
+    def _run_mode(self, budget, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer):
         if self.mode == "Report":
-            return self._report_mode(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
+            return self._report_mode(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, budget)
         elif self.mode == "Debate":
-            return self._debate_mode(QuestionText)
+            return self._debate_mode(QuestionText, budget)
         elif self.mode == "Memory":
-            return self._memory_mode(QuestionText)
+            return self._memory_mode(QuestionText, budget)
         elif self.mode == "Relay":
-            return self._relay_mode(QuestionText)
+            return self._relay_mode(QuestionText, budget)
         elif self.mode == "multi":
             return self._multi_mode(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
         elif self.mode == "multi_4":
-            return self._multi4_mode(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
+            return self._multi4_mode(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, budget)
         elif self.mode == "bigram":
-            return self._bigram_mode(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
+            return self._bigram_mode(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, budget)
         else:
             raise ValueError(f"Invalid mode: {self.mode}")
 
-    def _report_mode(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer):
+    def _ask(self, agent, fallback, *args, **kwargs):
+        """Call an agent; on AgentError return `fallback` so a failed agent adds nothing to the exchange."""
+        try:
+            return agent(*args, **kwargs)
+        except AgentError as e:
+            logger.warning("%s; continuing without its thought", e)
+            budget = _current_budget.get()
+            if budget is not None:
+                budget.agent_failed(e)
+            return fallback
+
+    @staticmethod
+    def _students_ideas(thought_b, thought_c):
+        prompt = "For this question's misconception, "
+        if thought_b is not None:
+            prompt += f"student b's ideas is \n{thought_b}\n"
+        if thought_c is not None:
+            prompt += f"student c's ideas is \n{thought_c}\n"
+        return prompt
+
+    def _report_mode(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, budget=None):
         # Step 1: A initiates thought
         thought_a = self.agent_a(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
         # pdb.set_trace()
 
         # Note this for-loop does not keep history of previous rounds, but it includes the chain of toughts if the agents
-        for _ in range(self.rounds):
-            # Step 2: A sends thought to B and C
-            agent_a_history = f"Agent A concludes: ({str(thought_a)})"
-            thought_b = self.agent_b(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
-            thought_c = self.agent_c(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
-
-            # Step 3: A receives feedback from B and C, then combines thoughts
-            combined_thoughts = (f"Agent B concludes: ({str(thought_b)}) /n"
-                                 f"Agent C concludes:  ({str(thought_c)})")
-            thought_a = self.agent_a(
-                QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=combined_thoughts)
+        for round_number in (budget or RoundBudget()).rounds(self.rounds):
+            with _round(round_number):
+                # Step 2: A sends thought to B and C
+                agent_a_history = f"Agent A concludes: ({str(thought_a)})"
+                thought_b = self._ask(self.agent_b, None, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
+                thought_c = self._ask(self.agent_c, None, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
+                if thought_b is None and thought_c is None:
+                    continue
+
+                # Step 3: A receives feedback from B and C, then combines thoughts
+                combined_thoughts = ""
+                if thought_b is not None:
+                    combined_thoughts += f"Agent B concludes: ({str(thought_b)}) /n"
+                if thought_c is not None:
+                    combined_thoughts += f"Agent C concludes:  ({str(thought_c)})"
+                thought_a = self._ask(self.agent_a, thought_a,
+                    QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=combined_thoughts)
 
         return thought_a
 
-    def _debate_mode(self, question):
+    def _debate_mode(self, question, budget=None):
         # Step 1: B and C initiate thought
-        thought_b = self.agent_b.forward(question)
-        thought_c = self.agent_c.forward(question)
+        thought_b = self.agent_b(question)
+        thought_c = self.agent_c(question)
 
-        for _ in range(self.rounds):
-            # Step 2: B and C communicates back and forth
-            thought_b = self.agent_b.forward(question, context=thought_c)
-            thought_c = self.agent_c.forward(question, context=thought_b)
+        for round_number in (budget or RoundBudget()).rounds(self.rounds):
+            with _round(round_number):
+                # Step 2: B and C communicates back and forth
+                thought_b = self.agent_b(question, context=thought_c)
+                thought_c = self.agent_c(question, context=thought_b)
 
         # Step 3: B and C send their final thoughts to A
         combined_thoughts = f"Agent B concludes: ({thought_b}), Agent C concludes: ({thought_c})"
-        thought_a = self.agent_a.forward(question, context=combined_thoughts)
+        thought_a = self.agent_a(question, context=combined_thoughts)
         thought_a.question = question
 
         return thought_a
 
-    def _memory_mode(self, question):
-        thought_a = self.agent_a.forward(question)
-        thought_b = self.agent_b.forward(question)
-        thought_c = self.agent_c.forward(question)
+    def _memory_mode(self, question, budget=None):
+        thought_a = self.agent_a(question)
+        thought_b = self.agent_b(question)
+        thought_c = self.agent_c(question)
         self.memory_pool.add_memory(thought_a, 'Agent_a')
         self.memory_pool.add_memory(thought_b, 'Agent_b')
         self.memory_pool.add_memory(thought_c, 'Agent_c')
 
-        for _ in range(self.rounds - 1):
-            self.memory_pool.add_memory(self.agent_a.forward(
-                question,
-                context=self.memory_pool.get_relevant_memories()
-            ), 'Agent_a')
+        for round_number in (budget or RoundBudget()).rounds(self.rounds - 1):
+            with _round(round_number):
+                self.memory_pool.add_memory(self.agent_a(
+                    question,
+                    context=self.memory_pool.get_relevant_memories()
+                ), 'Agent_a')
 
-            self.memory_pool.add_memory(self.agent_b.forward(
-                question,
-                context=self.memory_pool.get_relevant_memories()
-            ), 'Agent_b')
+                self.memory_pool.add_memory(self.agent_b(
+                    question,
+                    context=self.memory_pool.get_relevant_memories()
+                ), 'Agent_b')
 
-            self.memory_pool.add_memory(self.agent_c.forward(
-                question,
-                context=self.memory_pool.get_relevant_memories()
-            ), 'Agent_c')
+                self.memory_pool.add_memory(self.agent_c(
+                    question,
+                    context=self.memory_pool.get_relevant_memories()
+                ), 'Agent_c')
 
-        thought_a = self.agent_a.forward(
+        thought_a = self.agent_a(
             question,
             context=self.memory_pool.get_relevant_memories(k=100)
         )
@@ -123,52 +286,61 @@ class ExchangeOfThought(dspy.Module):
 
         return thought_a
 
-    def _relay_mode(self, question):
-        thought_a = self.agent_a.forward(question)
+    def _relay_mode(self, question, budget=None):
+        thought_a = self.agent_a(question)
 
-        for _ in range(self.rounds):
-            thought_b = self.agent_b.forward(question, context=thought_a)
-            thought_c = self.agent_b.forward(question, context=thought_b)
-            thought_a = self.agent_b.forward(question, context=thought_c)
+        for round_number in (budget or RoundBudget()).rounds(self.rounds):
+            with _round(round_number):
+                thought_b = self.agent_b(question, context=thought_a)
+                thought_c = self.agent_b(question, context=thought_b)
+                thought_a = self.agent_b(question, context=thought_c)
 
         thought_a.question = question
 
         return thought_a
     
-    def _multi4_mode(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer):
+    def _multi4_mode(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, budget=None):
         # Step 1: A initiates thought
         thought_a = self.agent_a(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
 
 
-        for _ in range(self.rounds):
+        for round_number in (budget or RoundBudget()).rounds(self.rounds):
+            with _round(round_number):
+                agent_a_history = f"Agent A concludes: ({str(thought_a)})"
+                thought_b = self._ask(self.agent_b, None, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
+                thought_c = self._ask(self.agent_c, None, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
+                if thought_b is None and thought_c is None:
+                    continue
 
-            agent_a_history = f"Agent A concludes: ({str(thought_a)})"
-            thought_b = self.agent_b(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
-            thought_c = self.agent_c(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=agent_a_history)
+                prompt = self._students_ideas(thought_b, thought_c)
 
-            prompt = f"For this question's misconception, student b's ideas is \n{thought_b}\nstudent c's ideas is \n{thought_c}\n"
+                # Without D's synthesis, A reads B's and C's ideas directly.
+                thought_d = self._ask(self.agent_d, prompt, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=prompt)
 
-            thought_d = self.agent_d.forward(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=prompt)
-
-            thought_a = self.agent_a.forward(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_d)
+                thought_a = self._ask(self.agent_a, thought_a, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_d)
 
         return thought_a
     
-    def _bigram_mode(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer):
+    def _bigram_mode(self, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, budget=None):
         # Step 1: A initiates thought
         thought_a = self.agent_a(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer)
 
-        for _ in range(self.rounds):
-
-            thought_b = self.agent_b.forward(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_a)
-            thought_c = self.agent_c.forward(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_a)
+        for round_number in (budget or RoundBudget()).rounds(self.rounds):
+            with _round(round_number):
+                thought_b = self._ask(self.agent_b, None, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_a)
+                thought_c = self._ask(self.agent_c, None, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_a)
 
-            thought_b = self.agent_b.forward(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_c)
-            thought_c = self.agent_c.forward(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_b)
+                # A failed exchange keeps the agent's previous thought instead of replying to nothing.
+                if thought_c is not None:
+                    thought_b = self._ask(self.agent_b, thought_b, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_c)
+                if thought_b is not None:
+                    thought_c = self._ask(self.agent_c, thought_c, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=thought_b)
+                if thought_b is None and thought_c is None:
+                    continue
 
-            prompt = f"For this question's misconception, student b's ideas is \n{thought_b}\nstudent c's ideas is \n{thought_c}\n"
+                prompt = self._students_ideas(thought_b, thought_c)
 
-            thought_a = self.agent_a.forward(QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=prompt)
+                thought_a = self._ask(self.agent_a, thought_a, QuestionText, AnswerText, ConstructName, SubjectName, CorrectAnswer, context=prompt)
 
         return thought_a
 
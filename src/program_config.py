@@ -0,0 +1,261 @@
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, Iterator, Literal, Optional, Tuple
+
+import dspy
+
+from util import Persona, PrefixedChatAdapter
+
+#########################################################################################################################
+# Declarative ExchangeOfThought configuration
+#
+# ExchangeOfThought holds live agents (predictors, demos, LM clients), and config.py sets the LM
+# globally with dspy.configure, so a program can't be shipped to another process. A ProgramConfig
+# is plain data (picklable and JSON-serializable) describing everything the program is built from:
+# mode, rounds, agent types and personas, the LM or model router, the compiled demos and the
+# optional fast paths. `build()` returns the program together with its own LM/adapter/callbacks,
+# applied with dspy.context around each call, so building one changes no process-wide settings.
+#
+# `process_pool(config)` starts spawn workers that each build the program once, in their
+# initializer; tasks only carry the ExchangeOfThought inputs. The CPU-bound parts of a call (demo
+# and misconception retrieval, the fast paths, prompt formatting and output parsing) then run on
+# all cores instead of taking turns on the GIL of one process.
+#
+#   config = ProgramConfig(mode="Report", rounds=2, lm="router")
+#   with process_pool(config, workers=4) as pool:
+#       results = list(pool.map(predict, tasks))
+#
+# `config_meta(config, lm)` describes the configuration (its JSON, the compiled demos and the models
+# behind the LM) with a version tag; stored results (materialized predictions, the semantic cache)
+# are only served to a program with the same tag.
+
+logger = logging.getLogger(__name__)
+
+AGENT_NAMES = ("Agent A", "Agent B", "Agent C", "Agent D", "Agent E")
+# Bump when a change to the program makes results of the same configuration differ.
+CONFIG_VERSION = 2
+
+
+def _persona_names() -> dict:
+    return {text: name for name, text in vars(Persona).items() if not name.startswith("_") and isinstance(text, str)}
+
+
+@dataclass(frozen=True)
+class AgentConfig:
+    name: str
+    kind: Literal["advanced", "basic"] = "advanced"
+    # A Persona attribute ("AGENT_A_new") or the persona text itself; None for no persona.
+    persona: Optional[str] = None
+    speculative_samples: int = 1
+
+    @property
+    def persona_text(self) -> Optional[str]:
+        return getattr(Persona, self.persona, self.persona) if self.persona else None
+
+
+@dataclass(frozen=True)
+class ProgramConfig:
+    mode: Literal["Debate", "Report", "Memory", "Relay"] = "Report"
+    rounds: int = 1
+    agents: Tuple[AgentConfig, ...] = tuple(AgentConfig(name) for name in AGENT_NAMES)
+    # "lambda"/"openai" as in util.LanguageModel, or "router" for routing.load_router.
+    lm: Literal["lambda", "openai", "router"] = "lambda"
+    max_tokens: int = 100
+    # (cheap, strong) models of the router; None uses its defaults.
+    router_models: Optional[Tuple[str, str]] = None
+    compiled_path: Optional[str] = "./compiled_model.dspy"
+    # Demo selection of the adapter: None sends every compiled demo, else "tfidf" or "dense".
+    demo_selector: Optional[str] = None
+    timeout: Optional[float] = None
+    reasoning_store_path: Optional[str] = None
+    rule_engine: bool = False
+    classifier: bool = False
+    semantic_cache_path: Optional[str] = None
+    q_data_path: str = "./data/train.csv"
+    mis_data_path: str = "./data/misconception_mapping.csv"
+
+    @classmethod
+    def from_sweep(cls, config, **kwargs) -> "ProgramConfig":
+        """The ProgramConfig of a sweep.SweepConfig (advanced agents with its persona set)."""
+        from sweep import PERSONA_SETS
+
+        names = _persona_names()
+        agents = tuple(AgentConfig(name, persona=names.get(persona, persona))
+                       for name, persona in zip(AGENT_NAMES, PERSONA_SETS[config.personas]))
+        return cls(mode=config.mode, rounds=config.rounds, agents=agents, **kwargs)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, values: dict) -> "ProgramConfig":
+        values = dict(values)
+        values["agents"] = tuple(AgentConfig(**agent) for agent in values.get("agents", ()))
+        if values.get("router_models") is not None:
+            values["router_models"] = tuple(values["router_models"])
+        return cls(**values)
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, text: str) -> "ProgramConfig":
+        return cls.from_dict(json.loads(text))
+
+    def build_lm(self):
+        if self.lm == "router":
+            from routing import load_router
+            return load_router(self.max_tokens, *(self.router_models or (None, None)))
+        from util import LanguageModel
+        return LanguageModel(max_tokens=self.max_tokens, service=self.lm).lm
+
+    def settings(self, lm=None) -> dict:
+        """dspy settings of the program: the LM, an adapter of its own and the app's callbacks."""
+        from config import metrics_callback, tracing_callback
+
+        demo_selector = None
+        if self.demo_selector:
+            from demo_selector import load_demo_selector
+            demo_selector = load_demo_selector(self.q_data_path, self.mis_data_path, embedding=self.demo_selector)
+        return {"lm": lm or self.build_lm(), "adapter": PrefixedChatAdapter(demo_selector=demo_selector),
+                "callbacks": [metrics_callback, tracing_callback]}
+
+    def meta(self, lm=None) -> Dict[str, str]:
+        return config_meta(self, lm or self.build_lm())
+
+    def build_exchange(self, lm=None):
+        """
+        The ExchangeOfThought graph alone (it runs under whatever dspy settings are active).
+        lm: the LM it will run with, which the tag of its semantic cache entries depends on.
+        """
+        from agents import Agent, AdvancedAgent
+        from compiled_state import load_compiled_program
+        from predict_model import ExchangeOfThought
+
+        if not 3 <= len(self.agents) <= 5:
+            raise ValueError(f"ExchangeOfThought takes 3 to 5 agents, got {len(self.agents)}")
+        reasoning_store = None
+        if self.reasoning_store_path:
+            from reasoning_store import load_reasoning_store
+            reasoning_store = load_reasoning_store(self.reasoning_store_path)
+        agents = []
+        for agent in self.agents:
+            if agent.kind == "advanced":
+                agents.append(AdvancedAgent(name=agent.name, persona_promt=agent.persona_text,
+                                            speculative_samples=agent.speculative_samples,
+                                            reasoning_store=reasoning_store))
+            elif agent.kind == "basic":
+                agents.append(Agent(name=agent.name, persona_promt=agent.persona_text))
+            else:
+                raise ValueError(f"Unknown agent kind {agent.kind!r}; expected 'advanced' or 'basic'")
+
+        program = ExchangeOfThought(*agents, rounds=self.rounds, mode=self.mode, timeout=self.timeout)
+        if self.compiled_path:
+            load_compiled_program(program, self.compiled_path)
+        if self.rule_engine:
+            from rule_engine import load_rule_engine
+            rule_engine = load_rule_engine(self.mis_data_path)
+            if any(rule.precision >= rule_engine.min_precision for rule in rule_engine.rules):
+                program.rule_engine = rule_engine
+            else:
+                logger.warning("No rule of the rule engine is precise enough to answer; running without it")
+        if self.classifier:
+            from misconception_classifier import load_misconception_classifier
+            classifier = load_misconception_classifier(self.q_data_path, self.mis_data_path)
+            # A threshold no held-out precision could meet means it never answers; don't ask it on every call.
+            if math.isinf(classifier.threshold):
+                logger.warning("The misconception classifier has no usable threshold; running without it")
+            else:
+                program.classifier = classifier
+        if self.semantic_cache_path:
+            from semantic_cache import load_semantic_cache
+            program.semantic_cache = load_semantic_cache(self.semantic_cache_path, namespace=self.meta(lm)["tag"])
+        return program
+
+    def build(self, lm=None) -> "ConfiguredProgram":
+        lm = lm or self.build_lm()
+        return ConfiguredProgram(self.build_exchange(lm), self.settings(lm))
+
+
+# The program of the Streamlit pages, which src/materialize.py precomputes by default: cheap model for
+# the judge and agents B/C, strong model for Agent A's final answer, and 30 seconds per analysis. The
+# rule engine stays off: no rule reaches rule_engine.MIN_PRECISION on train.csv yet.
+APP_PROGRAM = ProgramConfig(mode="Report", rounds=2, lm="router", max_tokens=1000, demo_selector="tfidf", timeout=30,
+                            semantic_cache_path="./cache/semantic.sqlite3")
+
+
+def describe_lm(lm) -> str:
+    """Model name(s) behind an LM; a routing.ModelRouter is described by its tiers."""
+    tiers = getattr(lm, "tiers", None)
+    if tiers:
+        return "router(" + ",".join(f"{tier}={getattr(tier_lm, 'model', tier_lm)}" for tier, tier_lm in sorted(tiers.items())) + ")"
+    return str(getattr(lm, "model", lm))
+
+
+def _file_digest(path: Optional[str]) -> Optional[str]:
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def config_meta(config: ProgramConfig, lm) -> Dict[str, str]:
+    """Everything a result of the program depends on, plus its version tag."""
+    meta = {"version": str(CONFIG_VERSION), "program": config.to_json(),
+            "compiled": _file_digest(config.compiled_path) or "", "lm": describe_lm(lm)}
+    meta["tag"] = hashlib.sha1(json.dumps(meta, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return meta
+
+
+@dataclass
+class ConfiguredProgram:
+    """An ExchangeOfThought with the dspy settings it runs under."""
+    program: dspy.Module
+    settings: dict = field(default_factory=dict)
+
+    def __call__(self, **inputs):
+        with dspy.context(**self.settings):
+            return self.program(**inputs)
+
+
+#########################################################################################################################
+# Process pool: one program per worker process
+
+_worker_program: Optional[ConfiguredProgram] = None
+
+
+def _init_worker(config: ProgramConfig, lm_cache_dir: Optional[str] = None):
+    global _worker_program
+    if lm_cache_dir:
+        from sweep import use_shared_lm_cache
+        use_shared_lm_cache(lm_cache_dir)
+    _worker_program = config.build()
+
+
+def predict(inputs: dict):
+    """Run the worker's program on one set of ExchangeOfThought inputs (submitted to a process_pool)."""
+    if _worker_program is None:
+        raise RuntimeError("predict runs in the workers of process_pool()")
+    return _worker_program(**inputs)
+
+
+def process_pool(config: ProgramConfig, workers: int = 4, lm_cache_dir: Optional[str] = None) -> ProcessPoolExecutor:
+    """
+    Spawn workers that build `config` once each; submit `predict` with the inputs of a call.
+    lm_cache_dir: the shared LM response cache (sweep.use_shared_lm_cache) of the workers.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(config, lm_cache_dir))
+
+
+def map_predictions(config: ProgramConfig, inputs: Iterable[dict], workers: int = 4,
+                    lm_cache_dir: Optional[str] = None) -> Iterator:
+    """Results of the program for every set of inputs, in order."""
+    with process_pool(config, workers, lm_cache_dir) as pool:
+        yield from pool.map(predict, inputs)
@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+#########################################################################################################################
+# Columnar, pre-indexed question store
+#
+# train.csv and misconception_mapping.csv are converted once into a directory of .npy files:
+# every text column is one UTF-8 byte buffer plus an offsets array (Arrow-style), numeric columns
+# are plain arrays, and misconception names are indexed by MisconceptionId. Files are opened with
+# mmap, so a row lookup is O(1) and only the pages actually touched become resident. A rebuild
+# writes a new sibling directory and swaps it in, so readers keep their mmaps of the old files.
+#
+#   python src/question_store.py --train data/train.csv --misconceptions data/misconception_mapping.csv --out data/question_store
+
+STORE_VERSION = 1
+
+OPTIONS = ("A", "B", "C", "D")
+# Columns shown as Markdown; LaTeX delimiters are converted at build time.
+WRAPPED_COLUMNS = ("QuestionText", "AnswerAText", "AnswerBText", "AnswerCText", "AnswerDText")
+TEXT_COLUMNS = WRAPPED_COLUMNS + ("ConstructName", "SubjectName", "CorrectAnswer")
+ID_COLUMNS = ("QuestionId", "ConstructId", "SubjectId") + tuple(f"Misconception{o}Id" for o in OPTIONS)
+MISSING_ID = -1
+
+
+def wrap_latex(text: str) -> str:
+    """Convert LaTeX delimiters to Markdown-friendly format."""
+    return text.replace("\\[", "$").replace("\\]", "$") \
+               .replace("\\(", "$").replace("\\)", "$")
+
+
+class StringColumn:
+    """Read-only column of strings stored as one UTF-8 buffer and int64 offsets."""
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    @staticmethod
+    def save(path_prefix: str, values):
+        encoded = [str(value).encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        np.save(f"{path_prefix}.offsets.npy", offsets)
+        np.save(f"{path_prefix}.data.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path_prefix: str, mmap_mode: Optional[str] = "r") -> "StringColumn":
+        return cls(np.load(f"{path_prefix}.offsets.npy", mmap_mode=mmap_mode),
+                   np.load(f"{path_prefix}.data.npy", mmap_mode=mmap_mode))
+
+
+def _source_stamp(*paths) -> list:
+    return [[os.path.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths]
+
+
+def build_store(q_data_path: str, mis_data_path: str, out_dir: str):
+    """Convert the CSV datasets into the columnar store in `out_dir`, replacing any previous store."""
+    out_dir = os.path.abspath(out_dir)
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=f".{os.path.basename(out_dir)}.", dir=os.path.dirname(out_dir))
+    try:
+        _write_store(q_data_path, mis_data_path, build_dir)
+        _swap_in(build_dir, out_dir)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def _swap_in(build_dir: str, out_dir: str):
+    # os.replace only renames a directory over an empty one, so the old store is moved aside first.
+    # Its files stay valid for readers that have them open or mapped until they let go.
+    old_dir = f"{build_dir}.old"
+    try:
+        os.replace(out_dir, old_dir)
+    except FileNotFoundError:
+        pass
+    try:
+        os.replace(build_dir, out_dir)
+    except OSError:
+        # Another process swapped in its build first; it is built from the same CSVs.
+        if not os.path.exists(os.path.join(out_dir, "meta.json")):
+            raise
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _write_store(q_data_path: str, mis_data_path: str, out_dir: str):
+    data = pd.read_csv(q_data_path)
+    mis_data = pd.read_csv(mis_data_path)
+
+    for column in TEXT_COLUMNS:
+        values = data[column].fillna("").astype(str)
+        if column in WRAPPED_COLUMNS:
+            values = values.map(wrap_latex)
+        StringColumn.save(os.path.join(out_dir, column), values)
+    for column in ID_COLUMNS:
+        np.save(os.path.join(out_dir, f"{column}.npy"), data[column].fillna(MISSING_ID).astype(np.int32).to_numpy())
+
+    # Dense MisconceptionId -> row index, so lookups don't depend on the CSV being sorted by id.
+    misconception_ids = mis_data["MisconceptionId"].astype(np.int64).to_numpy()
+    id_to_row = np.full(misconception_ids.max() + 1, MISSING_ID, dtype=np.int32)
+    id_to_row[misconception_ids] = np.arange(len(misconception_ids), dtype=np.int32)
+    np.save(os.path.join(out_dir, "misconception_id_to_row.npy"), id_to_row)
+    StringColumn.save(os.path.join(out_dir, "MisconceptionName"), mis_data["MisconceptionName"].astype(str))
+
+    # The meta file is written last: a store without it is incomplete and gets rebuilt.
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"version": STORE_VERSION, "rows": len(data), "sources": _source_stamp(q_data_path, mis_data_path)}, f)
+
+
+class QuestionStore:
+    def __init__(self, store_dir: str):
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.text: Dict[str, StringColumn] = {
+            column: StringColumn.load(os.path.join(store_dir, column)) for column in TEXT_COLUMNS
+        }
+        self.ids: Dict[str, np.ndarray] = {
+            column: np.load(os.path.join(store_dir, f"{column}.npy"), mmap_mode="r") for column in ID_COLUMNS
+        }
+        self._id_to_row = np.load(os.path.join(store_dir, "misconception_id_to_row.npy"), mmap_mode="r")
+        self._misconception_names = StringColumn.load(os.path.join(store_dir, "MisconceptionName"))
+
+    @classmethod
+    def open_or_build(cls, q_data_path: str = "./data/train.csv", mis_data_path: str = "./data/misconception_mapping.csv",
+                      store_dir: str = "./data/question_store") -> "QuestionStore":
+        """Open the store, (re)building it first if it is missing or older than the CSVs."""
+        meta_path = os.path.join(store_dir, "meta.json")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            fresh = meta.get("version") == STORE_VERSION and meta.get("sources") == _source_stamp(q_data_path, mis_data_path)
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            build_store(q_data_path, mis_data_path, store_dir)
+        return cls(store_dir)
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def question(self, index: int) -> dict:
+        """Row `index` in the format the quiz page displays (LaTeX already wrapped)."""
+        return {
+            'question_id': int(self.ids['QuestionId'][index]),
+            'question_text': self.text['QuestionText'][index],
+            'options': {option: self.text[f'Answer{option}Text'][index] for option in OPTIONS},
+            'correct_answer': self.text['CorrectAnswer'][index],
+            'construct_name': self.text['ConstructName'][index],
+            'subject_name': self.text['SubjectName'][index],
+            'misconceptions': {option: self.misconception_id(index, option) for option in OPTIONS},
+        }
+
+    def misconception_id(self, index: int, option: str) -> Optional[int]:
+        value = int(self.ids[f"Misconception{option}Id"][index])
+        return None if value == MISSING_ID else value
+
+    def misconception_name(self, misconception_id) -> Optional[str]:
+        """Name of a MisconceptionId, or None for missing/unknown ids."""
+        if misconception_id is None or not 0 <= int(misconception_id) < len(self._id_to_row):
+            return None
+        row = int(self._id_to_row[int(misconception_id)])
+        return None if row == MISSING_ID else self._misconception_names[row]
+
+
+@lru_cache(maxsize=4)
+def load_question_store(q_data_path: str = "./data/train.csv", mis_data_path: str = "./data/misconception_mapping.csv",
+                        store_dir: str = "./data/question_store") -> QuestionStore:
+    return QuestionStore.open_or_build(q_data_path, mis_data_path, store_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the columnar question store from the CSV datasets.")
+    parser.add_argument("--train", default="./data/train.csv")
+    parser.add_argument("--misconceptions", default="./data/misconception_mapping.csv")
+    parser.add_argument("--out", default="./data/question_store")
+    args = parser.parse_args()
+    build_store(args.train, args.misconceptions, args.out)
+    print(f"Built question store with {len(QuestionStore(args.out))} questions in {args.out}")
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Dict, Optional
+
+#########################################################################################################################
+# Correct-reasoning store
+#
+# The reasoning SolveAgent_api produces for a question depends on the question, its correct answer,
+# the agent's persona and the context the other agents gave it, but not on the wrong option or the
+# ExchangeOfThought mode. Stored here under all four, the reasoning of an agent's first call (no
+# context yet) is computed once per question and persona and reused by every option and
+# configuration (e.g. all runs of a sweep); later calls are only reused when their context repeats.
+# Entries never expire; delete the file to regenerate them.
+
+DEFAULT_REASONING_PATH = "./cache/reasoning.sqlite3"
+
+
+def reasoning_key(QuestionText: str, CorrectAnswer: str, context=None, persona: Optional[str] = None) -> str:
+    # Version 2: keys of the first version had neither context nor persona and are never matched.
+    parts = ("2", QuestionText, CorrectAnswer, "" if context is None else str(context), persona or "")
+    return hashlib.sha1("\x00".join(map(str, parts)).encode("utf-8")).hexdigest()
+
+
+class ReasoningStore:
+    def __init__(self, path: str = DEFAULT_REASONING_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS reasoning (
+                key TEXT PRIMARY KEY, reasoning TEXT NOT NULL, created REAL NOT NULL
+            )
+        """)
+        self.hits = 0
+        self.misses = 0
+        self._inflight: Dict[str, threading.Lock] = {}
+
+    def get(self, QuestionText: str, CorrectAnswer: str, context=None, persona: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT reasoning FROM reasoning WHERE key = ?",
+                                     (reasoning_key(QuestionText, CorrectAnswer, context, persona),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, QuestionText: str, CorrectAnswer: str, reasoning: str, context=None,
+            persona: Optional[str] = None) -> str:
+        """Store a reasoning and return the stored one: the first reasoning of a key wins."""
+        key = reasoning_key(QuestionText, CorrectAnswer, context, persona)
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO reasoning VALUES (?, ?, ?)", (key, str(reasoning), time.time()))
+            return self._conn.execute("SELECT reasoning FROM reasoning WHERE key = ?", (key,)).fetchone()[0]
+
+    def get_or_compute(self, QuestionText: str, CorrectAnswer: str, compute: Callable[[], str], context=None,
+                       persona: Optional[str] = None) -> str:
+        """The stored reasoning, computing it once even if several threads ask for it at the same time."""
+        reasoning = self.get(QuestionText, CorrectAnswer, context, persona)
+        if reasoning is not None:
+            return reasoning
+        key = reasoning_key(QuestionText, CorrectAnswer, context, persona)
+        with self._lock:
+            inflight = self._inflight.setdefault(key, threading.Lock())
+        with inflight:
+            reasoning = self.get(QuestionText, CorrectAnswer, context, persona)
+            if reasoning is None:
+                reasoning = self.put(QuestionText, CorrectAnswer, compute(), context, persona)
+        with self._lock:
+            self._inflight.pop(key, None)
+        return reasoning
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM reasoning").fetchone()[0]
+
+
+@lru_cache(maxsize=4)
+def load_reasoning_store(path: str = DEFAULT_REASONING_PATH) -> ReasoningStore:
+    """One store per file and process, so concurrent programs compute a reasoning once between them."""
+    return ReasoningStore(path)
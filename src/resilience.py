@@ -0,0 +1,334 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Callable, Dict, Mapping, Optional, TypeVar
+
+import dspy
+import openai
+
+#########################################################################################################################
+# Shared rate limiting and retries for every LM client
+#
+# One limiter per provider (lambda, openai, dashscope) is shared by all agents and threads of the
+# process. It keeps request and token buckets filled at the provider's per-minute limits and
+# corrects them from the x-ratelimit-* / retry-after headers of each response. Failed requests
+# are retried with full-jitter exponential backoff until a deadline, then surface as typed
+# errors instead of placeholder strings.
+
+logger = logging.getLogger(__name__)
+
+# (requests per minute, tokens per minute); overridable with e.g. OPENAI_RPM / OPENAI_TPM.
+DEFAULT_LIMITS = {
+    "openai": (500, 200_000),
+    "lambda": (60, 100_000),
+    "dashscope": (60, 100_000),
+}
+FALLBACK_LIMITS = (60, 100_000)
+DEFAULT_TIMEOUT = 60.0
+
+T = TypeVar("T")
+
+
+#########################################################################################################################
+# Typed errors
+
+
+class LMError(RuntimeError):
+    """An LM request failed and was not (or could no longer be) retried."""
+
+    def __init__(self, message: str, provider: Optional[str] = None):
+        super().__init__(message)
+        self.provider = provider
+
+
+class RateLimitExceeded(LMError):
+    """The provider kept rejecting requests with 429 until the deadline."""
+
+
+class LMUnavailable(LMError):
+    """Connection errors, timeouts or 5xx responses until the deadline."""
+
+
+class LMRequestError(LMError):
+    """The request itself was rejected (bad request, authentication, ...); retrying won't help."""
+
+
+class LMDeadlineExceeded(LMError):
+    """The deadline passed before the request could be sent or retried."""
+
+
+class AgentError(RuntimeError):
+    """An agent could not produce its output; raised instead of returning a placeholder string."""
+
+    def __init__(self, agent: str, cause: BaseException):
+        super().__init__(f"{agent} failed: {cause!r}")
+        self.agent = agent
+        self.cause = cause
+
+    def __reduce__(self):
+        # Errors of process-pool workers (program_config.py) are pickled back to the caller.
+        return type(self), (self.agent, self.cause)
+
+
+def classify_error(exception: BaseException, provider: Optional[str] = None) -> LMError:
+    """Map a client exception (openai or litellm) to a typed LMError."""
+    if isinstance(exception, LMError):
+        return exception
+    message = f"{provider or 'LM'} request failed: {exception}"
+    if isinstance(exception, openai.RateLimitError):
+        return RateLimitExceeded(message, provider)
+    if isinstance(exception, (openai.APIConnectionError, TimeoutError, ConnectionError)):
+        return LMUnavailable(message, provider)
+    status = getattr(exception, "status_code", None)
+    if status is not None and (status >= 500 or status in (408, 409)):
+        return LMUnavailable(message, provider)
+    return LMRequestError(message, provider)
+
+
+def is_retryable(error: LMError) -> bool:
+    return isinstance(error, (RateLimitExceeded, LMUnavailable))
+
+
+#########################################################################################################################
+# Rate limit headers
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value) -> Optional[float]:
+    """Seconds in an OpenAI-style reset header ("20ms", "1s", "6m0s") or a plain number."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _normalize_headers(headers: Optional[Mapping]) -> Dict[str, str]:
+    # litellm forwards provider headers with an "llm_provider-" prefix.
+    return {str(k).lower().removeprefix("llm_provider-"): v for k, v in (headers or {}).items()}
+
+
+def retry_after(headers: Optional[Mapping]) -> Optional[float]:
+    headers = _normalize_headers(headers)
+    milliseconds = parse_duration(headers.get("retry-after-ms"))
+    if milliseconds is not None:
+        return milliseconds / 1000
+    return parse_duration(headers.get("retry-after"))
+
+
+def _exception_headers(exception: BaseException) -> Optional[Mapping]:
+    response = getattr(exception, "response", None)
+    return getattr(response, "headers", None)
+
+
+#########################################################################################################################
+# Limiter
+
+
+class ProviderLimiter:
+    """Request and token buckets for one provider, shared by all threads."""
+
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float):
+        self.name = name
+        self.requests_per_minute = float(requests_per_minute)
+        self.tokens_per_minute = float(tokens_per_minute)
+        self._lock = threading.Lock()
+        self._requests = self.requests_per_minute
+        self._tokens = self.tokens_per_minute
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _wait_time(self, tokens: float, now: float) -> float:
+        wait = self._blocked_until - now
+        if self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens: int = 0, deadline: Optional[float] = None):
+        """Block until one request and `tokens` tokens are available; deadline is time.monotonic()."""
+        tokens = min(float(tokens), self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+            if deadline is not None and now + wait > deadline:
+                raise LMDeadlineExceeded(f"{self.name} rate limit would delay the request past its deadline", self.name)
+            time.sleep(min(wait, 1.0))
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the token bucket once the real usage of a request is known."""
+        with self._lock:
+            self._tokens = min(self.tokens_per_minute, self._tokens + min(estimated_tokens, self.tokens_per_minute) - actual_tokens)
+
+    def pause(self, seconds: float):
+        """Hold back every request to this provider for `seconds` (e.g. after a 429)."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers: Optional[Mapping]):
+        """Adopt the provider's own view of the limits from x-ratelimit-* headers."""
+        headers = _normalize_headers(headers)
+        if not headers:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            for kind in ("requests", "tokens"):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                try:
+                    # A limit of 0 (or garbage) would stall every request; keep the configured one.
+                    if limit is not None and float(limit) > 0:
+                        setattr(self, f"{kind}_per_minute", float(limit))
+                    if remaining is not None:
+                        setattr(self, f"_{kind}", min(getattr(self, f"_{kind}"), float(remaining)))
+                except ValueError:
+                    continue
+                if remaining is not None and float(remaining) <= 0:
+                    reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                    if reset:
+                        self._blocked_until = max(self._blocked_until, now + reset)
+
+
+_limiters: Dict[str, ProviderLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str) -> ProviderLimiter:
+    """The process-wide limiter of a provider, created from DEFAULT_LIMITS / environment on first use."""
+    with _limiters_lock:
+        if provider not in _limiters:
+            rpm, tpm = DEFAULT_LIMITS.get(provider, FALLBACK_LIMITS)
+            rpm = float(os.getenv(f"{provider.upper()}_RPM", rpm))
+            tpm = float(os.getenv(f"{provider.upper()}_TPM", tpm))
+            _limiters[provider] = ProviderLimiter(provider, rpm, tpm)
+        return _limiters[provider]
+
+
+#########################################################################################################################
+# Deadlines
+#
+# A deadline (a time.monotonic() value) set with `deadline_scope` applies to every LM call made
+# inside the block, including calls made by nested agents; nested scopes can only shorten it.
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+# Requests that outlive their deadline are abandoned here rather than blocking the caller; their
+# client-side timeouts (RateLimitedLM, SolveAgent_api) give the worker back soon after.
+_request_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="lm-request")
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[float]):
+    current = _deadline.get()
+    if deadline is None or (current is not None and current <= deadline):
+        yield current
+        return
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline() -> Optional[float]:
+    return _deadline.get()
+
+
+def remaining_time(deadline: Optional[float] = None) -> Optional[float]:
+    """Seconds left until `deadline` (default: the current scope's), or None without a deadline."""
+    deadline = current_deadline() if deadline is None else deadline
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def run_before_deadline(request: Callable[[], T], deadline: float, provider: Optional[str] = None) -> T:
+    """Run `request`, giving up (LMDeadlineExceeded) if it hasn't returned by `deadline`."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise LMDeadlineExceeded(f"{provider or 'LM'} request deadline has passed", provider)
+    # The copied context keeps tracing/metrics context inside the worker thread, and the deadline is
+    # set there so clients can pass the remaining time as their own timeout. dspy.context()
+    # overrides are thread-local, so the caller's LM/adapter/callbacks are applied again.
+    settings = {key: dspy.settings.get(key) for key in ("lm", "adapter", "callbacks")}
+
+    def run():
+        with dspy.context(**settings), deadline_scope(deadline):
+            return request()
+
+    future = _request_executor.submit(copy_context().run, run)
+    try:
+        return future.result(timeout=remaining)
+    except FutureTimeoutError:
+        future.cancel()
+        raise LMDeadlineExceeded(f"{provider or 'LM'} request did not finish before its deadline", provider) from None
+
+
+#########################################################################################################################
+# Retry
+
+
+def backoff_delay(attempt: int, base_delay: float = 0.5, max_delay: float = 30.0) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(max_delay, base_delay * 2**attempt)]."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retry(request: Callable[[], T], provider: str, tokens: int = 0, deadline: Optional[float] = None,
+                    max_attempts: int = 6, base_delay: float = 0.5, max_delay: float = 30.0) -> T:
+    """
+    Send `request` through the provider's limiter, retrying transient failures.
+
+    deadline: time.monotonic() by which the call must have succeeded (default: DEFAULT_TIMEOUT from now),
+    shortened by the enclosing `deadline_scope` if any.
+    Raises a typed LMError once retrying is pointless or would overrun the deadline.
+    """
+    limiter = get_limiter(provider)
+    deadline = time.monotonic() + DEFAULT_TIMEOUT if deadline is None else deadline
+    if current_deadline() is not None:
+        deadline = min(deadline, current_deadline())
+    for attempt in range(max_attempts):
+        limiter.acquire(tokens, deadline)
+        try:
+            return run_before_deadline(request, deadline, provider)
+        except LMDeadlineExceeded:
+            raise
+        except Exception as e:
+            error = classify_error(e, provider)
+            if not is_retryable(error) or attempt == max_attempts - 1:
+                raise error from e
+
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            server_delay = retry_after(_exception_headers(e))
+            if server_delay is not None:
+                delay = max(delay, server_delay)
+            if isinstance(error, RateLimitExceeded):
+                limiter.pause(delay)
+            if time.monotonic() + delay > deadline:
+                raise LMDeadlineExceeded(f"{provider} request could not be retried before its deadline: {e}", provider) from e
+            logger.info("%s request failed (%r), retry %d in %.2fs", provider, e, attempt + 1, delay)
+            time.sleep(delay)
@@ -0,0 +1,136 @@
+import logging
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence
+
+import dspy
+
+from metrics import current_context
+from structured_output import supports_response_schema
+from util import RateLimitedLM
+
+#########################################################################################################################
+# Role-based model routing
+#
+# A ModelRouter is configured as the dspy LM. For every request it looks at the call context kept
+# by metrics.MetricsCallback (agent, ExchangeOfThought round, predictor signature) and sends the
+# request to a model tier: the cheap tier for the judge, tool selection and agents B/C, the strong
+# tier for Agent A's final answer. Requests routed to the cheap tier with `escalate_to` are re-sent
+# to the stronger tier when the answer fails a confidence check. Agents are not aware of routing.
+
+logger = logging.getLogger(__name__)
+
+# Overridable with ROUTER_CHEAP_MODEL / ROUTER_STRONG_MODEL.
+DEFAULT_TIERS = {
+    "cheap": "openai/gpt-4o-mini",
+    "strong": "openai/gpt-4o",
+}
+
+_FIELD_HEADER = re.compile(r"\[\[ ## (\w+) ## \]\]")
+_HEDGING = re.compile(r"\b(i'?m not sure|i am not sure|cannot determine|can't determine|not enough information|"
+                      r"insufficient information|unable to (?:determine|identify))\b", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Route:
+    """Requests matching every given condition go to `tier` (None conditions match anything)."""
+    tier: str
+    signatures: Optional[Sequence[str]] = None
+    agents: Optional[Sequence[str]] = None
+    final_round: Optional[bool] = None
+    escalate_to: Optional[str] = None
+
+    def matches(self, context: dict) -> bool:
+        if self.signatures is not None and context.get("signature") not in self.signatures:
+            return False
+        if self.agents is not None and context.get("agent") not in self.agents:
+            return False
+        if self.final_round is not None and _is_final_round(context) != self.final_round:
+            return False
+        return True
+
+
+def _is_final_round(context: dict) -> bool:
+    # Outside an ExchangeOfThought every call is final.
+    if "rounds" not in context:
+        return True
+    return context.get("round", 0) >= context["rounds"]
+
+
+# First matching route wins.
+DEFAULT_ROUTES = [
+    # The judge and the tool choice are one-word answers; SolveAgent's loop already re-asks.
+    Route("cheap", signatures=("SolveAgentSignature", "SelectAgentSignature")),
+    # Agent A's final answer: the summarizing FinAgent step, or the whole answer of a basic Agent.
+    Route("strong", signatures=("FinAgentSignature", "BaseAgentSignature"), agents=("Agent A",), final_round=True),
+    Route("cheap", escalate_to="strong"),
+]
+
+
+def default_confidence_check(output: str, output_fields: Sequence[str] = ()) -> bool:
+    """A completion is trusted if every expected output field is present and non-empty and it doesn't hedge."""
+    if not output or not output.strip():
+        return False
+    if output_fields:
+        sections = dict(zip(_FIELD_HEADER.findall(output), _FIELD_HEADER.split(output)[2::2]))
+        if any(not sections.get(field, "").strip() for field in output_fields):
+            return False
+    return not _HEDGING.search(output)
+
+
+class ModelRouter(dspy.LM):
+    """dspy.LM that forwards each request to the LM of a tier; only the tier LMs run callbacks."""
+
+    def __init__(self, tiers: Dict[str, object], routes: List[Route] = None, default_tier: str = "cheap",
+                 confidence_check: Callable[[str, Sequence[str]], bool] = default_confidence_check):
+        # Predict reads temperature and n from lm.kwargs, so they mirror the default tier.
+        super().__init__(f"router/{default_tier}", **getattr(tiers[default_tier], "kwargs", {}))
+        self.tiers = tiers
+        self.routes = DEFAULT_ROUTES if routes is None else routes
+        self.default_tier = default_tier
+        self.confidence_check = confidence_check
+        self.stats = Counter()
+
+    def route(self, context: dict) -> Route:
+        return next((route for route in self.routes if route.matches(context)), Route(self.default_tier))
+
+    def _count(self, key: str):
+        self.stats[key] += 1
+
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        context = current_context()
+        route = self.route(context)
+        outputs = self.tiers[route.tier](prompt=prompt, messages=messages, **kwargs)
+        self._count(route.tier)
+
+        if route.escalate_to is not None:
+            output_fields = context.get("output_fields", ())
+            texts = [output["text"] if isinstance(output, dict) else output for output in outputs]
+            if not all(self.confidence_check(text, output_fields) for text in texts):
+                logger.info("Escalating %s request of %s from %s to %s",
+                            context.get("signature"), context.get("agent"), route.tier, route.escalate_to)
+                outputs = self.tiers[route.escalate_to](prompt=prompt, messages=messages, **kwargs)
+                self._count(f"escalated_to_{route.escalate_to}")
+        return outputs
+
+    def supports_response_schema(self) -> bool:
+        # Used by PrefixedChatAdapter: a schema is only requested if every tier can honour it.
+        return all(supports_response_schema(lm) for lm in self.tiers.values())
+
+    def inspect_history(self, n: int = 1):
+        for lm in self.tiers.values():
+            lm.inspect_history(n)
+
+
+@lru_cache(maxsize=4)
+def load_router(max_tokens: int = 1000, cheap_model: str = None, strong_model: str = None) -> ModelRouter:
+    """Cheap/strong router over RateLimitedLMs, built once per process."""
+    cheap_model = cheap_model or os.getenv("ROUTER_CHEAP_MODEL", DEFAULT_TIERS["cheap"])
+    strong_model = strong_model or os.getenv("ROUTER_STRONG_MODEL", DEFAULT_TIERS["strong"])
+    return ModelRouter({
+        "cheap": RateLimitedLM(cheap_model, max_tokens=max_tokens),
+        "strong": RateLimitedLM(strong_model, max_tokens=max_tokens),
+    })
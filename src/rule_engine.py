@@ -0,0 +1,231 @@
+import ast
+import operator
+import re
+from dataclasses import dataclass
+from fractions import Fraction
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+from safe_math import (ArithmeticEvaluator, ExpressionError, FUNCTIONS, OPERATORS, evaluate_text,
+                       extract_expressions, parse, power, to_python)
+
+#########################################################################################################################
+# Deterministic fast path for arithmetic-verifiable wrong answers
+#
+# When a question is a single arithmetic expression whose value is the correct answer, the wrong
+# answer can often be reproduced by re-evaluating the expression with a common mistake applied
+# (ignoring the order of operations, adding instead of multiplying, ...). If exactly one mistake
+# reproduces the wrong answer and train.csv labels what it reproduces precisely enough, its
+# MisconceptionId is returned without any LLM call.
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    misconception_id: int
+    simulate: Callable[[str], Fraction]
+    # Share of the train.csv wrong answers the rule alone reproduces that are labelled misconception_id.
+    precision: float = 0.0
+
+
+@dataclass(frozen=True)
+class RuleMatch:
+    rule: str
+    misconception_id: int
+    misconception: str
+
+
+#########################################################################################################################
+# Simulated mistakes
+
+_FLAT_TOKEN = re.compile(r"\s*(\d+\.?\d*|\.\d+|\*\*|sqrt|root|[-+*/(),])")
+_FLAT_OPERATORS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": OPERATORS[ast.Div][0],
+    "**": power,
+}
+
+
+def _tokenize(expression: str) -> List[str]:
+    tokens, i = [], 0
+    while i < len(expression):
+        match = _FLAT_TOKEN.match(expression, i)
+        if not match:
+            raise ExpressionError(f"unexpected character {expression[i]!r}")
+        tokens.append(match.group(1))
+        i = match.end()
+    return tokens
+
+
+def _evaluate_flat(expression: str, right_to_left: bool = False) -> Fraction:
+    """Evaluate with every operator at the same priority; brackets and fraction bars still group."""
+    tokens = _tokenize(expression)
+
+    def operand(i):
+        token = tokens[i] if i < len(tokens) else None
+        if token == "(":
+            value, i = sequence(i + 1)
+            if i >= len(tokens) or tokens[i] != ")":
+                raise ExpressionError("unbalanced brackets")
+            return value, i + 1
+        if token in ("-", "+"):
+            value, i = operand(i + 1)
+            return (-value if token == "-" else value), i
+        if token in FUNCTIONS:
+            if i + 1 >= len(tokens) or tokens[i + 1] != "(":
+                raise ExpressionError(f"{token} without arguments")
+            args, i = [], i + 2
+            while True:
+                value, i = sequence(i)
+                args.append(value)
+                if i < len(tokens) and tokens[i] == ",":
+                    i += 1
+                    continue
+                break
+            if i >= len(tokens) or tokens[i] != ")":
+                raise ExpressionError("unbalanced brackets")
+            return FUNCTIONS[token](*args), i + 1
+        if token is None or token in _FLAT_OPERATORS or token in "(),":
+            raise ExpressionError("missing operand")
+        return Fraction(token), i + 1
+
+    def sequence(i):
+        values, ops = [], []
+        value, i = operand(i)
+        values.append(value)
+        while i < len(tokens) and tokens[i] in _FLAT_OPERATORS:
+            ops.append(_FLAT_OPERATORS[tokens[i]])
+            value, i = operand(i + 1)
+            values.append(value)
+        if right_to_left:
+            result = values[-1]
+            for op, value in zip(reversed(ops), reversed(values[:-1])):
+                result = op(value, result)
+        else:
+            result = values[0]
+            for op, value in zip(ops, values[1:]):
+                result = op(result, value)
+        return result, i
+
+    value, i = sequence(0)
+    if i != len(tokens):
+        raise ExpressionError("unbalanced brackets")
+    return value
+
+
+def _left_to_right(expression: str) -> Fraction:
+    return _evaluate_flat(expression)
+
+
+def _right_to_left(expression: str) -> Fraction:
+    return _evaluate_flat(expression, right_to_left=True)
+
+
+def _substituted(operators: Dict = None, functions: Dict = None) -> Callable[[str], Fraction]:
+    """Evaluate with some operators/functions replaced; fails if none of them occur."""
+    operators = operators or {}
+    functions = functions or {}
+    operators_used = {**OPERATORS, **operators}
+    functions_used = {**FUNCTIONS, **functions}
+
+    def applies(tree) -> bool:
+        return any(
+            (isinstance(node, ast.BinOp) and type(node.op) in operators)
+            or (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in functions)
+            for node in ast.walk(tree)
+        )
+
+    def simulate(expression: str) -> Fraction:
+        tree = parse(expression)
+        if not applies(tree):
+            raise ExpressionError("the simulated mistake does not apply to this expression")
+        return ArithmeticEvaluator(operators_used, functions_used).visit(tree)
+
+    return simulate
+
+
+def _squaring_as_doubling(base: Fraction, exponent: Fraction) -> Fraction:
+    return base * 2 if exponent == 2 else power(base, exponent)
+
+
+def _multiplying_by_index(base: Fraction, exponent: Fraction) -> Fraction:
+    return base * exponent if exponent != 2 else power(base, exponent)
+
+
+# MisconceptionIds are the labels train.csv most often gives to wrong answers each mistake reproduces;
+# precisions were measured with RuleEngine.match over every wrong answer of train.csv (50 of 78 overall).
+RULES = [
+    # Carries out operations from left to right regardless of priority order
+    Rule("left_to_right", 1507, _left_to_right, precision=11 / 15),
+    Rule("adds_instead_of_multiplies", 1416, _substituted({ast.Mult: (operator.add, "+")}), precision=5 / 9),
+    Rule("adds_instead_of_subtracts", 1514, _substituted({ast.Sub: (operator.add, "+")}), precision=8 / 13),
+    Rule("multiplies_instead_of_divides", 1074, _substituted({ast.Div: (operator.mul, "×")}), precision=5 / 10),
+    Rule("squaring_as_doubling", 2316, _substituted({ast.Pow: (_squaring_as_doubling, "^")}), precision=11 / 16),
+    Rule("multiplies_by_index", 1072, _substituted({ast.Pow: (_multiplying_by_index, "^")}), precision=5 / 8),
+    Rule("adds_index", 952, _substituted({ast.Pow: (operator.add, "+")}), precision=5 / 7),
+]
+# Rules less precise than this are still simulated (a wrong answer two rules reproduce stays ambiguous)
+# but never answer: a misconception served without any LLM call should rarely be wrong.
+MIN_PRECISION = 0.9
+
+
+#########################################################################################################################
+
+
+class RuleEngine:
+    def __init__(self, rules: List[Rule] = None, mis_data_path: str = "./data/misconception_mapping.csv",
+                 min_precision: float = MIN_PRECISION):
+        self.rules = RULES if rules is None else rules
+        self.min_precision = min_precision
+        mis_data = pd.read_csv(mis_data_path)
+        self.misconception_names = dict(zip(mis_data["MisconceptionId"], mis_data["MisconceptionName"]))
+
+    def simulate(self, expression: str) -> Dict[str, Fraction]:
+        """Value of the expression under every rule that applies to it."""
+        values = {}
+        for rule in self.rules:
+            try:
+                values[rule.name] = rule.simulate(expression)
+            except (ExpressionError, ArithmeticError, ValueError):
+                continue
+        return values
+
+    def match(self, QuestionText: str, AnswerText: str, CorrectAnswer: str) -> Optional[RuleMatch]:
+        """The misconception behind a wrong answer, if exactly one simulated mistake reproduces it."""
+        expressions = extract_expressions(QuestionText)
+        if len(expressions) != 1:
+            return None
+        try:
+            sides = to_python(expressions[0])
+        except ExpressionError:
+            return None
+        if len(sides) != 1:
+            return None
+
+        question = [e for e in evaluate_text(expressions[0], use_sympy=False) if e.exact is not None]
+        correct = [e for e in evaluate_text(CorrectAnswer, use_sympy=False) if e.exact is not None]
+        wrong = [e for e in evaluate_text(AnswerText, use_sympy=False) if e.exact is not None]
+        if len(question) != 1 or len(correct) != 1 or len(wrong) != 1:
+            return None
+        # Only questions that ask for the value of the expression are handled.
+        if question[0].exact != correct[0].exact or wrong[0].exact == correct[0].exact:
+            return None
+
+        matches = [name for name, value in self.simulate(sides[0]).items() if value == wrong[0].exact]
+        misconception_ids = {rule.misconception_id for rule in self.rules if rule.name in matches}
+        if len(misconception_ids) != 1:
+            return None
+        misconception_id = misconception_ids.pop()
+        precision = max(rule.precision for rule in self.rules if rule.name in matches)
+        if precision < self.min_precision:
+            return None
+        return RuleMatch(matches[0], misconception_id, self.misconception_names.get(misconception_id, ""))
+
+
+@lru_cache(maxsize=2)
+def load_rule_engine(mis_data_path: str = "./data/misconception_mapping.csv") -> RuleEngine:
+    return RuleEngine(mis_data_path=mis_data_path)
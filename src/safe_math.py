@@ -0,0 +1,435 @@
+import ast
+import operator
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from fractions import Fraction
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+try:
+    import sympy
+except ImportError:  # sympy is optional; without it only plain arithmetic is evaluated
+    sympy = None
+
+#########################################################################################################################
+# Safe evaluation of the maths in question texts
+#
+# Expressions are taken from the \( ... \) / \[ ... \] LaTeX of a question, translated to Python
+# syntax and parsed with `ast`. Only whitelisted nodes are evaluated (numbers, + - * / ^, sqrt and,
+# when sympy is installed, single-letter symbols), so nothing in a question can run code.
+
+MAX_EXPRESSION_LENGTH = 300
+MAX_POWER_BITS = 4096
+# Highest polynomial degree a symbolic expression may reach through powers.
+MAX_SYMBOLIC_DEGREE = 64
+SYMPY_TIMEOUT = 1.0
+SYMPY_WORKERS = 2
+
+# \( ... \), \[ ... \] and the $ ... $ form the pages convert questions to for Markdown.
+LATEX_BLOCK = re.compile(r"\\\((.*?)\\\)|\\\[(.*?)\\\]|\$(.+?)\$", re.DOTALL)
+
+_sympy_executor = ThreadPoolExecutor(max_workers=SYMPY_WORKERS, thread_name_prefix="safe_math")
+# One slot per worker; held until the work finishes, even after its caller gave up on it.
+_sympy_slots = threading.BoundedSemaphore(SYMPY_WORKERS)
+
+
+class ExpressionError(ValueError):
+    """The text is not an expression this module can evaluate safely."""
+
+
+@dataclass(frozen=True)
+class Evaluation:
+    expression: str
+    value: str
+    steps: Tuple[str, ...] = ()
+    exact: Optional[Fraction] = None  # None for symbolic or irrational results
+
+
+#########################################################################################################################
+# LaTeX -> Python expression
+
+_LATEX_DROP = re.compile(r"\\left|\\right|\\[,;:!]|\\quad|\\qquad|\\displaystyle|~|£|€|\$")
+_LATEX_REPLACE = [
+    (re.compile(r"\\times|\\cdot|\\ast|×"), "*"),
+    (re.compile(r"\\div|÷"), "/"),
+    (re.compile(r"−|–"), "-"),
+    (re.compile(r"\\%|%"), "/100"),
+    (re.compile(r"\{,\}"), ""),
+    (re.compile(r"(?<=\d),(?=\d{3}(?!\d))"), ""),  # thousands separators
+]
+_FRAC = re.compile(r"\\[dt]?frac")
+
+
+def _read_group(text: str, i: int) -> Tuple[str, int]:
+    """Read a {...} group (or a single character) starting at text[i]."""
+    while i < len(text) and text[i] == " ":
+        i += 1
+    if i >= len(text):
+        raise ExpressionError("unexpected end of expression")
+    if text[i] != "{":
+        return text[i], i + 1
+    depth = 0
+    for j in range(i, len(text)):
+        if text[j] == "{":
+            depth += 1
+        elif text[j] == "}":
+            depth -= 1
+            if depth == 0:
+                return text[i + 1:j], j + 1
+    raise ExpressionError("unbalanced braces")
+
+
+def latex_to_python(latex: str) -> str:
+    text = _LATEX_DROP.sub("", latex)
+    text = re.sub(r"\?\s*$", "", text)  # "\sqrt{16}=?" asks for the value
+    for pattern, replacement in _LATEX_REPLACE:
+        text = pattern.sub(replacement, text)
+
+    out, i = [], 0
+    while i < len(text):
+        frac = _FRAC.match(text, i)
+        if frac:
+            numerator, i = _read_group(text, frac.end())
+            denominator, i = _read_group(text, i)
+            fraction = f"(({latex_to_python(numerator)})/({latex_to_python(denominator)}))"
+            # "2 \frac{2}{5}" is a mixed number, i.e. 2 + 2/5.
+            whole = re.search(r"(?:^|[^\w.)])(\d+)\s*$", "".join(out))
+            if whole:
+                out = list("".join(out)[:whole.start(1)])
+                fraction = f"({whole.group(1)}+{fraction})"
+            out.append(fraction)
+        elif text.startswith("\\sqrt", i):
+            i += len("\\sqrt")
+            degree = None
+            if i < len(text) and text[i] == "[":
+                end = text.index("]", i)
+                degree, i = latex_to_python(text[i + 1:end]), end + 1
+            radicand, i = _read_group(text, i)
+            radicand = latex_to_python(radicand)
+            out.append(f"sqrt({radicand})" if degree is None else f"root({radicand},{degree})")
+        elif text[i] == "^":
+            exponent, i = _read_group(text, i + 1)
+            out.append(f"**({latex_to_python(exponent)})")
+        elif text[i] == "\\":
+            command = re.match(r"\\[A-Za-z]+", text[i:])
+            raise ExpressionError(f"unsupported LaTeX command {command.group(0) if command else text[i:i + 2]}")
+        elif text[i] in "{}":
+            out.append("(" if text[i] == "{" else ")")
+            i += 1
+        else:
+            out.append(text[i])
+            i += 1
+    return "".join(out)
+
+
+_TOKEN = re.compile(r"\s*(?:(\d+\.?\d*|\.\d+)|(sqrt|root)|([A-Za-z])|(\*\*|[-+*/(),=]))")
+
+
+def _insert_implicit_multiplication(expression: str) -> str:
+    """'2x', '3(4+1)', 'x y' and ')(' become explicit products; unknown characters are rejected."""
+    tokens, i = [], 0
+    expression = expression.strip()
+    while i < len(expression):
+        match = _TOKEN.match(expression, i)
+        if not match or match.end() == i:
+            raise ExpressionError(f"unexpected character {expression[i]!r}")
+        number, function, symbol, op = match.groups()
+        kind = "num" if number else "func" if function else "sym" if symbol else op
+        if tokens and kind in ("num", "sym", "func", "(") and tokens[-1][0] in ("num", "sym", ")"):
+            tokens.append(("*", "*"))
+        tokens.append((kind, number or function or symbol or op))
+        i = match.end()
+    return "".join(value for _, value in tokens)
+
+
+#########################################################################################################################
+# Evaluation
+
+
+def _format_number(value: Fraction) -> str:
+    if value.denominator == 1:
+        return str(value.numerator)
+    denominator = value.denominator
+    for factor in (2, 5):
+        while denominator % factor == 0:
+            denominator //= factor
+    if denominator == 1:  # terminating decimal
+        return format(value.numerator / value.denominator, ".10f").rstrip("0").rstrip(".")
+    return f"{value.numerator}/{value.denominator}"
+
+
+def power(base: Fraction, exponent: Fraction) -> Fraction:
+    if exponent.denominator == 1:
+        bits = max(base.numerator.bit_length(), base.denominator.bit_length()) * abs(exponent.numerator)
+        if bits > MAX_POWER_BITS:
+            raise ExpressionError("power is too large")
+        if base == 0 and exponent < 0:
+            raise ExpressionError("division by zero")
+        return base ** exponent.numerator
+    # Roots: exact when the result is rational, otherwise not representable as a Fraction.
+    if base < 0:
+        raise ExpressionError("root of a negative number")
+    root_degree = exponent.denominator
+    numerator = round(base.numerator ** (1 / root_degree))
+    denominator = round(base.denominator ** (1 / root_degree))
+    if numerator ** root_degree == base.numerator and denominator ** root_degree == base.denominator:
+        return power(Fraction(numerator, denominator), Fraction(exponent.numerator))
+    raise ExpressionError("irrational result")
+
+
+def _divide(left: Fraction, right: Fraction) -> Fraction:
+    if right == 0:
+        raise ExpressionError("division by zero")
+    return left / right
+
+
+# ast operator -> (function, symbol used in the recorded steps)
+OPERATORS = {
+    ast.Add: (operator.add, "+"),
+    ast.Sub: (operator.sub, "-"),
+    ast.Mult: (operator.mul, "×"),
+    ast.Div: (_divide, "÷"),
+    ast.Pow: (power, "^"),
+}
+FUNCTIONS = {
+    "sqrt": lambda x: power(x, Fraction(1, 2)),
+    "root": lambda x, degree: power(x, 1 / degree),
+}
+
+
+class ArithmeticEvaluator:
+    """Exact evaluation of a whitelisted AST with Fractions, recording one step per operation.
+
+    `operators` and `functions` default to the real arithmetic; the rule engine swaps some of
+    them to simulate common student mistakes.
+    """
+
+    def __init__(self, operators=None, functions=None):
+        self.operators = OPERATORS if operators is None else operators
+        self.functions = FUNCTIONS if functions is None else functions
+        self.steps: List[str] = []
+
+    def visit(self, node) -> Fraction:
+        if isinstance(node, ast.Expression):
+            return self.visit(node.body)
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return Fraction(str(node.value))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            value = self.visit(node.operand)
+            return -value if isinstance(node.op, ast.USub) else value
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in self.operators:
+                raise ExpressionError(f"operator {type(node.op).__name__} is not allowed")
+            left, right = self.visit(node.left), self.visit(node.right)
+            function, symbol = self.operators[type(node.op)]
+            result = function(left, right)
+            self.steps.append(f"{_format_number(left)} {symbol} {_format_number(right)} = {_format_number(result)}")
+            return result
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in self.functions and not node.keywords:
+            args = [self.visit(arg) for arg in node.args]
+            try:
+                result = self.functions[node.func.id](*args)
+            except TypeError:
+                raise ExpressionError(f"wrong number of arguments for {node.func.id}")
+            self.steps.append(f"{node.func.id}({', '.join(_format_number(arg) for arg in args)}) = {_format_number(result)}")
+            return result
+        raise ExpressionError(f"{type(node).__name__} is not allowed in an arithmetic expression")
+
+
+def _is_symbolic(tree) -> bool:
+    return any(isinstance(node, ast.Name) and node.id not in FUNCTIONS for node in ast.walk(tree))
+
+
+def _bits(value: Fraction) -> int:
+    return max(value.numerator.bit_length(), value.denominator.bit_length(), 1)
+
+
+def check_size(node) -> Tuple[int, int]:
+    """
+    (bits, degree): bounds on the size of the numbers and on the polynomial degree of an
+    expression, computed from the AST before anything is built. Raises ExpressionError when a
+    power would exceed MAX_POWER_BITS or MAX_SYMBOLIC_DEGREE, like power() does for numbers,
+    so nested powers such as ((2^{64})^{64})^{64} are rejected up front.
+    """
+    if isinstance(node, ast.Expression):
+        return check_size(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return _bits(Fraction(str(node.value))), 0
+    if isinstance(node, ast.Name):
+        return 1, 1
+    if isinstance(node, ast.UnaryOp):
+        return check_size(node.operand)
+    if isinstance(node, ast.BinOp):
+        (left_bits, left_degree), (right_bits, right_degree) = check_size(node.left), check_size(node.right)
+        if isinstance(node.op, (ast.Add, ast.Sub)):
+            return max(left_bits, right_bits) + 1, max(left_degree, right_degree)
+        if not isinstance(node.op, ast.Pow):
+            return left_bits + right_bits, left_degree + right_degree
+        if right_degree:
+            # A symbolic exponent (2^{x}) stays unevaluated.
+            return left_bits, left_degree
+        exponent = abs(ArithmeticEvaluator().visit(node.right))
+        bits, degree = left_bits * exponent, left_degree * exponent
+        if bits > MAX_POWER_BITS or degree > MAX_SYMBOLIC_DEGREE:
+            raise ExpressionError("power is too large")
+        return max(int(bits) + 1, 1), int(degree) + (degree.denominator != 1)
+    if isinstance(node, ast.Call):
+        sizes = [check_size(arg) for arg in node.args]
+        return (sizes[0] if sizes else (1, 0))
+    raise ExpressionError(f"{type(node).__name__} is not allowed in an algebraic expression")
+
+
+_SYMPY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+
+def _to_sympy(node):
+    """
+    Build a sympy expression from an already whitelisted AST (never calls sympify on text).
+    Sizes are checked first (check_size); building runs inside _run_sympy's timeout.
+    """
+    if isinstance(node, ast.Expression):
+        return _to_sympy(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return sympy.Rational(str(node.value))
+    if isinstance(node, ast.Name) and len(node.id) == 1:
+        return sympy.Symbol(node.id)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        operand = _to_sympy(node.operand)
+        return -operand if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.BinOp):
+        left, right = _to_sympy(node.left), _to_sympy(node.right)
+        if isinstance(node.op, ast.Pow):
+            return left ** right
+        if type(node.op) in _SYMPY_OPERATORS:
+            return _SYMPY_OPERATORS[type(node.op)](left, right)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+        args = [_to_sympy(arg) for arg in node.args]
+        if node.func.id == "sqrt" and len(args) == 1:
+            return sympy.sqrt(args[0])
+        if node.func.id == "root" and len(args) == 2:
+            return sympy.root(args[0], args[1])
+    raise ExpressionError(f"{type(node).__name__} is not allowed in an algebraic expression")
+
+
+def _run_sympy(function, timeout: float):
+    # Work that timed out can't be stopped and keeps its worker; while it holds every worker, new
+    # work fails at once instead of queueing behind it past its own timeout.
+    if not _sympy_slots.acquire(blocking=False):
+        raise ExpressionError("symbolic evaluation is busy")
+
+    def run():
+        try:
+            return function()
+        finally:
+            _sympy_slots.release()
+
+    future = _sympy_executor.submit(run)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # The worker thread cannot be killed; it finishes in the background and its result is dropped.
+        if future.cancel():
+            _sympy_slots.release()
+        raise ExpressionError(f"symbolic evaluation timed out after {timeout}s")
+
+
+def parse(expression: str) -> ast.Expression:
+    try:
+        return ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ExpressionError(f"not an expression: {e.msg}")
+
+
+def to_python(latex: str) -> List[str]:
+    """Python-syntax sides of a LaTeX expression or equation ("2 \times 3^{2}=" has one side)."""
+    if len(latex) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError("expression is too long")
+    expression = _insert_implicit_multiplication(latex_to_python(latex))
+    if not expression:
+        raise ExpressionError("empty expression")
+
+    sides = expression.split("=")
+    if len(sides) > 2:
+        raise ExpressionError("more than one '=' sign")
+    if len(sides) == 2 and not sides[1].strip():  # "2 \times 3^{2}=" asks for the value
+        sides = sides[:1]
+    return sides
+
+
+@lru_cache(maxsize=4096)
+def _evaluate_cached(latex: str, use_sympy: bool, timeout: float):
+    # Errors are cached too (returned, not raised) so a bad expression is only parsed once.
+    try:
+        sides = to_python(latex)
+        expression = "=".join(sides)
+        trees = [parse(side) for side in sides]
+        if not any(_is_symbolic(tree) for tree in trees) and len(trees) == 1:
+            evaluator = ArithmeticEvaluator()
+            value = evaluator.visit(trees[0])
+            return Evaluation(expression, _format_number(value), tuple(evaluator.steps), value)
+
+        if not use_sympy or sympy is None:
+            raise ExpressionError("algebraic expressions need sympy")
+
+        for tree in trees:
+            check_size(tree)
+
+        if len(trees) == 2:
+            def solve():
+                lhs, rhs = (_to_sympy(tree) for tree in trees)
+                symbols = sorted((lhs - rhs).free_symbols, key=str)
+                if not symbols:
+                    return str(bool(sympy.simplify(lhs - rhs) == 0))
+                solutions = sympy.solve(sympy.Eq(lhs, rhs), symbols[0])
+                return f"{symbols[0]} = {', '.join(str(s) for s in solutions) or 'no solution'}"
+            return Evaluation(expression, _run_sympy(solve, timeout))
+
+        return Evaluation(expression, _run_sympy(lambda: str(sympy.simplify(_to_sympy(trees[0]))), timeout))
+    except ExpressionError as e:
+        return e
+    except (ArithmeticError, RecursionError, ValueError, TypeError) as e:
+        return ExpressionError(str(e))
+
+
+def evaluate(latex: str, use_sympy: bool = True, timeout: float = SYMPY_TIMEOUT) -> Evaluation:
+    """Evaluate one LaTeX expression (without its \\( \\) delimiters). Results are memoized."""
+    result = _evaluate_cached(latex.strip(), use_sympy, timeout)
+    if isinstance(result, ExpressionError):
+        raise result
+    return result
+
+
+def extract_expressions(text: str) -> List[str]:
+    """The contents of all \\( ... \\), \\[ ... \\] and $ ... $ blocks of a text."""
+    return [next(group for group in match.groups() if group is not None).strip()
+            for match in LATEX_BLOCK.finditer(str(text))]
+
+
+def evaluate_text(text: str, use_sympy: bool = True, timeout: float = SYMPY_TIMEOUT) -> List[Evaluation]:
+    """Evaluate every expression in a (question) text, skipping the ones that can't be evaluated."""
+    expressions = extract_expressions(text) or [str(text)]
+    evaluations = []
+    for expression in expressions:
+        try:
+            evaluations.append(evaluate(expression, use_sympy=use_sympy, timeout=timeout))
+        except ExpressionError:
+            continue
+    return evaluations
+
+
+def solve_arithmetic(QuestionText: str, CorrectAnswer: str) -> Optional[str]:
+    """Step-by-step solution of a pure arithmetic question, if it can be verified locally.
+
+    Returns None unless the question contains exactly one arithmetic expression and its value equals
+    the (single) value of the correct answer, so callers can fall back to an LLM otherwise.
+    """
+    questions = [e for e in evaluate_text(QuestionText, use_sympy=False) if e.exact is not None and e.steps]
+    answers = [e for e in evaluate_text(CorrectAnswer, use_sympy=False) if e.exact is not None]
+    if len(questions) != 1 or len(answers) != 1 or questions[0].exact != answers[0].exact:
+        return None
+
+    steps = [f"{i}. {step}" for i, step in enumerate(questions[0].steps, start=1)]
+    steps.append(f"{len(steps) + 1}. So the answer is {questions[0].value}, which matches the correct answer.")
+    return "\n".join(steps)
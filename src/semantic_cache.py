@@ -0,0 +1,219 @@
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+#########################################################################################################################
+# Near-duplicate cache of ExchangeOfThought results
+#
+# Exact-key caches (LM responses, reasoning) miss questions that differ in wording, spacing or a
+# few numbers. Here every answered (QuestionText, AnswerText) is kept with a MinHash signature of
+# its question's character shingles; locality-sensitive hashing (LSH) over signature bands finds
+# earlier questions that probably overlap, and a cached result is returned when the estimated
+# Jaccard similarity of the questions reaches `threshold` and the wrong and correct answers match.
+# The answers have to match (after normalization) because the misconception is about the wrong
+# answer: "2 + 3 x 4 = 20" and "2 + 3 x 4 = 9" are different mistakes on the same question, and
+# "1 : 2" is the right answer to one ratio question but a wrong one to its near-duplicate.
+#
+# A result also depends on the program that produced it (mode, rounds, agents, LM, demos), so
+# entries are stored under a namespace, the program's configuration tag
+# (program_config.config_meta), and a cache only serves its own namespace. The labelled
+# misconceptions of train.csv hold for every program and are shared by all namespaces.
+#
+#   python src/semantic_cache.py --warm data/train.csv   # seed with the labelled misconceptions of train.csv
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEMANTIC_CACHE_PATH = "./cache/semantic.sqlite3"
+# Namespace of the entries every program may serve (warm_from_train).
+SHARED_NAMESPACE = "*"
+
+SHINGLE = 5
+NUM_PERM = 128
+BANDS = 32
+_PRIME = (1 << 31) - 1
+_LATEX = re.compile(r"\\[()\[\]]|\$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Lower case, without LaTeX delimiters and whitespace."""
+    return _SPACES.sub("", _LATEX.sub("", str(text or "")).lower())
+
+
+def shingles(text: str, size: int = SHINGLE) -> np.ndarray:
+    """Hashes of the character `size`-grams of the normalized text."""
+    text = normalize(text)
+    if len(text) <= size:
+        return np.array([zlib.crc32(text.encode("utf-8")) % _PRIME], dtype=np.uint64)
+    grams = {text[i:i + size] for i in range(len(text) - size + 1)}
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) % _PRIME for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        # (a * x + b) mod p stays below 2**63 for p = 2**31 - 1, so uint64 never overflows.
+        hashes = (np.outer(shingles(text), self.a) + self.b) % _PRIME
+        return hashes.min(axis=0).astype(np.uint32)
+
+
+def similarity(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of two MinHash signatures."""
+    return float(np.mean(signature_a == signature_b))
+
+
+@dataclass(frozen=True)
+class SemanticHit:
+    result: str
+    similarity: float
+    QuestionText: str
+
+
+class SemanticCache:
+    def __init__(self, path: str = DEFAULT_SEMANTIC_CACHE_PATH, threshold: float = 0.85,
+                 num_perm: int = NUM_PERM, bands: int = BANDS, namespace: str = ""):
+        """
+        threshold: estimated Jaccard similarity of the questions' shingles needed for a hit.
+        namespace: configuration tag of the program whose results are stored and served.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.path = path
+        self.threshold = threshold
+        self.namespace = namespace
+        self.bands = bands
+        self.hasher = MinHasher(num_perm)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(entries)")}
+        if columns and "namespace" not in columns:
+            # Entries of the first version don't say which program produced them.
+            logger.info("Dropping the unnamespaced entries of %s", path)
+            self._conn.execute("DROP TABLE entries")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, question TEXT NOT NULL, answer TEXT NOT NULL,
+                correct TEXT NOT NULL, signature BLOB NOT NULL, result TEXT NOT NULL, source TEXT,
+                created REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, UNIQUE (namespace, question, answer, correct)
+            )
+        """)
+        self._entries: Dict[int, tuple] = {}
+        self._buckets: Dict[tuple, List[int]] = defaultdict(list)
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "stores": 0}
+        for entry_id, question, answer, correct, signature in self._conn.execute(
+                "SELECT id, question, answer, correct, signature FROM entries WHERE namespace IN (?, ?)",
+                (namespace, SHARED_NAMESPACE)):
+            self._index(entry_id, question, (normalize(answer), normalize(correct)),
+                        np.frombuffer(signature, dtype=np.uint32))
+
+    def _bands(self, signature: np.ndarray):
+        rows = len(signature) // self.bands
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+
+    def _index(self, entry_id: int, question: str, answers: tuple, signature: np.ndarray):
+        self._entries[entry_id] = (question, answers, signature)
+        for key in self._bands(signature):
+            self._buckets[key].append(entry_id)
+
+    def lookup(self, QuestionText: str, AnswerText: str, CorrectAnswer: str) -> Optional[SemanticHit]:
+        """The result of the most similar answered question with the same answers, if similar enough."""
+        signature = self.hasher.signature(QuestionText)
+        answers = (normalize(AnswerText), normalize(CorrectAnswer))
+        with self._lock:
+            self.stats["lookups"] += 1
+            candidates = {entry_id for key in self._bands(signature) for entry_id in self._buckets.get(key, ())}
+            best, best_similarity = None, self.threshold
+            for entry_id in candidates:
+                question, entry_answers, entry_signature = self._entries[entry_id]
+                if entry_answers != answers:
+                    continue
+                score = similarity(signature, entry_signature)
+                if score >= best_similarity:
+                    best, best_similarity = entry_id, score
+            if best is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self._conn.execute("UPDATE entries SET hits = hits + 1 WHERE id = ?", (best,))
+            result = self._conn.execute("SELECT result FROM entries WHERE id = ?", (best,)).fetchone()[0]
+            return SemanticHit(result, best_similarity, self._entries[best][0])
+
+    def store(self, QuestionText: str, AnswerText: str, CorrectAnswer: str, result: str, source: str = "live",
+              shared: bool = False):
+        """
+        Remember the result of a question; the first result of an exact (question, answers) triple is kept.
+        shared: store it for every namespace rather than this cache's own.
+        """
+        signature = self.hasher.signature(QuestionText)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO entries (namespace, question, answer, correct, signature, result, source, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (SHARED_NAMESPACE if shared else self.namespace, str(QuestionText), str(AnswerText),
+                 str(CorrectAnswer), signature.tobytes(), str(result), source, time.time()))
+            if cursor.rowcount:
+                self._index(cursor.lastrowid, str(QuestionText), (normalize(AnswerText), normalize(CorrectAnswer)),
+                            signature)
+                self.stats["stores"] += 1
+
+    def warm_from_train(self, q_data_path: str = "./data/train.csv",
+                        mis_data_path: str = "./data/misconception_mapping.csv") -> int:
+        """Add the labelled wrong answers of train.csv with their misconception names as results."""
+        data = pd.read_csv(q_data_path)
+        mis_data = pd.read_csv(mis_data_path)
+        names = dict(zip(mis_data["MisconceptionId"], mis_data["MisconceptionName"]))
+        before = len(self)
+        for row in data.itertuples(index=False):
+            for option in "ABCD":
+                misconception_id = getattr(row, f"Misconception{option}Id")
+                if option != row.CorrectAnswer and not pd.isna(misconception_id) and int(misconception_id) in names:
+                    self.store(row.QuestionText, getattr(row, f"Answer{option}Text"),
+                               getattr(row, f"Answer{row.CorrectAnswer}Text"), names[int(misconception_id)],
+                               source="train", shared=True)
+        return len(self) - before
+
+    def hit_rate(self) -> float:
+        return self.stats["hits"] / self.stats["lookups"] if self.stats["lookups"] else 0.0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+@lru_cache(maxsize=4)
+def load_semantic_cache(path: str = DEFAULT_SEMANTIC_CACHE_PATH, threshold: float = 0.85,
+                        namespace: str = "") -> SemanticCache:
+    return SemanticCache(path, threshold, namespace=namespace)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or seed the near-duplicate ExchangeOfThought cache.")
+    parser.add_argument("--path", default=DEFAULT_SEMANTIC_CACHE_PATH)
+    parser.add_argument("--warm", metavar="TRAIN_CSV", help="add the labelled wrong answers of this CSV")
+    parser.add_argument("--misconceptions", default="./data/misconception_mapping.csv")
+    args = parser.parse_args()
+    cache = SemanticCache(args.path)
+    if args.warm:
+        print(f"Added {cache.warm_from_train(args.warm, args.misconceptions)} entries from {args.warm}")
+    rows = cache._conn.execute("SELECT namespace, source, COUNT(*), SUM(hits) FROM entries GROUP BY namespace, source").fetchall()
+    for namespace, source, count, hits in rows:
+        print(f"{namespace} {source}: {count} entries, {hits} hits")
@@ -0,0 +1,159 @@
+import difflib
+import json
+import re
+from typing import Any, Dict, Literal, Optional, Sequence, Tuple, get_args, get_origin
+
+import json_repair
+import litellm
+from dspy.adapters.chat_adapter import field_header_pattern, parse_value
+
+#########################################################################################################################
+# Structured outputs and tolerant parsing
+#
+# Signatures whose outputs are enum-like (Literal[...]) are requested with a JSON schema when the
+# provider supports it, so the model can only answer with an allowed value. Whatever comes back
+# (JSON, [[ ## field ## ]] sections, or a bare answer) is parsed locally and enum values are
+# matched tolerantly ("**Yes.**", "yes, I can", "I'd use the calculator"), so a verbose or oddly
+# formatted completion never needs another request.
+
+# Ordered: negative phrases must be tried before the positive words they contain.
+_YES_NO_PATTERNS = [
+    (re.compile(r"\b(no|not (?:enough|sufficient)|insufficient|cannot|can't|false)\b"), "no"),
+    (re.compile(r"\b(yes|enough|sufficient|can|true)\b"), "yes"),
+]
+
+
+def literal_options(annotation) -> Optional[Tuple[str, ...]]:
+    """The allowed values of a Literal[...] annotation, or None for other types."""
+    if get_origin(annotation) is Literal:
+        return tuple(str(option) for option in get_args(annotation))
+    return None
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", str(text).lower()).strip()
+
+
+def coerce_literal(text: str, options: Sequence[str]) -> Optional[str]:
+    """Match free text to one of `options` (case/format-insensitive); None if nothing fits."""
+    normalized = _normalize(text)
+    by_normalized = {_normalize(option): option for option in options}
+    if normalized in by_normalized:
+        return by_normalized[normalized]
+
+    # An option mentioned as a whole word: the earliest mention wins ("Yes. No further ..." -> Yes).
+    positions = []
+    for key, option in by_normalized.items():
+        match = re.search(rf"\b{re.escape(key)}\b", normalized)
+        if match:
+            positions.append((match.start(), option))
+    if positions:
+        return min(positions)[1]
+
+    # Multi-word spellings of one-word options ("Web Search" -> websearch).
+    compact = normalized.replace(" ", "")
+    positions = [(compact.find(key.replace(" ", "")), option) for key, option in by_normalized.items()
+                 if key.replace(" ", "") in compact]
+    if positions:
+        return min(positions)[1]
+
+    if set(by_normalized) == {"yes", "no"}:
+        for pattern, key in _YES_NO_PATTERNS:
+            if pattern.search(normalized):
+                return by_normalized[key]
+
+    close = difflib.get_close_matches(normalized, list(by_normalized), n=1, cutoff=0.6)
+    return by_normalized[close[0]] if close else None
+
+
+def response_format_for(signature) -> Optional[dict]:
+    """JSON schema response format for signatures with only str/Literal outputs, at least one Literal."""
+    properties, has_literal = {}, False
+    for name, field in signature.output_fields.items():
+        options = literal_options(field.annotation)
+        if options is not None:
+            properties[name] = {"type": "string", "enum": list(options)}
+            has_literal = True
+        elif field.annotation is str:
+            properties[name] = {"type": "string"}
+        else:
+            return None
+    if not has_literal:
+        return None
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": signature.__name__,
+            "strict": True,
+            "schema": {"type": "object", "properties": properties, "required": list(properties),
+                       "additionalProperties": False},
+        },
+    }
+
+
+def supports_response_schema(lm) -> bool:
+    check = getattr(lm, "supports_response_schema", None)
+    if callable(check):
+        return check()
+    try:
+        return bool(litellm.supports_response_schema(model=lm.model))
+    except Exception:
+        return False
+
+
+def _sections(completion: str) -> Dict[str, str]:
+    sections, current, lines = {}, None, []
+    for line in completion.splitlines():
+        match = field_header_pattern.match(line.strip())
+        if match:
+            if current is not None and current not in sections:
+                sections[current] = "\n".join(lines).strip()
+            current, lines = match.group(1), []
+        else:
+            lines.append(line)
+    if current is not None and current not in sections:
+        sections[current] = "\n".join(lines).strip()
+    return sections
+
+
+def _json_fields(completion: str) -> Dict[str, Any]:
+    text = completion.strip()
+    if not text.startswith("{"):
+        return {}
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        value = json_repair.loads(text)
+    return value if isinstance(value, dict) else {}
+
+
+def parse_completion(signature, completion: str) -> Dict[str, Any]:
+    """
+    Output field values of a completion in any of the formats above.
+
+    A single-output signature takes the whole completion when no field markers are found. Literal
+    fields that can't be matched keep their raw text; callers decide how to treat it.
+    Raises ValueError only if an output field is missing altogether.
+    """
+    output_fields = signature.output_fields
+    raw = {k: v for k, v in _sections(completion).items() if k in output_fields}
+    if len(raw) < len(output_fields):
+        raw = {**{k: v for k, v in _json_fields(completion).items() if k in output_fields}, **raw}
+    if not raw and len(output_fields) == 1:
+        raw = {next(iter(output_fields)): field_header_pattern.sub("", completion).strip()}
+
+    missing = [name for name in output_fields if name not in raw]
+    if missing:
+        raise ValueError(f"Completion is missing output fields {missing} of {signature.__name__}")
+
+    values = {}
+    for name, field in output_fields.items():
+        value = raw[name]
+        options = literal_options(field.annotation)
+        if options is not None:
+            values[name] = coerce_literal(value, options) or str(value).strip()
+        elif field.annotation is str:
+            values[name] = str(value).strip()
+        else:
+            values[name] = parse_value(value, field.annotation)
+    return values
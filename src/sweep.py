@@ -0,0 +1,327 @@
+import argparse
+import itertools
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import dspy
+import numpy as np
+import pandas as pd
+
+from demo_selector import load_train_demos
+from evaluation import DEFAULT_K, NO_PREDICTION, answer_keys, score
+from metrics import get_store, metrics_context
+from misconception_index import MisconceptionIndex, load_misconception_index, top_columns
+from program_config import ProgramConfig
+from util import Persona
+
+#########################################################################################################################
+# Hyperparameter sweep over ExchangeOfThought modes, rounds and personas
+#
+# Every configuration answers the same sample of labelled (question, wrong option) pairs of
+# train.csv. Overlapping work is paid for once:
+#   * LM responses go through one disk cache (litellm) shared by all configurations and sweeps, so
+#     e.g. the first rounds of a 3-round run are served from the 2-round run of the same example;
+#   * the correct reasoning of each question, persona and context comes from one ReasoningStore,
+#     so an agent's first reasoning (before any context) is shared by every configuration;
+#   * finished (configuration, example) results are kept in results.sqlite3 and never recomputed.
+# Runs of one example that differ only in their number of rounds are scheduled in increasing order
+# on the same worker so the cache is warm. Predicted misconception texts are ranked against the
+# misconception names (BM25 + optional dense retrieval), optionally within the subject partitions of cooccurrence.py, and
+# scored with MAP@25 (evaluation.py).
+#
+#   python src/sweep.py --modes Report bigram --rounds 1 2 3 --personas none classic new --examples 50
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SWEEP_DIR = "./sweeps/default"
+
+# Modes that call agents with the full question; Debate/Memory/Relay pass a single question string.
+SWEEP_MODES = ("Report", "multi_4", "bigram")
+# Personas of agents A..E.
+PERSONA_SETS = {
+    "none": (None, None, None, None, None),
+    "classic": (Persona.AGENT_A, Persona.AGENT_B, Persona.AGENT_C, None, None),
+    "new": (Persona.AGENT_A_new, Persona.AGENT_B_new, Persona.AGENT_C_new, Persona.AGENT_D_new, Persona.AGENT_E_new),
+}
+
+
+@dataclass(frozen=True)
+class SweepConfig:
+    mode: str
+    rounds: int
+    personas: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.mode}-r{self.rounds}-{self.personas}"
+
+
+def sweep_configs(modes: Sequence[str], rounds: Sequence[int], personas: Sequence[str]) -> List[SweepConfig]:
+    for persona_set in personas:
+        if persona_set not in PERSONA_SETS:
+            raise ValueError(f"Unknown persona set {persona_set!r}; expected one of {list(PERSONA_SETS)}")
+    return [SweepConfig(mode, r, p) for mode, p, r in itertools.product(modes, personas, sorted(rounds))]
+
+
+def sample_examples(n: Optional[int] = None, seed: int = 0, q_data_path: str = "./data/train.csv",
+                    mis_data_path: str = "./data/misconception_mapping.csv") -> List[dspy.Example]:
+    """A reproducible sample of labelled (question, wrong option) pairs."""
+    examples = load_train_demos(q_data_path, mis_data_path)
+    if n is not None and n < len(examples):
+        examples = random.Random(seed).sample(examples, n)
+    return examples
+
+
+def example_key(example) -> int:
+    return int(answer_keys(example.QuestionId, "ABCD".index(example.Option)))
+
+
+class MisconceptionRanker:
+    """
+    Ranks misconception names against predicted misconception texts with the hybrid lexical + dense
+    index of misconception_index.py.
+
+    With a co-occurrence index (cooccurrence.py), a text whose SubjectName/ConstructName is known is
+    only compared with the misconceptions seen for them in train.csv, plus `prior_weight` times their
+    log prior; the rest of the ranking is filled from the unrestricted search.
+    """
+
+    def __init__(self, mis_data_path: str = "./data/misconception_mapping.csv", cooccurrence=None,
+                 prior_weight: float = 0.02, index: Optional[MisconceptionIndex] = None):
+        self.index = index or load_misconception_index(mis_data_path)
+        self.ids = self.index.ids
+        self.cooccurrence = cooccurrence
+        self.prior_weight = prior_weight
+        # MisconceptionId -> row of the index
+        self._rows = np.full(int(self.ids.max()) + 1, -1, dtype=np.int64)
+        self._rows[self.ids] = np.arange(len(self.ids))
+
+    def rank(self, texts: List[str], k: int = DEFAULT_K, subjects: Optional[Sequence[str]] = None,
+             constructs: Optional[Sequence[str]] = None) -> np.ndarray:
+        """(len(texts), k) MisconceptionIds, most similar first."""
+        if not texts:
+            return np.full((0, k), NO_PREDICTION, dtype=np.int64)
+        if self.cooccurrence is None or subjects is None:
+            return self.ids[top_columns(self.index.scores(texts), k)]
+
+        # Queries are scored against all names once; partitions only select columns.
+        lexical, dense = self.index.lexical_scores(texts), self.index.dense_scores(texts)
+        constructs = constructs if constructs is not None else [None] * len(texts)
+        partitions: Dict[tuple, List[int]] = {}
+        for i, partition in enumerate(zip(subjects, constructs)):
+            partitions.setdefault(partition, []).append(i)
+        ranked = np.full((len(texts), k), NO_PREDICTION, dtype=np.int64)
+        short = []
+        for (subject, construct), members in partitions.items():
+            candidates = self.cooccurrence.candidates(subject, construct)
+            if candidates is None:
+                short.extend(members)
+                continue
+            rows = self._rows[candidates[candidates < len(self._rows)]]
+            rows = rows[rows >= 0]
+            scores = self.index.fuse(lexical[members], dense[members] if dense is not None else None, rows)
+            scores += self.prior_weight * self.cooccurrence.prior(subject, construct)[self.ids[rows]]
+            best = rows[top_columns(scores, k)]
+            ranked[np.ix_(members, np.arange(best.shape[1]))] = self.ids[best]
+            if best.shape[1] < k:
+                short.extend(members)
+
+        # Unknown partitions and partitions with fewer than k candidates continue with the global ranking.
+        if short:
+            fused = self.index.fuse(lexical[short], dense[short] if dense is not None else None)
+            fallback = self.ids[top_columns(fused, 2 * k)]
+            for i, row in zip(short, fallback):
+                head = ranked[i][ranked[i] != NO_PREDICTION]
+                tail = row[~np.isin(row, head)]
+                ranked[i] = np.concatenate((head, tail))[:k]
+        return ranked
+
+
+class ResultStore:
+    """Predictions of finished (run, example) pairs, kept across sweeps."""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                run TEXT NOT NULL, key INTEGER NOT NULL, prediction TEXT, latency_s REAL, error TEXT,
+                truncated INTEGER, PRIMARY KEY (run, key)
+            )
+        """)
+
+    def done(self, run: str) -> set:
+        """Keys with a complete prediction; failed and truncated ones are run again."""
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM results WHERE run = ? AND error IS NULL AND truncated = 0",
+                                      (run,)).fetchall()
+        return {row[0] for row in rows}
+
+    def put(self, run: str, key: int, prediction: Optional[str], latency_s: float, error: Optional[str],
+            truncated: bool = False):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                               (run, key, prediction, latency_s, error, int(truncated)))
+
+    def results(self, run: str) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql_query("SELECT * FROM results WHERE run = ?", self._conn, params=(run,))
+
+
+def use_shared_lm_cache(cache_dir: str):
+    """Point the dspy/litellm disk cache of LM responses at `cache_dir` (shared across processes)."""
+    import litellm
+    from litellm.caching import Cache
+
+    litellm.cache = Cache(disk_cache_dir=cache_dir, type="disk")
+
+
+class Sweep:
+    def __init__(self, configs: List[SweepConfig], examples: List[dspy.Example], sweep_dir: str = DEFAULT_SWEEP_DIR,
+                 workers: int = 4, **program_options):
+        """
+        program_options: ProgramConfig fields every configuration shares (lm, compiled_path, timeout,
+        reasoning_store_path, ...).
+        """
+        self.configs = configs
+        self.examples = examples
+        self.sweep_dir = sweep_dir
+        self.workers = workers
+        self.results = ResultStore(os.path.join(sweep_dir, "results.sqlite3"))
+        program_configs = {config: ProgramConfig.from_sweep(config, **program_options) for config in configs}
+        lm = ProgramConfig(**program_options).build_lm()
+        self.programs = {config: program_config.build(lm) for config, program_config in program_configs.items()}
+        # Results are kept per configuration tag, so a rerun with other demos, timeout or LM starts afresh.
+        self.runs = {config: f"{config.name}-{program_config.meta(lm)['tag']}"
+                     for config, program_config in program_configs.items()}
+
+    def _run_group(self, example, configs: List[SweepConfig]):
+        # One example under configurations that differ only in rounds, fewest rounds first.
+        for config in configs:
+            start = time.perf_counter()
+            prediction, error, truncated = None, None, False
+            try:
+                with metrics_context(run=self.runs[config]):
+                    prediction = self.programs[config](
+                        QuestionText=example.QuestionText, AnswerText=example.AnswerText,
+                        ConstructName=example.ConstructName, SubjectName=example.SubjectName,
+                        CorrectAnswer=example.CorrectAnswer)
+                truncated = bool(getattr(prediction, "truncated", False))
+            except Exception as e:
+                logger.warning("%s failed on %s_%s: %r", config.name, example.QuestionId, example.Option, e)
+                error = repr(e)
+            self.results.put(self.runs[config], example_key(example), None if prediction is None else str(prediction),
+                             time.perf_counter() - start, error, truncated)
+
+    def run(self):
+        """Run every missing (configuration, example) pair on the worker pool."""
+        done = {config: self.results.done(self.runs[config]) for config in self.configs}
+        groups: Dict[tuple, List[SweepConfig]] = {}
+        for config in self.configs:
+            groups.setdefault((config.mode, config.personas), []).append(config)
+
+        tasks = []
+        for example in self.examples:
+            key = example_key(example)
+            for group in groups.values():
+                pending = sorted((c for c in group if key not in done[c]), key=lambda c: c.rounds)
+                if pending:
+                    tasks.append((example, pending))
+        logger.info("Sweep: %d configurations, %d examples, %d task groups to run",
+                    len(self.configs), len(self.examples), len(tasks))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sweep") as executor:
+            futures = [executor.submit(self._run_group, example, configs) for example, configs in tasks]
+            for i, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if i % 10 == 0 or i == len(futures):
+                    logger.info("Sweep: %d/%d task groups finished", i, len(futures))
+
+    def table(self, ranker: Optional[MisconceptionRanker] = None, k: int = DEFAULT_K) -> pd.DataFrame:
+        """One row per configuration: accuracy (MAP@k, recall@k), cost and latency on the sampled examples."""
+        ranker = ranker or MisconceptionRanker()
+        labels = {example_key(e): e.MisconceptionId for e in self.examples}
+        by_key = {example_key(e): e for e in self.examples}
+        totals = get_store(os.path.join(self.sweep_dir, "calls.sqlite3")).run_totals()
+        rows = []
+        for config in self.configs:
+            results = self.results.results(self.runs[config])
+            results = results[results["key"].isin(labels.keys())]
+            answered = results[results["error"].isna()]
+            # Failed or missing examples count as wrong answers.
+            predictions = np.full((len(labels), k), NO_PREDICTION, dtype=np.int64)
+            positions = {key: i for i, key in enumerate(labels)}
+            if len(answered):
+                examples = [by_key[key] for key in answered["key"]]
+                predictions[[positions[key] for key in answered["key"]]] = ranker.rank(
+                    answered["prediction"].fillna("").tolist(), k,
+                    subjects=[e.SubjectName for e in examples], constructs=[e.ConstructName for e in examples])
+            scores = score(predictions, np.array(list(labels.values())), k)
+            run_totals = totals.get(self.runs[config], {})
+            rows.append({
+                "run": self.runs[config], "mode": config.mode, "rounds": config.rounds, "personas": config.personas,
+                "examples": len(labels), "errors": int(results["error"].notna().sum()),
+                "truncated": int(results["truncated"].sum()),
+                **{name: value for name, value in scores.items() if name != "rows"},
+                "lm_calls": run_totals.get("lm_calls", 0), "cache_hits": run_totals.get("cache_hits", 0),
+                "prompt_tokens": run_totals.get("prompt_tokens", 0),
+                "completion_tokens": run_totals.get("completion_tokens", 0),
+                "cost_usd": run_totals.get("cost", 0.0),
+                "latency_mean_s": float(answered["latency_s"].mean()) if len(answered) else float("nan"),
+                "latency_p90_s": float(answered["latency_s"].quantile(0.9)) if len(answered) else float("nan"),
+            })
+        return pd.DataFrame(rows).sort_values(f"map@{k}", ascending=False).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep ExchangeOfThought over modes, rounds and personas.")
+    parser.add_argument("--modes", nargs="+", default=["Report"], choices=SWEEP_MODES)
+    parser.add_argument("--rounds", nargs="+", type=int, default=[1, 2])
+    parser.add_argument("--personas", nargs="+", default=["none", "new"], choices=list(PERSONA_SETS))
+    parser.add_argument("--examples", type=int, default=50, help="labelled (question, option) pairs per configuration")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=None, help="seconds per example (default: no deadline)")
+    parser.add_argument("--router", action="store_true", help="route requests to cheap/strong models (routing.py)")
+    parser.add_argument("--out", default=DEFAULT_SWEEP_DIR, help="sweep directory (results, metrics, table)")
+    parser.add_argument("--cache-dir", default="./cache/lm", help="LM response cache shared by all sweeps")
+    parser.add_argument("--reasoning-store", default="./cache/reasoning.sqlite3")
+    parser.add_argument("--compiled", default="./compiled_model.dspy")
+    parser.add_argument("--embedding-model", default=None,
+                        help="sentence-transformers model for dense misconception retrieval (default: BM25 only)")
+    parser.add_argument("--cooccurrence", action="store_true",
+                        help="rank within subject/construct partitions of train.csv (optimistic on train.csv examples)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    use_shared_lm_cache(args.cache_dir)
+    from config import metrics_callback
+
+    # Calls are recorded per run in the sweep directory instead of the app's metrics file.
+    metrics_callback.store = get_store(os.path.join(args.out, "calls.sqlite3"))
+    # No demo selector (the ProgramConfig default): it would pick the evaluated example itself from train.csv as a demo.
+    sweep = Sweep(sweep_configs(args.modes, args.rounds, args.personas), sample_examples(args.examples, args.seed),
+                  args.out, args.workers, lm="router" if args.router else "lambda",
+                  max_tokens=1000 if args.router else 100, compiled_path=args.compiled or None, timeout=args.timeout,
+                  reasoning_store_path=args.reasoning_store or None)
+    sweep.run()
+    cooccurrence = None
+    if args.cooccurrence:
+        from cooccurrence import load_cooccurrence_index
+        cooccurrence = load_cooccurrence_index()
+    ranker = MisconceptionRanker(cooccurrence=cooccurrence,
+                                 index=load_misconception_index(embedding_model=args.embedding_model))
+    table = sweep.table(ranker)
+    table.to_csv(os.path.join(args.out, "results.csv"), index=False)
+    with pd.option_context("display.max_columns", None, "display.width", 250):
+        print(table.round(4).to_string(index=False))
@@ -0,0 +1,217 @@
+import json
+import os
+import secrets
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+import dspy
+from dspy.utils.callback import BaseCallback
+
+from metrics import lm_history_entry
+
+#########################################################################################################################
+# Span tree tracing
+#
+# A span is recorded for each ExchangeOfThought.forward call, each round, each agent call and each
+# LM request (dspy and DashScope), with timings and token counts. When a root span ends, its whole
+# trace is appended to a JSON lines file in the OTLP/JSON format (one ExportTraceServiceRequest
+# per line), which OpenTelemetry collectors and viewers such as Jaeger can import. Spans ending after
+# their root (e.g. agent calls abandoned at a deadline) are exported on their own, as soon as they end.
+
+DEFAULT_TRACE_PATH = "./traces/traces.jsonl"
+SERVICE_NAME = "misconception-agents"
+# Number of exported trace ids remembered to recognise late spans
+MAX_EXPORTED_TRACES = 4096
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"] = None, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.kind = kind
+        self.attributes: Dict[str, Any] = {k: v for k, v in attributes.items() if v is not None}
+        self.events: List[dict] = []
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+
+    def set_attribute(self, key: str, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def record_exception(self, exception: BaseException):
+        self.status = STATUS_ERROR
+        self.status_message = repr(exception)
+        self.events.append({
+            "timeUnixNano": str(time.time_ns()),
+            "name": "exception",
+            "attributes": _otlp_attributes({
+                "exception.type": type(exception).__name__,
+                "exception.message": str(exception),
+                "exception.stacktrace": "".join(traceback.format_exception(type(exception), exception, exception.__traceback__)),
+            }),
+        })
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": self.events,
+            "status": {"code": self.status, "message": self.status_message},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+class Tracer:
+    def __init__(self, path: str = DEFAULT_TRACE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._finished: Dict[str, List[Span]] = {}
+        self._exported: "OrderedDict[str, None]" = OrderedDict()
+
+    def start_span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        """Start a child of the current span; returns (span, token) for `end_span`."""
+        span = Span(name, _current_span.get(), kind, **attributes)
+        return span, _current_span.set(span)
+
+    def end_span(self, span: Span, token=None, exception: Optional[BaseException] = None):
+        span.end_ns = time.time_ns()
+        if exception is not None:
+            span.record_exception(exception)
+        if token is not None:
+            _current_span.reset(token)
+        with self._lock:
+            if span.trace_id in self._exported:
+                # The root span already ended and its trace was exported.
+                spans = [span]
+            else:
+                spans = self._finished.setdefault(span.trace_id, [])
+                spans.append(span)
+                if span.parent_id is None:
+                    del self._finished[span.trace_id]
+                    self._exported[span.trace_id] = None
+                    if len(self._exported) > MAX_EXPORTED_TRACES:
+                        self._exported.popitem(last=False)
+                else:
+                    spans = None
+        if spans:
+            self.export(spans)
+
+    @contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        span, token = self.start_span(name, kind, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, token, e)
+            raise
+        self.end_span(span, token)
+
+    def export(self, spans: List[Span]):
+        request = {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps(request) + "\n")
+
+
+class TracingCallback(BaseCallback):
+    """dspy callback opening spans for ExchangeOfThought, named agents and LM requests."""
+
+    def __init__(self, tracer: Optional[Tracer] = None):
+        self.tracer = tracer or Tracer()
+        self._spans: Dict[str, tuple] = {}
+
+    def on_module_start(self, call_id, instance, inputs):
+        if hasattr(instance, "mode") and hasattr(instance, "rounds"):  # ExchangeOfThought
+            self._spans[call_id] = self.tracer.start_span(
+                f"{type(instance).__name__}.forward", mode=instance.mode, rounds=instance.rounds)
+        elif getattr(instance, "name", None):
+            self._spans[call_id] = self.tracer.start_span(
+                f"agent {instance.name}", **{"agent.name": instance.name, "agent.type": type(instance).__name__})
+
+    def on_module_end(self, call_id, outputs, exception=None):
+        if call_id in self._spans:
+            self.tracer.end_span(*self._spans.pop(call_id), exception=exception)
+
+    def on_lm_start(self, call_id, instance, inputs):
+        model = getattr(instance, "model", None)
+        self._spans[call_id] = (instance, *self.tracer.start_span(
+            f"lm {model}", SPAN_KIND_CLIENT, **{"gen_ai.request.model": model}))
+
+    def on_lm_end(self, call_id, outputs, exception=None):
+        if call_id not in self._spans:
+            return
+        instance, span, token = self._spans.pop(call_id)
+        usage = (lm_history_entry(instance, outputs) or {}).get("usage") or {}
+        span.set_attribute("gen_ai.usage.input_tokens", usage.get("prompt_tokens"))
+        span.set_attribute("gen_ai.usage.output_tokens", usage.get("completion_tokens"))
+        self.tracer.end_span(span, token, exception)
+
+
+def active_tracer() -> Optional[Tracer]:
+    for callback in dspy.settings.get("callbacks") or []:
+        if isinstance(callback, TracingCallback):
+            return callback.tracer
+    return None
+
+
+@contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """Span under the current one when tracing is enabled; yields None otherwise."""
+    tracer = active_tracer()
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(name, kind, **attributes) as current:
+        yield current
+
+
+def record_exception(exception: BaseException):
+    """Mark the current span as failed (for exceptions that are handled, not raised)."""
+    current = _current_span.get()
+    if current is not None:
+        current.record_exception(exception)
@@ -1,10 +1,53 @@
 import os
+import time
 from typing import Literal
 #from typing import override
 
 import dspy
 from dotenv import load_dotenv
 
+from metrics import lm_history_entry
+from structured_output import parse_completion, response_format_for, supports_response_schema
+from resilience import DEFAULT_TIMEOUT, call_with_retry, get_limiter
+
+def estimate_tokens(text) -> int:
+    """Cheap token count estimate (~4 characters per token) used for prompt budgets."""
+    return len(str(text)) // 4 + 1
+
+
+class RateLimitedLM(dspy.LM):
+    """dspy.LM whose requests go through the shared per-provider limiter and retry policy (resilience.py).
+
+    litellm's own retries are disabled so that backoff, deadlines and rate-limit headers are handled
+    in one place for every client.
+    """
+
+    def __init__(self, model: str, rate_limit_key: str = None, timeout: float = DEFAULT_TIMEOUT, **kwargs):
+        kwargs.setdefault("num_retries", 0)
+        # Client-side timeout: a request abandoned at its deadline doesn't hold its worker thread for
+        # longer than this. It is constant, so it doesn't change the cache key of a request.
+        kwargs.setdefault("timeout", timeout)
+        super().__init__(model, **kwargs)
+        # Only the key is stored: limiters hold locks and LM.copy() deep-copies the instance.
+        self.rate_limit_key = rate_limit_key or model.split("/")[0]
+        self.timeout = timeout
+
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        estimated = estimate_tokens(messages or prompt) + kwargs.get("max_tokens", self.kwargs.get("max_tokens", 0))
+        limiter = get_limiter(self.rate_limit_key)
+
+        def request():
+            outputs = super(RateLimitedLM, self).__call__(prompt=prompt, messages=messages, **kwargs)
+            entry = lm_history_entry(self, outputs) or {}
+            response = entry.get("response")
+            hidden_params = getattr(response, "_hidden_params", None) or {}
+            limiter.update_from_headers(hidden_params.get("additional_headers"))
+            limiter.settle(estimated, (entry.get("usage") or {}).get("total_tokens", estimated))
+            return outputs
+
+        return call_with_retry(request, self.rate_limit_key, estimated, time.monotonic() + self.timeout)
+
+
 class LanguageModel:
     def __init__(self, max_tokens: int = 100, service: Literal['lambda', 'openai'] = 'lambda'):
         load_dotenv()
@@ -17,15 +60,15 @@ class LanguageModel:
             if not os.getenv('LAMBDA_API_MODEL') or not os.getenv('LAMBDA_API_KEY') or not os.getenv('LAMBDA_API_BASE'):
                 raise EnvironmentError(
                     "LAMBDA_API_MODEL, LAMBDA_API_KEY, or LAMBDA_API_BASE not found in environment variables.")
-            self.lm = dspy.LM(f"openai/{os.getenv('LAMBDA_API_MODEL')}", max_tokens=max_tokens, api_key=os.getenv("LAMBDA_API_KEY"),
-                    api_base=os.getenv("LAMBDA_API_BASE"))
+            self.lm = RateLimitedLM(f"openai/{os.getenv('LAMBDA_API_MODEL')}", rate_limit_key='lambda', max_tokens=max_tokens,
+                    api_key=os.getenv("LAMBDA_API_KEY"), api_base=os.getenv("LAMBDA_API_BASE"))
         elif service == 'openai':
             OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
             if not OPENAI_API_KEY:
                 raise EnvironmentError(
                     "OPENAI_API_KEY not found in environment variables.")
             os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-            self.lm = dspy.LM('openai/gpt-4o-mini', max_tokens=max_tokens)
+            self.lm = RateLimitedLM('openai/gpt-4o-mini', rate_limit_key='openai', max_tokens=max_tokens)
 
         assert self.lm is not None, "Language Model not initialized"
         return self.lm
@@ -53,49 +96,123 @@ class Persona:
 
 
 # chat_adapter_wrapper.py
+from collections import OrderedDict
 from typing import Any, Dict
 
 
 class PrefixedChatAdapter(dspy.adapters.chat_adapter.ChatAdapter):
-    # def __init__(self, callbacks=None):
-    #     super().__init__(callbacks=callbacks)
-    #     self.prefix = prefix
+    """ChatAdapter that puts the agent's persona prefix in front of the system message.
+
+    The system message only depends on (signature, prefix) and the formatted demo turns only
+    depend on (signature, demo set), so both are built once and cached. Per call only the user
+    turn for the current inputs is formatted. Demos are treated as immutable once they are
+    attached to a predictor, which is how dspy uses them.
+
+    If a `demo_selector` (see demo_selector.py) is set, only the demos it picks for the current
+    inputs are sent instead of every stored demo of the predictor.
+
+    Completions are parsed tolerantly (structured_output.py) and never re-requested through the
+    JSONAdapter fallback of dspy; with `structured_outputs`, signatures with Literal outputs are
+    requested with a JSON schema when the LM supports it.
+    """
+
+    def __init__(self, callbacks=None, max_cache_size: int = 512, demo_selector=None, structured_outputs: bool = True):
+        super().__init__(callbacks=callbacks)
+        self.max_cache_size = max_cache_size
+        self.demo_selector = demo_selector
+        self.structured_outputs = structured_outputs
+        self._system_cache: Dict[tuple, str] = {}
+        self._demo_cache: OrderedDict = OrderedDict()
+
+    def _system_message(self, signature, prefix) -> str:
+        key = (signature, prefix)
+        instructions = self._system_cache.get(key)
+        if instructions is None:
+            prepared_instructions = dspy.adapters.chat_adapter.prepare_instructions(signature)
+            instructions = f"{prefix}\n{prepared_instructions}" if prefix is not None else prepared_instructions
+            if len(self._system_cache) >= self.max_cache_size:
+                self._system_cache.clear()
+            self._system_cache[key] = instructions
+        return instructions
+
+    def _demo_messages(self, signature, demos) -> list[dict[str, Any]]:
+        if not demos:
+            return []
+
+        # Demo objects are keyed by identity; the cache entry keeps them alive so ids can't be reused.
+        key = (signature, tuple(id(demo) for demo in demos))
+        entry = self._demo_cache.get(key)
+        if entry is not None:
+            self._demo_cache.move_to_end(key)
+            return entry[1]
+
+        # Single linear pass instead of `demo not in incomplete_demos` (quadratic dict comparisons).
+        fields = list(signature.fields)
+        incomplete_demos, complete_demos = [], []
+        for demo in demos:
+            if all(k in demo and demo[k] is not None for k in fields):
+                complete_demos.append(demo)
+            else:
+                incomplete_demos.append(demo)
+
+        messages: list[dict[str, Any]] = []
+        for demos_group, incomplete in ((incomplete_demos, True), (complete_demos, False)):
+            for demo in demos_group:
+                messages.append(self.format_turn(signature, demo, role="user", incomplete=incomplete))
+                messages.append(self.format_turn(signature, demo, role="assistant", incomplete=incomplete))
+
+        self._demo_cache[key] = (list(demos), messages)
+        if len(self._demo_cache) > self.max_cache_size:
+            self._demo_cache.popitem(last=False)
+        return messages
+
+    def clear_cache(self):
+        self._system_cache.clear()
+        self._demo_cache.clear()
 
     #@override
     def format(self, signature: dspy.signatures.signature.Signature, demos: list[dict[str, Any]], inputs: dict[str, Any]) -> list[dict[str, Any]]:
-        # Get the prepared instructions from the original ChatAdapter.
-        # print("Custom PrefixedChatAdapter format method called")
-        prepared_instructions = dspy.adapters.chat_adapter.prepare_instructions(signature)
-
         # Add the desired prefix.
         prefix = inputs.pop("prefix", None)
 
-        if prefix is not None:
-            instructions = f"{prefix}\n{prepared_instructions}"
-        else:
-            instructions = prepared_instructions
+        if self.demo_selector is not None:
+            demos = self.demo_selector.select(signature, demos, inputs)
 
-        # Add the prefixed instructions to the messages.
         # noinspection PyListCreation
         messages: list[dict[str, Any]] = []
-        messages.append({"role": "system", "content": instructions})
-
-        # Proceed with the rest of the logic as per the original `format` method.
-        incomplete_demos = [
-            demo for demo in demos if not all(k in demo and demo[k] is not None for k in signature.fields)
-        ]
-        complete_demos = [demo for demo in demos if demo not in incomplete_demos]
+        messages.append({"role": "system", "content": self._system_message(signature, prefix)})
 
-        demos = incomplete_demos + complete_demos
-
-        for demo in demos:
-            messages.append(self.format_turn(signature, demo, role="user", incomplete=demo in incomplete_demos))
-            messages.append(self.format_turn(signature, demo, role="assistant", incomplete=demo in incomplete_demos))
+        # The cached turns are shared between calls, so hand out shallow copies of the message dicts.
+        messages.extend(dict(message) for message in self._demo_messages(signature, demos))
 
         messages.append(self.format_turn(signature, inputs, role="user"))
         return messages
 
+    def __call__(self, lm, lm_kwargs, signature, demos, inputs, _parse_values=True):
+        messages = self.format(signature, demos, inputs)
+
+        lm_kwargs = dict(lm_kwargs)
+        if self.structured_outputs and "response_format" not in lm_kwargs and supports_response_schema(lm):
+            response_format = response_format_for(signature)
+            if response_format is not None:
+                lm_kwargs["response_format"] = response_format
+
+        values = []
+        for output in lm(messages=messages, **lm_kwargs):
+            logprobs = None
+            if isinstance(output, dict):
+                output, logprobs = output["text"], output.get("logprobs")
+            value = self.parse(signature, output, _parse_values=_parse_values)
+            if logprobs is not None:
+                value["logprobs"] = logprobs
+            values.append(value)
+        return values
+
+    def parse(self, signature, completion, _parse_values=True):
+        if not _parse_values:
+            return super().parse(signature, completion, _parse_values=False)
+        return parse_completion(signature, completion)
+
 # Example usage:
-# Assuming you have an instance of signature, demos, and inputs
-# adapter = PrefixedChatAdapter(prefix="Custom Prefix: ")
-# messages = adapter.format(signature, demos, inputs)
+# adapter = PrefixedChatAdapter()
+# messages = adapter.format(signature, demos, {**inputs, "prefix": "Custom Prefix: "})
@@ -0,0 +1,382 @@
+import hmac
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.request
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+#########################################################################################################################
+# Leased work queue for batch scoring with several workers
+#
+# Tasks are (key, payload) pairs. A worker leases a few tasks for `lease_s` seconds and keeps the
+# lease alive with heartbeats while it works; a task whose lease runs out (the worker died or lost
+# the network) goes back to the queue and is handed to another worker. Results are stored with
+# the task, so partial runs can be merged at any time.
+#
+# SQLiteWorkQueue is the shared backend: one database file on a local disk, used by any number of
+# worker processes on that machine, with leases taken in IMMEDIATE transactions so two workers
+# never get the same task. That guarantee rests on SQLite's file locks, which NFS/SMB shares and
+# synced volumes don't implement reliably: there two workers can lease the same task or corrupt
+# the file, so keep the queue off them. Workers on other hosts reach the file through QueueServer,
+# a small HTTP coordinator running next to it, with HTTPWorkQueue as their client. MemoryWorkQueue
+# has the same interface within one process and stands in for it in local runs, experiments and
+# tests.
+#
+#   server = QueueServer(SQLiteWorkQueue("./cache/test.queue"), port=8765, token="secret")  # coordinator
+#   queue = open_queue("http://coordinator:8765", token="secret")                          # any host
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+@dataclass(frozen=True)
+class Task:
+    key: int
+    payload: Dict[str, Any]
+    attempts: int
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+
+
+class SQLiteWorkQueue:
+    def __init__(self, path: str, max_attempts: int = 3):
+        """
+        path: the queue file, on a local disk (not a network share; see above).
+        max_attempts: leases a task gets before it is marked failed (expired leases count too).
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        # Rollback journal instead of WAL: the queue stays a single file that can be copied between runs.
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                key INTEGER PRIMARY KEY, payload TEXT NOT NULL, status TEXT NOT NULL, worker TEXT,
+                lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT, updated REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_until)")
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, tasks: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        """Add tasks that aren't queued yet; returns how many were added."""
+        rows = [(int(key), json.dumps(payload), PENDING, time.time()) for key, payload in tasks]
+        return self._transaction(lambda conn: conn.executemany(
+            "INSERT OR IGNORE INTO tasks (key, payload, status, updated) VALUES (?, ?, ?, ?)", rows).rowcount)
+
+    def lease(self, worker: str, n: int = 1, lease_s: float = 120.0) -> List[Task]:
+        """Up to n pending tasks or tasks whose lease expired, leased to `worker`."""
+        def statements(conn):
+            now = time.time()
+            # Expired leases that used up their attempts are given up on.
+            conn.execute("UPDATE tasks SET status = ?, error = 'lease expired', updated = ? "
+                         "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                         (FAILED, now, LEASED, now, self.max_attempts))
+            rows = conn.execute(
+                "SELECT key, payload, attempts FROM tasks WHERE status = ? OR (status = ? AND lease_until < ?) "
+                "ORDER BY attempts, key LIMIT ?", (PENDING, LEASED, now, n)).fetchall()
+            conn.executemany("UPDATE tasks SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, "
+                             "updated = ? WHERE key = ?",
+                             [(LEASED, worker, now + lease_s, now, key) for key, _, _ in rows])
+            return [Task(key, json.loads(payload), attempts + 1) for key, payload, attempts in rows]
+        return self._transaction(statements)
+
+    def heartbeat(self, worker: str, keys: Iterable[int], lease_s: float = 120.0) -> int:
+        """Extend the worker's leases on `keys`; returns how many it still holds."""
+        keys = list(keys)
+        if not keys:
+            return 0
+        now = time.time()
+        return self._transaction(lambda conn: conn.executemany(
+            "UPDATE tasks SET lease_until = ?, updated = ? WHERE key = ? AND worker = ? AND status = ?",
+            [(now + lease_s, now, key, worker, LEASED) for key in keys]).rowcount)
+
+    def complete(self, key: int, worker: str, result: Any) -> bool:
+        """Store a result; the first result of a task wins, even if its lease had moved to another worker."""
+        now = time.time()
+        return bool(self._transaction(lambda conn: conn.execute(
+            "UPDATE tasks SET status = ?, worker = ?, result = ?, error = NULL, updated = ? WHERE key = ? AND status != ?",
+            (DONE, worker, json.dumps(result), now, key, DONE)).rowcount))
+
+    def fail(self, key: int, worker: str, error: str):
+        """Give the task back (or mark it failed after max_attempts)."""
+        now = time.time()
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, lease_until = NULL, "
+            "error = ?, updated = ? WHERE key = ? AND worker = ? AND status = ?",
+            (self.max_attempts, FAILED, PENDING, str(error), now, key, worker, LEASED)))
+
+    def retry_failed(self) -> int:
+        """Put failed tasks back in the queue with fresh attempts."""
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE tasks SET status = ?, attempts = 0, worker = NULL, lease_until = NULL WHERE status = ?",
+            (PENDING, FAILED)).rowcount)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def results(self) -> Dict[int, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, result FROM tasks WHERE status = ?", (DONE,)).fetchall()
+        return {key: json.loads(result) for key, result in rows}
+
+    def finished(self) -> bool:
+        counts = self.counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+
+class MemoryWorkQueue:
+    """SQLiteWorkQueue for a single process, without a file."""
+
+    def __init__(self, max_attempts: int = 3):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._tasks: Dict[int, dict] = {}
+
+    def enqueue(self, tasks: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        added = 0
+        with self._lock:
+            for key, payload in tasks:
+                if int(key) not in self._tasks:
+                    self._tasks[int(key)] = {"payload": payload, "status": PENDING, "worker": None,
+                                             "lease_until": None, "attempts": 0, "result": None, "error": None}
+                    added += 1
+        return added
+
+    def lease(self, worker: str, n: int = 1, lease_s: float = 120.0) -> List[Task]:
+        now = time.time()
+        leased = []
+        with self._lock:
+            for task in self._tasks.values():
+                if task["status"] == LEASED and task["lease_until"] < now and task["attempts"] >= self.max_attempts:
+                    task.update(status=FAILED, error="lease expired")
+            available = [(task["attempts"], key) for key, task in self._tasks.items()
+                         if task["status"] == PENDING or (task["status"] == LEASED and task["lease_until"] < now)]
+            for _, key in sorted(available)[:n]:
+                task = self._tasks[key]
+                task.update(status=LEASED, worker=worker, lease_until=now + lease_s, attempts=task["attempts"] + 1)
+                leased.append(Task(key, task["payload"], task["attempts"]))
+        return leased
+
+    def heartbeat(self, worker: str, keys: Iterable[int], lease_s: float = 120.0) -> int:
+        held = 0
+        with self._lock:
+            for key in keys:
+                task = self._tasks.get(key)
+                if task and task["worker"] == worker and task["status"] == LEASED:
+                    task["lease_until"] = time.time() + lease_s
+                    held += 1
+        return held
+
+    def complete(self, key: int, worker: str, result: Any) -> bool:
+        with self._lock:
+            task = self._tasks[key]
+            if task["status"] == DONE:
+                return False
+            task.update(status=DONE, worker=worker, result=result, error=None)
+            return True
+
+    def fail(self, key: int, worker: str, error: str):
+        with self._lock:
+            task = self._tasks[key]
+            if task["worker"] == worker and task["status"] == LEASED:
+                task.update(status=FAILED if task["attempts"] >= self.max_attempts else PENDING,
+                            worker=None, lease_until=None, error=str(error))
+
+    def retry_failed(self) -> int:
+        with self._lock:
+            failed = [task for task in self._tasks.values() if task["status"] == FAILED]
+            for task in failed:
+                task.update(status=PENDING, attempts=0, worker=None, lease_until=None)
+        return len(failed)
+
+    def counts(self) -> Dict[str, int]:
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        with self._lock:
+            for task in self._tasks.values():
+                counts[task["status"]] += 1
+        return counts
+
+    def results(self) -> Dict[int, Any]:
+        with self._lock:
+            return {key: task["result"] for key, task in self._tasks.items() if task["status"] == DONE}
+
+    def finished(self) -> bool:
+        counts = self.counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+
+#########################################################################################################################
+# HTTP coordinator for workers on other hosts
+
+# Queue methods a QueueServer exposes, as POST /<method> with the keyword arguments as a JSON object.
+QUEUE_METHODS = ("enqueue", "lease", "heartbeat", "complete", "fail", "retry_failed", "counts", "results")
+
+
+class QueueServer(ThreadingHTTPServer):
+    """Serves a queue (usually a SQLiteWorkQueue on this host's disk) to HTTPWorkQueue clients."""
+
+    daemon_threads = True
+
+    def __init__(self, queue, host: str = "0.0.0.0", port: int = 8765, token: Optional[str] = None):
+        """token: shared secret the clients send in X-Queue-Token; None accepts every client."""
+        self.queue = queue
+        self.token = token
+        super().__init__((host, port), _QueueHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{'127.0.0.1' if host in ('0.0.0.0', '') else host}:{port}"
+
+    def start(self) -> "QueueServer":
+        """Serve on a background thread until stop()."""
+        threading.Thread(target=self.serve_forever, name="queue-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _QueueHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        method = self.path.strip("/")
+        if server.token is not None and not hmac.compare_digest(self.headers.get("X-Queue-Token", ""), server.token):
+            return self._reply(403, {"error": "bad token"})
+        if method not in QUEUE_METHODS:
+            return self._reply(404, {"error": f"unknown method {method!r}"})
+        try:
+            kwargs = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            result = getattr(server.queue, method)(**kwargs)
+        except (TypeError, ValueError, KeyError) as e:
+            return self._reply(400, {"error": repr(e)})
+        if method == "lease":
+            result = [asdict(task) for task in result]
+        elif method == "results":
+            result = [[key, value] for key, value in result.items()]
+        self._reply(200, {"result": result})
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # One line per request would drown the coordinator's own log.
+        pass
+
+
+class HTTPWorkQueue:
+    """Client of a QueueServer with the SQLiteWorkQueue interface; network errors raise OSError."""
+
+    def __init__(self, url: str, token: Optional[str] = None, timeout: float = 30.0):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+
+    def _call(self, method: str, **kwargs):
+        request = urllib.request.Request(f"{self.url}/{method}", data=json.dumps(kwargs).encode("utf-8"), method="POST",
+                                         headers={"Content-Type": "application/json", "X-Queue-Token": self.token or ""})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())["result"]
+
+    def enqueue(self, tasks: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        return self._call("enqueue", tasks=[[int(key), payload] for key, payload in tasks])
+
+    def lease(self, worker: str, n: int = 1, lease_s: float = 120.0) -> List[Task]:
+        return [Task(**task) for task in self._call("lease", worker=worker, n=n, lease_s=lease_s)]
+
+    def heartbeat(self, worker: str, keys: Iterable[int], lease_s: float = 120.0) -> int:
+        return self._call("heartbeat", worker=worker, keys=[int(key) for key in keys], lease_s=lease_s)
+
+    def complete(self, key: int, worker: str, result: Any) -> bool:
+        return self._call("complete", key=int(key), worker=worker, result=result)
+
+    def fail(self, key: int, worker: str, error: str):
+        self._call("fail", key=int(key), worker=worker, error=str(error))
+
+    def retry_failed(self) -> int:
+        return self._call("retry_failed")
+
+    def counts(self) -> Dict[str, int]:
+        return self._call("counts")
+
+    def results(self) -> Dict[int, Any]:
+        return {int(key): value for key, value in self._call("results")}
+
+    def finished(self) -> bool:
+        counts = self.counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+
+def open_queue(spec: str, token: Optional[str] = None, max_attempts: int = 3):
+    """An HTTPWorkQueue for an http(s):// URL of a QueueServer, else a SQLiteWorkQueue file."""
+    if spec.startswith(("http://", "https://")):
+        return HTTPWorkQueue(spec, token)
+    return SQLiteWorkQueue(spec, max_attempts)
+
+
+class Heartbeat:
+    """Background thread that keeps a worker's current leases alive."""
+
+    def __init__(self, queue, worker: str, lease_s: float = 120.0, interval_s: Optional[float] = None):
+        self.queue = queue
+        self.worker = worker
+        self.lease_s = lease_s
+        self.interval_s = interval_s or lease_s / 3
+        self.keys: set = set()
+        self._keys_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{worker}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            with self._keys_lock:
+                keys = list(self.keys)
+            try:
+                self.queue.heartbeat(self.worker, keys, self.lease_s)
+            except (sqlite3.Error, OSError):
+                # A missed beat (locked file, network error) only shortens the lease; the next one may get through.
+                pass
+
+    def hold(self, key: int):
+        with self._keys_lock:
+            self.keys.add(key)
+
+    def release(self, key: int):
+        with self._keys_lock:
+            self.keys.discard(key)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
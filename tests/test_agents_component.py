@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from agents_component import MAX_SPECULATIVE_BATCHES, SolveAgent_api
+from resilience import LMError
+
+
+class ScriptedSolveAgent(SolveAgent_api):
+    """SolveAgent_api whose reasoning requests and judge verdicts are scripted."""
+
+    def __init__(self, reasoning, verdict, samples=3):
+        super().__init__("Agent X", speculative_samples=samples)
+        self.reasoning = reasoning
+        self.verdict = verdict
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get_reasoning(self, query, answer):
+        # Samples run on several threads.
+        with self._lock:
+            self.requests += 1
+            n = self.requests
+        return self.reasoning(n)
+
+    def _judge(self, context, QuestionText, ConstructName, SubjectName, CorrectAnswer):
+        return self.verdict(context)
+
+
+def _reason(agent):
+    return agent._speculative_reasoning("Agent A concludes: (x)", "1 + 1", "", "", "2")
+
+
+def test_reasoning_starts_on_a_new_line():
+    agent = ScriptedSolveAgent(lambda n: "1. add", lambda context: True)
+
+    assert _reason(agent) == "Agent A concludes: (x)\nReasoning result: 1. add \n"
+
+
+def test_rejected_batches_stop_after_the_cap():
+    agent = ScriptedSolveAgent(lambda n: f"attempt {n}", lambda context: False)
+
+    context = _reason(agent)
+
+    assert agent.requests == MAX_SPECULATIVE_BATCHES * 3
+    assert context.startswith("Agent A concludes: (x)\nReasoning result: attempt ")
+
+
+def test_partly_failing_batches_stop_after_the_cap():
+    def reasoning(n):
+        if n % 3:
+            raise LMError("dashscope down")
+        return f"attempt {n}"
+
+    agent = ScriptedSolveAgent(reasoning, lambda context: False)
+
+    assert "Reasoning result: attempt" in _reason(agent)
+    assert agent.requests == MAX_SPECULATIVE_BATCHES * 3
+
+
+def test_a_batch_of_errors_is_raised():
+    def reasoning(n):
+        raise LMError("dashscope down")
+
+    agent = ScriptedSolveAgent(reasoning, lambda context: True)
+
+    with pytest.raises(LMError):
+        _reason(agent)
+    assert agent.requests == 3
@@ -0,0 +1,51 @@
+import threading
+
+from chat_history import ChatHistory
+
+
+def _summarize(summary, turns):
+    return " ".join([summary, *(user["content"] for user, _ in turns)]).strip()
+
+
+def test_old_turns_are_folded_into_the_summary():
+    history = ChatHistory("system", _summarize, keep_turns=2)
+    for i in range(5):
+        history.add_turn(f"q{i}", f"a{i}")
+
+    assert history.wait(timeout=5)
+    assert history.summary == "q0 q1 q2"
+    assert [message["content"] for message in history.messages("q5")] == [
+        "system", "Summary of the earlier conversation:\nq0 q1 q2", "q3", "a3", "q4", "a4", "q5"]
+
+
+def test_sessions_share_the_summary_threads():
+    before = {thread.name for thread in threading.enumerate()}
+    histories = [ChatHistory("system", _summarize, keep_turns=1) for _ in range(50)]
+    for history in histories:
+        history.add_turn("q0", "a0")
+        history.add_turn("q1", "a1")
+
+    assert all(history.wait(timeout=5) for history in histories)
+    started = {thread.name for thread in threading.enumerate()} - before
+    assert len([name for name in started if name.startswith("chat-summary")]) <= 4
+    assert all(history.summary == "q0" for history in histories)
+
+
+def test_failed_folds_are_retried_after_the_next_turn():
+    calls = []
+
+    def flaky(summary, turns):
+        calls.append(len(turns))
+        if len(calls) == 1:
+            raise RuntimeError("rate limited")
+        return _summarize(summary, turns)
+
+    history = ChatHistory("system", flaky, keep_turns=1)
+    history.add_turn("q0", "a0")
+    history.add_turn("q1", "a1")
+    assert history.wait(timeout=5)
+    assert history.stats["fold_errors"] == 1
+
+    history.add_turn("q2", "a2")
+    assert history.wait(timeout=5)
+    assert history.summary == "q0 q1"
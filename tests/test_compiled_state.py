@@ -0,0 +1,84 @@
+import json
+import os
+
+import dspy
+
+from compiled_state import CACHE_SUFFIX, CompiledState, LazyDemos, compiled_names, load_compiled_program
+
+DEMO = {"question": "What is 2 + 3 x 4?", "answer": "Adds before multiplying"}
+
+
+class Step(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.process = dspy.Predict("question -> answer")
+
+
+class Agent(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.fin_agent = Step()
+        self.mis_agent = Step()
+
+
+class Program(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.agent_a = Agent()
+        self.agent_b = Agent()
+
+
+def _write_compiled(path, state):
+    with open(path, "w") as f:
+        json.dump(state, f)
+    return str(path)
+
+
+def test_lazy_demos_are_materialized_on_first_access():
+    demos = LazyDemos([DEMO, DEMO])
+
+    assert len(demos) == 2 and not demos.materialized
+    assert demos[0].answer == "Adds before multiplying"
+    assert demos.materialized
+    assert [demo.question for demo in demos] == [DEMO["question"]] * 2
+
+
+def test_compiled_names_map_renamed_predictors_to_their_legacy_names():
+    assert compiled_names("agent_a.fin_agent.process") == ["agent_a.fin_agent.process", "agent_a.process"]
+    assert compiled_names("agent_a.mis_agent.process") == ["agent_a.mis_agent.process", "agent_a.reasoning_agent.process"]
+    assert compiled_names("agent_a.judge") == ["agent_a.judge"]
+
+
+def test_legacy_demos_are_attached_and_shared_between_programs(tmp_path):
+    path = _write_compiled(tmp_path / "compiled.dspy", {
+        "agent_a.process": {"demos": [DEMO]},
+        "agent_a.reasoning_agent.process": {"demos": [DEMO, DEMO]},
+        # The exact name wins over the legacy one.
+        "agent_b.process": {"demos": [DEMO]},
+        "agent_b.fin_agent.process": {"demos": [DEMO, DEMO, DEMO]},
+    })
+    first, second = Program(), Program()
+
+    attached = load_compiled_program(first, path)
+    load_compiled_program(second, path)
+
+    assert sorted(attached) == ["agent_a.fin_agent.process", "agent_a.mis_agent.process", "agent_b.fin_agent.process"]
+    assert len(first.agent_a.fin_agent.process.demos) == 1
+    assert len(first.agent_a.mis_agent.process.demos) == 2
+    assert len(first.agent_b.fin_agent.process.demos) == 3
+    assert first.agent_b.mis_agent.process.demos == []
+    assert first.agent_a.fin_agent.process.demos is second.agent_a.fin_agent.process.demos
+    assert not first.agent_a.fin_agent.process.demos.materialized
+
+
+def test_a_changed_file_is_parsed_again_instead_of_served_from_the_cache(tmp_path):
+    path = _write_compiled(tmp_path / "compiled.dspy", {"agent_a.process": {"demos": [DEMO]}})
+    assert len(CompiledState.load(path).demos("agent_a.process")) == 1
+    assert os.path.exists(path + CACHE_SUFFIX)
+
+    _write_compiled(path, {"agent_a.process": {"demos": [DEMO, DEMO]}, "agent_b.process": {"demos": []}})
+    os.utime(path, ns=(0, 1))
+
+    state = CompiledState.load(path)
+    assert len(state.demos("agent_a.process")) == 2
+    assert state.demos("agent_c.process") is None
@@ -0,0 +1,38 @@
+import dspy
+
+from demo_selector import DemoSelector
+
+
+class Signature:
+    input_fields = {"QuestionText": None, "AnswerText": None}
+    output_fields = {"MisconceptionText": None}
+
+
+def _demo(question_id, question, answer, misconception):
+    return dspy.Example(QuestionId=question_id, Option="B", QuestionText=question, AnswerText=answer,
+                        SubjectName="BIDMAS", ConstructName="Use the order of operations",
+                        CorrectAnswer="14", MisconceptionText=misconception, MisconceptionId=question_id)
+
+
+POOL = [
+    _demo(1, r"What is \( 2+3 \times 4 \)?", r"\( 20 \)", "Carries out operations from left to right"),
+    _demo(2, r"What is \( 5+2 \times 3 \)?", r"\( 21 \)", "Carries out operations from left to right"),
+    _demo(3, r"What is \( 16-12 \div 4 \)?", r"\( 1 \)", "Carries out operations from left to right"),
+]
+
+
+def test_skips_demos_of_the_quiz_question():
+    selector = DemoSelector(POOL, k=3)
+    # The quiz shows train.csv questions with $ delimiters, and asks about another wrong option.
+    selected = selector.select(Signature, [], {"QuestionText": "What is $2+3 \\times 4$?", "AnswerText": "$24$",
+                                               "SubjectName": "BIDMAS", "ConstructName": "Use the order of operations"})
+
+    assert [demo.QuestionId for demo in selected] == [2, 3]
+
+
+def test_skips_demos_with_the_query_question_id():
+    selector = DemoSelector(POOL, k=3)
+    selected = selector.select(Signature, [], {"QuestionId": 2, "QuestionText": "Another wording", "AnswerText": "21"})
+
+    assert 2 not in [demo.QuestionId for demo in selected]
+    assert len(selected) == 2
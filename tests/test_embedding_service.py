@@ -0,0 +1,113 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from embedding_service import EmbeddingService
+
+DIMENSION = 8
+
+
+class FakeModel:
+    """Deterministic unit vectors per text; records the texts of every encode call."""
+
+    def __init__(self, delay_s: float = 0.0, error: Exception = None):
+        self.delay_s = delay_s
+        self.error = error
+        self.calls = []
+
+    def encode(self, texts, batch_size, normalize_embeddings, convert_to_numpy, show_progress_bar):
+        self.calls.append(list(texts))
+        time.sleep(self.delay_s)
+        if self.error is not None:
+            raise self.error
+        return np.stack([vector(text) for text in texts])
+
+    def get_sentence_embedding_dimension(self):
+        return DIMENSION
+
+
+def vector(text) -> np.ndarray:
+    values = np.random.default_rng(abs(hash(text)) % 2 ** 32).standard_normal(DIMENSION).astype(np.float32)
+    return values / np.linalg.norm(values)
+
+
+def _embed_concurrently(service, requests):
+    results = [None] * len(requests)
+    start = threading.Barrier(len(requests))
+
+    def run(i):
+        start.wait()
+        results[i] = service(requests[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results
+
+
+def test_concurrent_callers_share_batches():
+    model = FakeModel(delay_s=0.02)
+    service = EmbeddingService(model, max_wait_ms=50)
+    requests = [[f"thought {i}", "shared query"] for i in range(8)]
+
+    results = _embed_concurrently(service, requests)
+
+    for texts, result in zip(requests, results):
+        np.testing.assert_allclose(result, np.stack([vector(text) for text in texts]))
+    assert len(model.calls) < len(requests)
+    # A text asked for by several callers of a batch is encoded once per batch.
+    assert sum(call.count("shared query") for call in model.calls) == len(model.calls)
+    assert service.stats["batches"] == len(model.calls)
+
+
+def test_batches_stay_under_max_batch_size():
+    model = FakeModel(delay_s=0.02)
+    service = EmbeddingService(model, max_batch_size=4, max_wait_ms=50)
+
+    _embed_concurrently(service, [[f"text {i}", f"other {i}"] for i in range(8)])
+
+    assert max(len(call) for call in model.calls) <= 4
+    assert sum(len(call) for call in model.calls) == 16
+
+
+def test_lru_cache_evicts_the_least_recently_used_text():
+    model = FakeModel()
+    service = EmbeddingService(model, cache_size=2)
+
+    service(["a", "b"])
+    service(["a"])  # a is now the most recently used
+    service(["c"])  # evicts b
+    service(["a", "b"])
+
+    assert model.calls == [["a", "b"], ["c"], ["b"]]
+    assert service.stats["cache_hits"] == 2
+
+
+def test_encoding_errors_reach_every_caller_of_the_batch():
+    service = EmbeddingService(FakeModel(delay_s=0.02, error=RuntimeError("model crashed")), max_wait_ms=50)
+    errors = []
+
+    def run(texts):
+        try:
+            service(texts)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=([f"text {i}"],)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert len(errors) == 3
+    # Nothing was cached, so the texts are encoded again next time.
+    with pytest.raises(RuntimeError):
+        service(["text 0"])
+
+
+def test_no_texts_give_an_empty_matrix():
+    assert EmbeddingService(FakeModel())([]).shape == (0, DIMENSION)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from evaluation import NO_PREDICTION, answer_keys, load_predictions
+
+HEADER = b"QuestionId_Answer,MisconceptionId\n"
+
+
+def _load(tmp_path, body: bytes, k=3, block_size=1 << 24):
+    path = tmp_path / "submission.csv"
+    path.write_bytes(HEADER + body)
+    return load_predictions(str(path), k=k, block_size=block_size)
+
+
+def _expected(*rows):
+    keys = answer_keys([question for question, _, _ in rows], ["ABCD".index(option) for _, option, _ in rows])
+    predictions = np.full((len(rows), 3), NO_PREDICTION, dtype=np.int32)
+    for i, (_, _, ranked) in enumerate(rows):
+        predictions[i, :len(ranked)] = ranked
+    return keys, predictions
+
+
+@pytest.mark.parametrize("body", [
+    b"1869_B,1 2 3\n1870_C,4 5\n",
+    b'"1869_B","1 2 3"\n"1870_C","4 5"\n',
+    b"1869_B,1 2 3\r\n1870_C,4 5\r\n",
+    b'"1869_B","1 2 3"\r\n"1870_C","4 5"\r\n',
+    b"1869_B,1 2 3\n1870_C,4 5",
+    b"1869_B,1 2 3\n\n1870_C,4 5\n",
+])
+def test_parses_plain_quoted_and_crlf_lines(tmp_path, body):
+    keys, predictions = _load(tmp_path, body)
+    expected_keys, expected_predictions = _expected((1869, "B", [1, 2, 3]), (1870, "C", [4, 5]))
+
+    np.testing.assert_array_equal(keys, expected_keys)
+    np.testing.assert_array_equal(predictions, expected_predictions)
+
+
+@pytest.mark.parametrize("body", [b"1869_B,\n1870_C,4\n", b'"1869_B",""\r\n"1870_C","4"'])
+def test_empty_prediction_lists_are_padded(tmp_path, body):
+    keys, predictions = _load(tmp_path, body)
+    expected_keys, expected_predictions = _expected((1869, "B", []), (1870, "C", [4]))
+
+    np.testing.assert_array_equal(keys, expected_keys)
+    np.testing.assert_array_equal(predictions, expected_predictions)
+
+
+def test_lines_split_across_blocks(tmp_path):
+    body = b"".join(b'"%d_A","%d %d"\r\n' % (question, question, question + 1) for question in range(100))
+    keys, predictions = _load(tmp_path, body, block_size=7)
+
+    np.testing.assert_array_equal(keys, answer_keys(np.arange(100), 0))
+    np.testing.assert_array_equal(predictions[:, :2], np.stack([np.arange(100), np.arange(1, 101)], axis=1))
+
+
+def test_rejects_malformed_lines(tmp_path):
+    with pytest.raises(ValueError, match="Malformed"):
+        _load(tmp_path, b"1869_B,1 2 3\n1870,4 5\n")
@@ -0,0 +1,17 @@
+from materialize import MaterializedPredictions, PredictionWriter
+
+META = {"version": "2", "tag": "abc"}
+
+
+def test_resumed_jobs_predict_incomplete_keys_again(tmp_path):
+    path = str(tmp_path / "predictions.sqlite3")
+    writer = PredictionWriter(path, META)
+    writer.put(4, "complete")
+    writer.put(5, "late", truncated=True)
+
+    assert writer.done() == {4}
+    writer.put(5, "complete now")
+    assert writer.done() == {4, 5}
+    writer.finish(complete=True)
+
+    assert MaterializedPredictions(path, "abc").predictions == {4: "complete", 5: "complete now"}
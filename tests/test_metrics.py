@@ -0,0 +1,42 @@
+import numpy as np
+
+from metrics import LATENCY_BUCKETS, MetricsCallback, merge_percentiles
+
+
+def _hist(bucket, calls):
+    hist = np.zeros(len(LATENCY_BUCKETS) + 1, dtype=np.int64)
+    hist[bucket] = calls
+    return hist
+
+
+def test_percentiles_of_merged_histograms_are_read_from_their_sum():
+    fast, slow = _hist(10, 90), _hist(100, 10)
+
+    merged = merge_percentiles([fast, slow])
+
+    assert merged["p50_ms"] == merged["p90_ms"] == LATENCY_BUCKETS[10]
+    # A call-weighted average of the two p99s would land between the buckets.
+    assert merged["p99_ms"] == LATENCY_BUCKETS[100]
+
+
+def test_empty_histograms_have_zero_percentiles():
+    assert merge_percentiles([_hist(0, 0)]) == {"p50_ms": 0.0, "p90_ms": 0.0, "p99_ms": 0.0}
+
+
+class Response:
+    _hidden_params = {}
+
+
+def test_cache_hits_are_not_confused_by_reused_ids():
+    callback = MetricsCallback()
+    response = Response()
+    assert not callback._is_cache_hit(response)
+    assert callback._is_cache_hit(response)
+
+    key = id(response)
+    del response
+    fresh = [Response() for _ in range(1000)]
+    reused = [candidate for candidate in fresh if id(candidate) == key]
+
+    assert reused, "no new response reused the collected one's id"
+    assert not callback._is_cache_hit(reused[0])
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+from misconception_index import MisconceptionIndex, bm25_weights, build_index, rrf, top_columns
+
+NAMES = [
+    "Multiplies instead of divides",
+    "Adds instead of multiplies",
+    "Carries out operations from left to right regardless of priority order",
+    "Confuses the order of operations, believes addition comes before multiplication",
+    "Thinks a square root is half the number",
+]
+
+
+def test_rrf_sums_reciprocal_ranks_and_skips_missing_entries():
+    lexical = np.array([[2, 0, 1]])
+    dense = np.array([[0, 3, -1]])
+
+    fused = rrf(lexical, dense, n_columns=4, k=60)
+
+    np.testing.assert_allclose(fused, [[1 / 62 + 1 / 61, 1 / 63, 1 / 61, 1 / 62]], rtol=1e-6)
+    assert top_columns(fused, 4).tolist() == [[0, 2, 3, 1]]
+
+
+def test_top_columns_orders_each_row_best_first():
+    scores = np.array([[0.1, 0.9, 0.5, 0.7], [3.0, 1.0, 2.0, 0.0]])
+
+    assert top_columns(scores, 3).tolist() == [[1, 3, 2], [0, 2, 1]]
+    assert top_columns(scores, 0).shape == (2, 0)
+
+
+def test_bm25_prefers_rare_terms_and_short_names():
+    # Term 0 is in every name, term 1 in one; names 1 and 2 hold term 1 at different lengths.
+    counts = sp.csr_matrix(np.array([[1, 0, 1], [1, 1, 0], [1, 1, 4]], dtype=np.float32))
+
+    weights = bm25_weights(counts).toarray()
+
+    assert weights[1, 1] > weights[1, 0]
+    assert weights[1, 1] > weights[2, 1]
+
+
+class OneHotEmbedder:
+    """Dense 'meaning': a text's vector is the one-hot of the first keyword it contains."""
+    KEYWORDS = ("divid", "multipl", "left", "order", "root")
+
+    def __call__(self, texts):
+        vectors = np.zeros((len(texts), len(self.KEYWORDS)), dtype=np.float32)
+        for i, text in enumerate(texts):
+            hits = [j for j, keyword in enumerate(self.KEYWORDS) if keyword in text.lower()]
+            vectors[i, hits[0] if hits else 0] = 1.0
+        return vectors
+
+
+@pytest.fixture
+def mis_data_path(tmp_path):
+    path = tmp_path / "misconception_mapping.csv"
+    pd.DataFrame({"MisconceptionId": [10, 11, 12, 13, 14], "MisconceptionName": NAMES}).to_csv(path, index=False)
+    return str(path)
+
+
+def test_lexical_search_ranks_names_sharing_the_query_terms(mis_data_path, tmp_path):
+    index = MisconceptionIndex.open_or_build(mis_data_path, str(tmp_path / "index"))
+
+    assert index.search(["multiplies instead of divides"], k=2).tolist() == [[10, 11]]
+    # Names sharing no term with the query get no lexical rank, so they score 0.
+    scores = index.scores(["square root"])
+    assert scores[0].argmax() == 4 and np.count_nonzero(scores) == 1
+
+
+def test_hybrid_search_fuses_lexical_and_dense_rankings(mis_data_path, tmp_path):
+    embed = OneHotEmbedder()
+    build_index(mis_data_path, str(tmp_path / "index"), embed, "one-hot")
+    index = MisconceptionIndex(str(tmp_path / "index"), embed)
+
+    scores = index.scores(["works left to right"])
+
+    # First for both retrievers: the fused score is scaled to 1.
+    assert scores[0].max() == pytest.approx(1.0)
+    assert index.search(["works left to right"], k=1).tolist() == [[12]]
+    # No term in common with any name: only the dense ranking contributes.
+    assert np.count_nonzero(index.lexical_scores(["halving roots"]).toarray()) == 0
+    assert index.search(["halving roots"], k=1).tolist() == [[14]]
@@ -0,0 +1,41 @@
+from predict_model import ExchangeOfThought
+from resilience import AgentError, LMDeadlineExceeded
+
+INPUTS = {"QuestionText": "q", "AnswerText": "a", "ConstructName": "", "SubjectName": "", "CorrectAnswer": "c"}
+
+
+class ScriptedAgent:
+    """Returns a thought per call, or raises AgentError for calls listed in `failures`."""
+
+    def __init__(self, name, failures=None):
+        self.name = name
+        self.failures = failures or {}
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls in self.failures:
+            raise AgentError(self.name, self.failures[self.calls])
+        return f"{self.name} thought {self.calls}"
+
+
+def _exchange(agent_b):
+    return ExchangeOfThought(ScriptedAgent("Agent A"), agent_b, ScriptedAgent("Agent C"), rounds=3, mode="Report")
+
+
+def test_an_agent_running_out_of_time_truncates_the_exchange():
+    deadline = LMDeadlineExceeded("LM request did not finish before its deadline", "openai")
+    result = _exchange(ScriptedAgent("Agent B", {2: deadline}))(**INPUTS)
+
+    assert result.truncated
+    assert (result.rounds_completed, result.rounds) == (1, 3)
+    assert result.failed_agents == ("Agent B",)
+    assert result == "Agent A thought 3"
+
+
+def test_other_agent_failures_do_not_truncate_the_exchange():
+    result = _exchange(ScriptedAgent("Agent B", {2: RuntimeError("bad output")}))(**INPUTS)
+
+    assert not result.truncated
+    assert (result.rounds_completed, result.rounds) == (3, 3)
+    assert result.failed_agents == ("Agent B",)
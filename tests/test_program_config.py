@@ -0,0 +1,66 @@
+import pickle
+from dataclasses import replace
+
+import pytest
+
+from program_config import APP_PROGRAM, AgentConfig, ProgramConfig, config_meta, predict, process_pool
+from semantic_cache import SemanticCache
+
+
+class FakeLM:
+    model = "openai/gpt-4o-mini"
+
+
+@pytest.mark.parametrize("change", [
+    {"demo_selector": None},
+    {"demo_selector": "dense"},
+    {"classifier": True},
+    {"rule_engine": True},
+    {"semantic_cache_path": None},
+    {"timeout": 60},
+    {"reasoning_store_path": "./cache/reasoning.sqlite3"},
+    {"rounds": 1},
+    {"agents": tuple(AgentConfig(agent.name, speculative_samples=2) for agent in APP_PROGRAM.agents)},
+])
+def test_tag_covers_every_setting_of_the_program(change):
+    assert config_meta(replace(APP_PROGRAM, **change), FakeLM())["tag"] != config_meta(APP_PROGRAM, FakeLM())["tag"]
+
+
+def test_tag_is_stable_across_serialization():
+    restored = ProgramConfig.from_json(APP_PROGRAM.to_json())
+
+    assert restored == APP_PROGRAM
+    assert config_meta(restored, FakeLM())["tag"] == config_meta(APP_PROGRAM, FakeLM())["tag"]
+
+
+def test_tag_depends_on_the_models_behind_the_lm():
+    other = FakeLM()
+    other.model = "openai/gpt-4o"
+
+    assert config_meta(APP_PROGRAM, other)["tag"] != config_meta(APP_PROGRAM, FakeLM())["tag"]
+
+
+def test_configs_survive_pickling():
+    config = replace(APP_PROGRAM, agents=(AgentConfig("Agent A", kind="basic", persona="AGENT_A_new"),
+                                          AgentConfig("Agent B", speculative_samples=2), AgentConfig("Agent C")),
+                     router_models=("openai/gpt-4o-mini", "openai/gpt-4o"))
+
+    assert pickle.loads(pickle.dumps(config)) == config
+
+
+def test_process_pool_workers_build_the_same_program(tmp_path, monkeypatch):
+    # The workers answer from a semantic cache entry stored under the parent's tag: no LM request is
+    # made, and a worker whose unpickled config or LM differed would miss it.
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    config = ProgramConfig(mode="Report", rounds=2, lm="openai", compiled_path=None,
+                           semantic_cache_path=str(tmp_path / "semantic.sqlite3"))
+    question = "What is the value of 2 + 3 \\times 4?"
+    SemanticCache(config.semantic_cache_path, namespace=config.meta()["tag"]).store(
+        question, "20", "14", "Carries out operations from left to right")
+    inputs = {"QuestionText": question, "AnswerText": "20", "ConstructName": "", "SubjectName": "", "CorrectAnswer": "14"}
+
+    with process_pool(config, workers=1) as pool:
+        result = pool.submit(predict, inputs).result(timeout=120)
+
+    assert result == "Carries out operations from left to right"
+    assert (result.rounds, result.truncated, result.failed_agents) == (2, False, ())
@@ -0,0 +1,25 @@
+import os
+
+import pandas as pd
+
+from question_store import QuestionStore, build_store
+
+MIS_DATA_PATH = "./data/misconception_mapping.csv"
+
+
+def test_rebuilds_do_not_touch_the_files_open_readers_map(tmp_path):
+    train = pd.read_csv("./data/train.csv").head(20)
+    q_data_path = str(tmp_path / "train.csv")
+    store_dir = str(tmp_path / "question_store")
+    train.to_csv(q_data_path, index=False)
+    build_store(q_data_path, MIS_DATA_PATH, store_dir)
+    reader = QuestionStore(store_dir)
+    before = reader.question(3)
+
+    train["QuestionText"] = "Rewritten " + train["QuestionText"] + " with a longer text"
+    train.iloc[::-1].to_csv(q_data_path, index=False)
+    build_store(q_data_path, MIS_DATA_PATH, store_dir)
+
+    assert reader.question(3) == before
+    assert QuestionStore(store_dir).question(16)["question_text"].startswith("Rewritten ")
+    assert sorted(os.listdir(tmp_path)) == ["question_store", "train.csv"]
@@ -0,0 +1,37 @@
+import threading
+import time
+
+from reasoning_store import ReasoningStore
+
+
+def test_reasoning_is_keyed_on_context_and_persona(tmp_path):
+    store = ReasoningStore(str(tmp_path / "reasoning.sqlite3"))
+    store.put("1 + 1", "2", "first call")
+    store.put("1 + 1", "2", "after agent A", context="Agent A concludes: (x)")
+    store.put("1 + 1", "2", "as a teacher", persona="You are a teacher.")
+
+    assert store.get("1 + 1", "2") == "first call"
+    assert store.get("1 + 1", "2", "Agent A concludes: (x)") == "after agent A"
+    assert store.get("1 + 1", "2", "Agent A concludes: (y)") is None
+    assert store.get("1 + 1", "2", persona="You are a teacher.") == "as a teacher"
+
+
+def test_concurrent_callers_compute_once(tmp_path):
+    store = ReasoningStore(str(tmp_path / "reasoning.sqlite3"))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return "solution"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get_or_compute("1 + 1", "2", compute, "ctx")))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["solution"] * 8
+    assert len(calls) == 1
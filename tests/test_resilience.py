@@ -0,0 +1,96 @@
+import threading
+import time
+
+import dspy
+import pytest
+from dspy.utils.callback import BaseCallback
+
+from resilience import (LMDeadlineExceeded, ProviderLimiter, call_with_retry, deadline_scope, remaining_time,
+                        retry_after)
+from util import RateLimitedLM
+
+
+class RecordingCallback(BaseCallback):
+    def __init__(self):
+        self.threads = []
+
+    def on_lm_start(self, call_id, instance, inputs):
+        self.threads.append(threading.current_thread().name)
+
+
+def mock_lm():
+    return RateLimitedLM("openai/gpt-4o-mini", rate_limit_key="test", api_key="test", mock_response="ok", cache=False)
+
+
+def in_thread(target):
+    result = {}
+
+    def run():
+        try:
+            result["value"] = target()
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, name="not-main")
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def test_callbacks_fire_when_dspy_is_configured_outside_the_main_thread():
+    callback = RecordingCallback()
+
+    def run():
+        dspy.configure(lm=mock_lm(), callbacks=[callback])
+        return dspy.settings.lm(messages=[{"role": "user", "content": "hi"}])
+
+    assert in_thread(run) == ["ok"]
+    # The request itself runs on a pool thread of run_before_deadline.
+    assert len(callback.threads) == 1 and callback.threads[0].startswith("lm-request")
+
+
+def test_callbacks_fire_under_dspy_context_in_another_thread():
+    callback = RecordingCallback()
+
+    def run():
+        with dspy.context(lm=mock_lm(), callbacks=[callback]):
+            return dspy.settings.lm(messages=[{"role": "user", "content": "hi"}])
+
+    assert in_thread(run) == ["ok"]
+    assert len(callback.threads) == 1
+
+
+def test_request_sees_its_deadline():
+    seen = []
+    deadline = time.monotonic() + 5
+    call_with_retry(lambda: seen.append(remaining_time()), "test", deadline=deadline)
+    assert seen[0] is not None and 0 < seen[0] <= 5
+
+
+def test_abandoned_request_raises_at_the_deadline():
+    start = time.monotonic()
+    with deadline_scope(start + 0.2), pytest.raises(LMDeadlineExceeded):
+        call_with_retry(lambda: time.sleep(2), "test")
+    assert time.monotonic() - start < 1.5
+
+
+@pytest.mark.parametrize("headers, seconds", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"llm_provider-retry-after": "2"}, 2.0),
+    ({"retry-after-ms": None, "retry-after": "3"}, 3.0),
+    ({"retry-after-ms": "soon"}, None),
+    (None, None),
+])
+def test_retry_after(headers, seconds):
+    assert retry_after(headers) == seconds
+
+
+def test_limiter_ignores_non_positive_limits():
+    limiter = ProviderLimiter("test", requests_per_minute=60, tokens_per_minute=1000)
+    limiter.update_from_headers({"x-ratelimit-limit-requests": "0", "x-ratelimit-limit-tokens": "-5",
+                                 "x-ratelimit-remaining-requests": "0"})
+
+    assert (limiter.requests_per_minute, limiter.tokens_per_minute) == (60, 1000)
+    assert limiter._wait_time(10, time.monotonic()) == pytest.approx(1.0, abs=0.1)
@@ -0,0 +1,72 @@
+import pytest
+
+from metrics import metrics_context
+from routing import ModelRouter, default_confidence_check
+
+CONFIDENT = "[[ ## MisconceptionText ## ]]\nAdds before multiplying\n\n[[ ## completed ## ]]"
+HEDGING = "[[ ## MisconceptionText ## ]]\nI'm not sure which misconception this is\n\n[[ ## completed ## ]]"
+
+
+class FakeTier:
+    def __init__(self, name, answer=CONFIDENT):
+        self.name = name
+        self.answer = answer
+        self.kwargs = {"temperature": 0.0, "max_tokens": 100}
+        self.calls = 0
+
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        self.calls += 1
+        return [self.answer]
+
+
+def _router(cheap_answer=CONFIDENT):
+    return ModelRouter({"cheap": FakeTier("cheap", cheap_answer), "strong": FakeTier("strong")})
+
+
+def _tier_of(router, **context):
+    with metrics_context(output_fields=("MisconceptionText",), **context):
+        router(messages=[{"role": "user", "content": "q"}])
+    return [name for name, calls in router.stats.items() if calls]
+
+
+@pytest.mark.parametrize("context, tier", [
+    ({"signature": "SolveAgentSignature", "agent": "Agent A", "round": 2, "rounds": 2}, "cheap"),
+    ({"signature": "SelectAgentSignature", "agent": "Agent B"}, "cheap"),
+    ({"signature": "FinAgentSignature", "agent": "Agent A", "round": 2, "rounds": 2}, "strong"),
+    ({"signature": "BaseAgentSignature", "agent": "Agent A"}, "strong"),
+    ({"signature": "FinAgentSignature", "agent": "Agent A", "round": 1, "rounds": 2}, "cheap"),
+    ({"signature": "FinAgentSignature", "agent": "Agent B", "round": 2, "rounds": 2}, "cheap"),
+    ({}, "cheap"),
+])
+def test_requests_go_to_the_tier_of_their_role(context, tier):
+    assert _tier_of(_router(), **context) == [tier]
+
+
+def test_unconfident_cheap_answers_escalate_to_the_strong_tier():
+    router = _router(cheap_answer=HEDGING)
+
+    with metrics_context(signature="MisAgentSignature", agent="Agent B", output_fields=("MisconceptionText",)):
+        outputs = router(messages=[{"role": "user", "content": "q"}])
+
+    assert outputs == [CONFIDENT]
+    assert router.stats == {"cheap": 1, "escalated_to_strong": 1}
+
+
+def test_the_judge_is_never_escalated():
+    router = _router(cheap_answer="")
+
+    with metrics_context(signature="SolveAgentSignature", output_fields=("answer",)):
+        router(messages=[{"role": "user", "content": "q"}])
+
+    assert router.stats == {"cheap": 1}
+
+
+@pytest.mark.parametrize("output, trusted", [
+    (CONFIDENT, True),
+    (HEDGING, False),
+    ("[[ ## MisconceptionText ## ]]\n\n[[ ## completed ## ]]", False),
+    ("Adds before multiplying", False),
+    ("   ", False),
+])
+def test_confidence_check(output, trusted):
+    assert default_confidence_check(output, ("MisconceptionText",)) == trusted
@@ -0,0 +1,22 @@
+from dataclasses import replace
+
+from program_config import APP_PROGRAM
+from rule_engine import RULES, RuleEngine
+
+QUESTION = r"\( 2+3 \times 4 = \)"
+MIS_DATA_PATH = "./data/misconception_mapping.csv"
+
+
+def test_rules_below_the_precision_threshold_do_not_answer():
+    assert RuleEngine(mis_data_path=MIS_DATA_PATH).match(QUESTION, r"\( 20 \)", r"\( 14 \)") is None
+
+
+def test_precise_rules_answer():
+    rules = [replace(rule, precision=1.0) if rule.name == "left_to_right" else rule for rule in RULES]
+    match = RuleEngine(rules, MIS_DATA_PATH).match(QUESTION, r"\( 20 \)", r"\( 14 \)")
+
+    assert (match.rule, match.misconception_id) == ("left_to_right", 1507)
+
+
+def test_app_program_runs_without_the_rule_engine():
+    assert not APP_PROGRAM.rule_engine
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+import safe_math
+from safe_math import ExpressionError, check_size, evaluate, parse, to_python
+
+
+@pytest.mark.parametrize("latex, value", [
+    ("2^{10}", "1024"),
+    (r"\frac{1}{2}+\frac{1}{3}", "5/6"),
+    ("x^2=4", "x = -2, 2"),
+    ("2x+3x", "5*x"),
+    ("x^{64}", "x**64"),
+    ("2^{x}", "2**x"),
+])
+def test_evaluates_ordinary_expressions(latex, value):
+    assert evaluate(latex).value == value
+
+
+@pytest.mark.parametrize("latex", [
+    "x+((((2^{64})^{64})^{64})^{64})^{64}",
+    "x+(((((2^{64})^{64})^{64})^{64})^{64})^{64}",
+    "((2^{64})^{64})^{64}",
+    "((x+1)^{64})^{64}",
+    "x^{65}",
+    "(2^{4096})x",
+])
+def test_rejects_huge_powers_before_building_them(latex):
+    start = time.monotonic()
+    with pytest.raises(ExpressionError, match="too large"):
+        evaluate(latex, timeout=1.0)
+    assert time.monotonic() - start < 0.5
+
+
+def test_check_size_multiplies_nested_exponents():
+    bits, degree = check_size(parse(to_python("(x^{2})^{3}")[0]))
+    assert degree == 6
+    with pytest.raises(ExpressionError):
+        check_size(parse(to_python("(2^{64})^{64}")[0]))
+
+
+def test_busy_workers_fail_fast(monkeypatch):
+    release = threading.Event()
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(safe_math, "_sympy_slots", slots)
+    # A timed-out call keeps its worker (and slot) until its work ends.
+    with pytest.raises(ExpressionError, match="timed out"):
+        safe_math._run_sympy(lambda: release.wait(5), timeout=0.05)
+    start = time.monotonic()
+    with pytest.raises(ExpressionError, match="busy"):
+        safe_math._run_sympy(lambda: "never runs", timeout=1.0)
+    assert time.monotonic() - start < 0.5
+    release.set()
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline:
+        try:
+            assert safe_math._run_sympy(lambda: "ok", timeout=1.0) == "ok"
+            break
+        except ExpressionError:
+            time.sleep(0.01)
+    else:
+        pytest.fail("the slot was not given back")
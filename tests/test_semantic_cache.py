@@ -0,0 +1,86 @@
+import sqlite3
+
+from predict_model import ExchangeOfThought
+from resilience import AgentError
+from semantic_cache import SemanticCache
+
+QUESTION = "What is the value of 2 + 3 \\times 4?"
+NEAR_DUPLICATE = "What is the value of 2 + 3 \\times 4 ?"
+
+
+class FakeAgent:
+    def __init__(self, name, thought=None, fail=False):
+        self.name = name
+        self.thought = thought or f"{name} thinks"
+        self.fail = fail
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise AgentError(self.name, RuntimeError("down"))
+        return self.thought
+
+
+def test_entries_are_only_served_to_their_namespace(tmp_path):
+    path = str(tmp_path / "semantic.sqlite3")
+    SemanticCache(path, namespace="a").store(QUESTION, "20", "14", "Adds before multiplying")
+
+    assert SemanticCache(path, namespace="a").lookup(NEAR_DUPLICATE, "20", "14").result == "Adds before multiplying"
+    assert SemanticCache(path, namespace="b").lookup(NEAR_DUPLICATE, "20", "14") is None
+
+
+def test_shared_entries_are_served_to_every_namespace(tmp_path):
+    path = str(tmp_path / "semantic.sqlite3")
+    SemanticCache(path, namespace="a").store(QUESTION, "20", "14", "Adds before multiplying", source="train", shared=True)
+
+    assert SemanticCache(path, namespace="b").lookup(QUESTION, "20", "14").result == "Adds before multiplying"
+
+
+def test_drops_entries_without_a_namespace(tmp_path):
+    path = str(tmp_path / "semantic.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE entries (
+            id INTEGER PRIMARY KEY, question TEXT NOT NULL, answer TEXT NOT NULL, correct TEXT NOT NULL,
+            signature BLOB NOT NULL, result TEXT NOT NULL, source TEXT, created REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0, UNIQUE (question, answer, correct)
+        )
+    """)
+    conn.execute("INSERT INTO entries VALUES (1, 'q', 'a', 'c', x'00', 'r', 'live', 0, 0)")
+    conn.commit()
+    conn.close()
+
+    cache = SemanticCache(path, namespace="a")
+    assert len(cache) == 0
+    cache.store(QUESTION, "20", "14", "Adds before multiplying")
+    assert len(cache) == 1
+
+
+def _exchange(cache, fail_b=False):
+    agents = [FakeAgent("Agent A", "Adds before multiplying"), FakeAgent("Agent B", fail=fail_b), FakeAgent("Agent C")]
+    return ExchangeOfThought(*agents, rounds=1, mode="Report", semantic_cache=cache), agents
+
+
+def test_stores_complete_exchanges(tmp_path):
+    cache = SemanticCache(str(tmp_path / "semantic.sqlite3"), namespace="a")
+    program, _ = _exchange(cache)
+
+    result = program(QuestionText=QUESTION, AnswerText="20", ConstructName="", SubjectName="", CorrectAnswer="14")
+
+    assert result.failed_agents == ()
+    assert cache.lookup(QUESTION, "20", "14").result == "Adds before multiplying"
+
+
+def test_does_not_store_exchanges_an_agent_dropped_out_of(tmp_path):
+    cache = SemanticCache(str(tmp_path / "semantic.sqlite3"), namespace="a")
+    program, agents = _exchange(cache, fail_b=True)
+
+    result = program(QuestionText=QUESTION, AnswerText="20", ConstructName="", SubjectName="", CorrectAnswer="14")
+
+    assert result == "Adds before multiplying"
+    assert result.failed_agents == ("Agent B",)
+    assert len(cache) == 0
+    # The next call runs the agents again instead of serving the degraded result.
+    program(QuestionText=QUESTION, AnswerText="20", ConstructName="", SubjectName="", CorrectAnswer="14")
+    assert agents[0].calls == 4
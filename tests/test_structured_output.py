@@ -0,0 +1,79 @@
+from typing import Literal
+
+import dspy
+import pytest
+
+from structured_output import coerce_literal, parse_completion, response_format_for
+
+
+class JudgeSignature(dspy.Signature):
+    """Decide whether the information is enough."""
+    question: str = dspy.InputField()
+    Judge: Literal["Yes", "No"] = dspy.OutputField()
+
+
+class ReasonedChoiceSignature(dspy.Signature):
+    """Pick a tool."""
+    question: str = dspy.InputField()
+    reasoning: str = dspy.OutputField()
+    Choice: Literal["Calculator", "WebSearch", "None"] = dspy.OutputField()
+
+
+@pytest.mark.parametrize("text, value", [
+    ("Yes", "Yes"),
+    ("**yes.**", "Yes"),
+    ("No, the question needs more context", "No"),
+    ("There is not enough information", "No"),
+    ("I can answer it", "Yes"),
+    ("Yess", "Yes"),
+    ("maybe", None),
+])
+def test_coerce_yes_no(text, value):
+    assert coerce_literal(text, ("Yes", "No")) == value
+
+
+@pytest.mark.parametrize("text, value", [
+    ("I'd use the Web Search tool", "WebSearch"),
+    ("calculator, then websearch", "Calculator"),
+    ("`Calculater`", "Calculator"),
+    ("a spreadsheet", None),
+])
+def test_coerce_tool_names(text, value):
+    assert coerce_literal(text, ("Calculator", "WebSearch", "None")) == value
+
+
+@pytest.mark.parametrize("completion", [
+    '{"reasoning": "needs arithmetic", "Choice": "calculator"',  # truncated
+    "{'reasoning': 'needs arithmetic', 'Choice': 'Calculator',}",  # single quotes, trailing comma
+    '{"reasoning": "needs arithmetic", "Choice": "**Calculator**"}\n```',
+])
+def test_parses_malformed_json(completion):
+    assert parse_completion(ReasonedChoiceSignature, completion) == {"reasoning": "needs arithmetic", "Choice": "Calculator"}
+
+
+def test_sections_fill_in_fields_missing_from_json():
+    completion = '[[ ## reasoning ## ]]\nneeds arithmetic\n\n[[ ## Choice ## ]]\nCalculator.\n\n[[ ## completed ## ]]'
+
+    assert parse_completion(ReasonedChoiceSignature, completion) == {"reasoning": "needs arithmetic", "Choice": "Calculator"}
+
+
+def test_single_output_signatures_take_a_bare_answer():
+    assert parse_completion(JudgeSignature, "Yes, that is sufficient.") == {"Judge": "Yes"}
+
+
+def test_unmatched_literals_keep_their_raw_text():
+    assert parse_completion(JudgeSignature, "[[ ## Judge ## ]]\n  perhaps  ") == {"Judge": "perhaps"}
+
+
+@pytest.mark.parametrize("completion", ['{"reasoning": "needs arithmetic"', "[[ ## reasoning ## ]]\nneeds arithmetic", "Calculator"])
+def test_missing_fields_raise(completion):
+    with pytest.raises(ValueError, match="Choice"):
+        parse_completion(ReasonedChoiceSignature, completion)
+
+
+def test_response_format_lists_the_literal_options():
+    schema = response_format_for(ReasonedChoiceSignature)["json_schema"]["schema"]
+
+    assert schema["properties"] == {"reasoning": {"type": "string"},
+                                    "Choice": {"type": "string", "enum": ["Calculator", "WebSearch", "None"]}}
+    assert schema["required"] == ["reasoning", "Choice"]
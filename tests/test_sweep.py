@@ -0,0 +1,23 @@
+from sweep import ResultStore, Sweep, SweepConfig
+
+
+def test_truncated_and_failed_results_are_run_again(tmp_path):
+    store = ResultStore(str(tmp_path / "results.sqlite3"))
+    store.put("run", 1, "complete", 1.0, None)
+    store.put("run", 2, "late", 1.0, None, truncated=True)
+    store.put("run", 3, None, 1.0, "LMError('down')")
+
+    assert store.done("run") == {1}
+
+
+def test_runs_are_keyed_by_the_whole_configuration(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    config = SweepConfig("Report", 1, "none")
+
+    def runs(**options):
+        return Sweep([config], [], str(tmp_path), lm="openai", compiled_path=None, **options).runs[config]
+
+    assert runs().startswith("Report-r1-none-")
+    assert runs() == runs()
+    assert runs(timeout=30) != runs()
+    assert runs(reasoning_store_path=str(tmp_path / "reasoning.sqlite3")) != runs()
@@ -0,0 +1,41 @@
+import json
+
+import tracing
+from tracing import Span, Tracer
+
+
+def _exported(path):
+    with open(path) as f:
+        return [[span["name"] for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]] for line in f]
+
+
+def test_exports_a_trace_when_its_root_span_ends(tmp_path):
+    tracer = Tracer(str(tmp_path / "traces.jsonl"))
+    with tracer.span("root"):
+        with tracer.span("child"):
+            pass
+
+    assert _exported(tracer.path) == [["child", "root"]]
+    assert tracer._finished == {}
+
+
+def test_late_spans_are_exported_on_their_own(tmp_path):
+    tracer = Tracer(str(tmp_path / "traces.jsonl"))
+    root, token = tracer.start_span("root")
+    late = Span("abandoned agent call", root)
+    tracer.end_span(root, token)
+
+    tracer.end_span(late)
+
+    assert _exported(tracer.path) == [["root"], ["abandoned agent call"]]
+    assert tracer._finished == {}
+
+
+def test_remembers_a_bounded_number_of_exported_traces(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "MAX_EXPORTED_TRACES", 2)
+    tracer = Tracer(str(tmp_path / "traces.jsonl"))
+    for _ in range(5):
+        with tracer.span("root"):
+            pass
+
+    assert len(tracer._exported) == 2
@@ -0,0 +1,166 @@
+import random
+import threading
+import time
+
+import pytest
+
+from batch_score import Worker
+from predict_model import ExchangeResult
+from program_config import ProgramConfig
+from work_queue import DONE, FAILED, Heartbeat, HTTPWorkQueue, MemoryWorkQueue, QueueServer, SQLiteWorkQueue
+
+
+@pytest.fixture(params=["memory", "sqlite", "http"])
+def make_queue(request, tmp_path):
+    """
+    Queue factory; SQLite queues of one test share a file, like workers in separate processes, and
+    HTTP queues share a QueueServer in front of one, like workers on other hosts.
+    """
+    if request.param == "http":
+        servers = []
+
+        def make_http_queue(max_attempts=3):
+            if not servers:
+                servers.append(QueueServer(SQLiteWorkQueue(str(tmp_path / "tasks.queue"), max_attempts),
+                                           "127.0.0.1", 0, token="secret").start())
+                request.addfinalizer(servers[0].stop)
+            return HTTPWorkQueue(servers[0].url, token="secret")
+        return make_http_queue
+    if request.param == "memory":
+        queues = []
+
+        def make_memory_queue(max_attempts=3):
+            if not queues:
+                queues.append(MemoryWorkQueue(max_attempts=max_attempts))
+            return queues[0]
+        return make_memory_queue
+    path = str(tmp_path / "tasks.queue")
+    return lambda max_attempts=3: SQLiteWorkQueue(path, max_attempts=max_attempts)
+
+
+def test_expired_lease_goes_to_another_worker(make_queue):
+    queue = make_queue()
+    queue.enqueue([(1, {"x": 1})])
+
+    assert [task.key for task in queue.lease("a", lease_s=0.05)] == [1]
+    assert queue.lease("b") == []
+    time.sleep(0.1)
+    tasks = queue.lease("b")
+
+    assert [(task.key, task.attempts) for task in tasks] == [(1, 2)]
+
+
+def test_heartbeats_keep_a_lease(make_queue):
+    queue = make_queue()
+    queue.enqueue([(1, {"x": 1})])
+    queue.lease("a", lease_s=0.2)
+
+    with Heartbeat(queue, "a", lease_s=0.2, interval_s=0.05) as heartbeat:
+        heartbeat.hold(1)
+        time.sleep(0.5)
+        assert queue.lease("b") == []
+    # Only the holder can extend a lease.
+    assert queue.heartbeat("b", [1], lease_s=10) == 0
+    time.sleep(0.3)
+
+    assert [task.key for task in queue.lease("b")] == [1]
+
+
+def test_tasks_fail_after_max_attempts(make_queue):
+    queue = make_queue(max_attempts=2)
+    queue.enqueue([(1, {"x": 1}), (2, {"x": 2})])
+
+    # Task 1 fails twice, task 2 is leased by workers that die twice.
+    for worker in ("a", "b"):
+        for task in queue.lease(worker, n=2, lease_s=0.05):
+            if task.key == 1:
+                queue.fail(task.key, worker, "boom")
+        time.sleep(0.1)
+
+    assert queue.lease("c", n=2) == []
+    assert queue.counts()[FAILED] == 2
+    assert queue.retry_failed() == 2
+    assert {task.key: task.attempts for task in queue.lease("c", n=2)} == {1: 1, 2: 1}
+
+
+def test_first_result_wins(make_queue):
+    queue = make_queue()
+    queue.enqueue([(1, {"x": 1})])
+    queue.lease("slow", lease_s=0.05)
+    time.sleep(0.1)
+    queue.lease("fast")
+
+    assert queue.complete(1, "fast", "from fast")
+    # The worker whose lease expired finishes late; its result is dropped.
+    assert not queue.complete(1, "slow", "from slow")
+    assert queue.results() == {1: "from fast"}
+    assert queue.finished()
+
+
+class FlakyWorker(Worker):
+    """Doubles payload["x"]; one attempt in twenty raises."""
+
+    def _score(self, task) -> str:
+        time.sleep(0.001)
+        if random.Random(f"{task.key}-{task.attempts}").random() < 0.05:
+            raise RuntimeError(f"flaky task {task.key}")
+        return str(task.payload["x"] * 2)
+
+
+def test_three_workers_finish_despite_a_dead_worker_and_flaky_tasks(make_queue):
+    tasks = [(key, {"x": key}) for key in range(200)]
+    make_queue(max_attempts=5).enqueue(tasks)
+    # A worker that leased tasks and died: no heartbeats, no results.
+    dead = make_queue(max_attempts=5).lease("dead", n=10, lease_s=0.3)
+
+    workers = []
+    for i in range(3):
+        worker = FlakyWorker(make_queue(max_attempts=5), threads=4, lease_s=0.3, poll_s=0.02)
+        worker.worker_id = f"worker-{i}"
+        workers.append(worker)
+    threads = [threading.Thread(target=worker.run) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    queue = make_queue(max_attempts=5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert queue.counts()[DONE] == len(tasks)
+    assert queue.results() == {key: str(key * 2) for key, _ in tasks}
+    assert sum(worker.completed for worker in workers) == len(tasks)
+    assert sum(worker.failed for worker in workers) > 0
+    assert {task.key for task in dead} <= set(queue.results())
+
+
+def test_queue_server_rejects_clients_without_the_token(tmp_path):
+    server = QueueServer(SQLiteWorkQueue(str(tmp_path / "tasks.queue")), "127.0.0.1", 0, token="secret").start()
+    try:
+        with pytest.raises(OSError):
+            HTTPWorkQueue(server.url, token="wrong").counts()
+        assert HTTPWorkQueue(server.url, token="secret").counts()[DONE] == 0
+    finally:
+        server.stop()
+
+
+class ScriptedWorker(Worker):
+    """Builds no program: the result of a task is scripted by the `rounds` of its ProgramConfig."""
+
+    RESULTS = {1: ExchangeResult("late", 0, 1, truncated=True), 2: ExchangeResult("partial", 2, 2, failed_agents=("Agent B",)),
+               3: ExchangeResult("complete", 3, 3)}
+
+    def _program(self, config: str):
+        return lambda **inputs: self.RESULTS[ProgramConfig.from_json(config).rounds]
+
+
+def test_degraded_predictions_are_failed_not_completed(make_queue):
+    queue = make_queue(max_attempts=1)
+    inputs = {"QuestionText": "q", "AnswerText": "a", "ConstructName": "", "SubjectName": "", "CorrectAnswer": "c"}
+    queue.enqueue([(rounds, {"config": ProgramConfig(rounds=rounds).to_json(), **inputs}) for rounds in (1, 2, 3)])
+
+    worker = ScriptedWorker(queue, threads=2, lease_s=1.0, poll_s=0.02)
+    worker.run()
+
+    assert queue.results() == {3: "complete"}
+    assert queue.counts()[FAILED] == 2
+    assert (worker.completed, worker.failed) == (1, 2)